@@ -4,8 +4,11 @@ import amquery.utils.iof as iof
 from amquery.utils.config import get_default_config
 from amquery.utils.multiprocess import Pool
 from amquery.utils.config import save_config, get_biom_path
-from amquery.core.distance import distances, DEFAULT_DISTANCE
-from amquery.core import Index
+from amquery.core.distance import distances, matrix_distances, DEFAULT_DISTANCE, KMER_DISTANCES
+from amquery.utils.ui import cache_stats, search_stats
+from amquery.core import Index, SampleMap
+from amquery.core.sample import KmerIndexCache
+from amquery.core.storage import VpTree
 from shutil import copyfile
 
 
@@ -16,8 +19,10 @@ CONTEXT_SETTINGS = dict(help_option_names=['-h', '--help'])
 @click.option('--force', '-f', is_flag=True, help='Force overwrite output directory')
 @click.option('--quiet', '-q', is_flag=True, help='Be quiet')
 @click.option('--jobs', '-j', type=int, default=1, help='Number of jobs to start in parallel')
-def cli(force, quiet, jobs):
+@click.pass_context
+def cli(ctx, force, quiet, jobs):
     Pool.instance(jobs=jobs)
+    ctx.obj = dict(jobs=jobs, quiet=quiet)
 
 
 @cli.command()
@@ -26,7 +31,20 @@ def cli(force, quiet, jobs):
 @click.option("--rep_set", type=click.Path())
 @click.option("--biom_table", type=click.Path())
 @click.option("--kmer_size", "-k", type=int, default=15)
-def init(method, rep_tree, rep_set, biom_table, kmer_size):
+@click.option("--dereplicate/--no_dereplicate", default=True,
+              help='Collapse identical reads before k-mer counting')
+@click.option("--kmer_memory_budget", type=int, default=0,
+              help='Memory budget for k-mer counting of a sample, in MB. K-mer counts are spilled '
+                   'to the temporary directory beyond it. 0 means unlimited')
+@click.option("--profile_cache_size", type=int, default=1024,
+              help='Size limit of the k-mer profile cache, in MB. 0 disables the cache')
+@click.option("--profile_memory_budget", type=int, default=2048,
+              help='Memory budget for the k-mer profiles kept in memory, in MB. 0 means unlimited')
+@click.option("--compact_profiles/--wide_profiles", default=False,
+              help='Keep k-mer profiles as uint32 counts with delta-encoded columns')
+@click.pass_obj
+def init(options, method, rep_tree, rep_set, biom_table, kmer_size, dereplicate, kmer_memory_budget,
+         profile_cache_size, profile_memory_budget, compact_profiles):
     index_dir = os.path.join(os.getcwd(), '.amq')
     iof.make_sure_exists(index_dir)
     index_path = os.path.join(index_dir, 'config')
@@ -44,17 +62,25 @@ def init(method, rep_tree, rep_set, biom_table, kmer_size):
         config.set('distance', 'biom_table', get_biom_path())
     if kmer_size:
         config.set('distance', 'kmer_size', str(kmer_size))
+    config.set('distance', 'dereplicate', str(dereplicate))
+    config.set('distance', 'kmer_memory_budget', str(kmer_memory_budget))
+    config.set('distance', 'profile_cache_size', str(profile_cache_size))
+    config.set('distance', 'profile_memory_budget', str(profile_memory_budget))
+    config.set('distance', 'compact_profiles', str(compact_profiles))
 
-    index = Index.init(config)
+    index = Index.init(config, options['jobs'])
     index.save()
     save_config(config)
 
 @cli.command()
 @click.argument('input_files', type=click.Path(exists=True), nargs=-1, required=True)
-def build(input_files):
-    index, config = Index.load()
+@click.pass_obj
+def build(options, input_files):
+    index, config = Index.load(options['jobs'])
     index.build(config, input_files)
     index.save()
+    if not options['quiet'] and config.get('distance', 'method') in KMER_DISTANCES:
+        cache_stats("K-mer profile cache", KmerIndexCache.instance().stats)
 
 
 @cli.command()
@@ -67,22 +93,24 @@ def refine(kmer_size, distance):
 @cli.command()
 @click.argument('input_files', type=click.Path(exists=True), nargs=-1, required=True)
 @click.option("--biom_table", type=click.Path())
-def add(input_files, biom_table):
+@click.pass_obj
+def add(options, input_files, biom_table):
 
-    index, config = Index.load()
+    index, config = Index.load(options['jobs'])
+    # the table of a former add is merged already
+    config.remove_option('additional', 'biom_table')
 
-    if biom_table:
-        config.set('additional', 'biom_table', str(biom_table))
-
-    index.add(config, input_files)
+    index.add(config, input_files, str(biom_table) if biom_table else None)
     index.save()
     save_config(config)
+    if not options['quiet'] and config.get('distance', 'method') in KMER_DISTANCES:
+        cache_stats("K-mer profile cache", KmerIndexCache.instance().stats)
 
 
 @cli.command()
 def stats():
-    index, config = Index.load()
-    indexed = len(index)
+    # answered from the sample manifest, without loading the whole index
+    indexed = len(SampleMap.load())
 
     click.secho("Indexed: ", bold=True, nl=False)
     click.secho("%s samples" % indexed)
@@ -90,20 +118,67 @@ def stats():
 
 @cli.command()
 def ls():
-    index, config = Index.load()
+    sample_map = SampleMap.load()
 
     click.secho("Indexed", bold=True)
-    sample_names = sorted(list(sample.name for sample in index.samples))
+    sample_names = sorted(sample_map.labels)
     for name in sample_names:
         click.secho("%s" % name, fg='blue')
 
 
+@cli.command()
+@click.argument('output_file', type=click.Path(), required=True)
+@click.option('--upper', is_flag=True, help='Compute only the upper triangle of the matrix')
+@click.option('--method', type=click.Choice(matrix_distances.keys()), default=None,
+              help='A distance of the matrix, the one of the index by default')
+@click.pass_obj
+def matrix(options, output_file, upper, method):
+    index, config = Index.load(options['jobs'])
+    try:
+        names = index.matrix(config, output_file, upper, method)
+    except ValueError as e:
+        raise click.BadParameter(str(e), param_hint='--method')
+
+    labels_file = output_file + '.labels'
+    with open(labels_file, 'w') as f:
+        f.write('\n'.join(names) + '\n')
+
+    click.secho("Distance matrix: ", bold=True, nl=False)
+    click.secho("%s (%d x %d, float64 .npy), sample labels: %s" %
+                (output_file, len(names), len(names), labels_file))
+
+
+@cli.command()
+@click.argument('output_file', type=click.Path(), required=True)
+def export_storage(output_file):
+    storage = VpTree.load()
+    storage.export_json(output_file)
+
+    click.secho("VP-tree: ", bold=True, nl=False)
+    click.secho("%s (%d samples, JSON)" % (output_file, len(storage)))
+
+
+@cli.command()
+@click.argument('input_file', type=click.Path(exists=True), required=True)
+def import_storage(input_file):
+    storage = VpTree.import_json(input_file)
+    storage.save()
+
+    click.secho("VP-tree: ", bold=True, nl=False)
+    click.secho("%d samples imported from %s" % (len(storage), input_file))
+
+
 @cli.command()
 @click.argument('sample_name', type=str, required=True)
 @click.option('-k', type=int, required=True, help='Count of nearest neighbors')
-def find(sample_name, k):
-    index, config = Index.load();
+@click.pass_obj
+def find(options, sample_name, k):
+    index, config = Index.load(options['jobs'])
     values, points = index.find(sample_name, k)
+    if not options['quiet']:
+        if config.get('distance', 'method') in KMER_DISTANCES:
+            cache_stats("K-mer profile cache", KmerIndexCache.instance().stats)
+        search_stats("VP-tree search", index.storage.stats)
     click.secho("%s nearest neighbors:" % k, bold=True)
     click.secho('\t'.join(x for x in ['Hash', 'Sample', 'Similarity']), bold=True)
 
@@ -1,7 +1,13 @@
 from ._pairwise_distance import PairwiseDistance, SamplePairwiseDistance
+from ._distance_cache import DistanceCache
+from ._distance_matrix import distance_matrix
 from .metrics import distances, \
+    matrix_distances, \
     FFP_JSD, \
     WEIGHTED_UNIFRAC, \
+    ANGULAR, \
+    BRAY_CURTIS, \
+    KMER_DISTANCES, \
     DEFAULT_DISTANCE
 
 
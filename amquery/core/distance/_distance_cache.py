@@ -0,0 +1,289 @@
+import os
+import numpy as np
+import pandas as pd
+from amquery.utils.iof import append_lines, make_sure_exists, read_lines
+
+
+_NAMES_FILE = 'names'
+_ENTRIES_FILE = 'entries'
+_SORTED_FILE = 'entries.sorted'
+_ENTRY_DTYPE = np.dtype([('i', '<u4'), ('j', '<u4'), ('value', '<f4')])
+_SORTED_DTYPE = np.dtype([('key', '<u8'), ('value', '<f4')])
+
+
+def _read_records(filename, dtype):
+    """
+    :param filename: str
+    :param dtype: np.dtype
+    :return: np.memmap of the complete records
+    """
+    size = os.path.getsize(filename) // dtype.itemsize if os.path.exists(filename) else 0
+    if size == 0:
+        return np.array([], dtype=dtype)
+    return np.memmap(filename, dtype=dtype, mode='r', shape=(size,))
+
+
+def _keys(i, j):
+    """
+    :param i: Union[int, np.array]
+    :param j: Union[int, np.array]
+    :return: Union[int, np.array] of uint64, the same key for (i, j) and (j, i)
+    """
+    i = np.asarray(i, dtype=np.uint64)
+    j = np.asarray(j, dtype=np.uint64)
+    return (np.minimum(i, j) << np.uint64(32)) | np.maximum(i, j)
+
+
+class DistanceCache:
+    """
+    Symmetric cache of pairwise distances between named samples.
+    Samples get consecutive integer ids; a distance is kept under the key
+    of the unordered pair of ids, so the memory is proportional to the
+    number of the known distances, not to the squared number of samples.
+    Unknown distances are NaN.
+
+    On the disk the cache is a names file with one sample per line in the
+    id order, a compacted file of (key, float32) records sorted by the key
+    and an append-only log of (i, j, float32) records. Saving appends the
+    distances added since the previous save to the log; once the log grows
+    large enough it is merged into the sorted file. Loading maps the files
+    only: the sorted records are looked up by binary search, and the log is
+    indexed on the first lookup
+    """
+    # the log is compacted when it has more records than this
+    # and than a _COMPACT_RATIO share of the sorted ones
+    _COMPACT_SIZE = 1 << 16
+    _COMPACT_RATIO = 0.25
+
+    def __init__(self, names=(), values=None):
+        """
+        :param names: Sequence[str]
+        :param values: np.ndarray, (len(names), len(names)) distances, NaN for unknown
+        """
+        self._names = []
+        self._ids = {}
+        # distances of the log and the ones set since the load
+        self._known = {}
+        self._pending = {}
+        self._sorted = np.array([], dtype=_SORTED_DTYPE)
+        self._log_file = None
+
+        for name in names:
+            self.add(name)
+
+        if values is not None:
+            i, j = np.nonzero(np.triu(~np.isnan(values)))
+            for i_, j_ in zip(i, j):
+                self.set(i_, j_, values[i_, j_])
+
+    def __len__(self):
+        return len(self._names)
+
+    def __contains__(self, name):
+        return name in self._ids
+
+    def add(self, name):
+        """
+        :param name: str
+        :return: int, id of the sample
+        """
+        if name in self._ids:
+            return self._ids[name]
+
+        self._ids[name] = len(self._names)
+        self._names.append(name)
+        return self._ids[name]
+
+    def id(self, name):
+        """
+        :param name: str
+        :return: int
+        """
+        return self._ids[name]
+
+    def ids(self, names):
+        """
+        :param names: Sequence[str]
+        :return: np.array of int
+        """
+        return np.fromiter((self._ids[name] for name in names), dtype=np.int64, count=len(names))
+
+    def _index_log(self):
+        """
+        Read the log of the loaded cache into the known distances
+        :return: None
+        """
+        if self._log_file is None:
+            return
+
+        entries = _read_records(self._log_file, _ENTRY_DTYPE)
+        self._log_file = None
+        known = self._known
+        self._known = dict(zip(_keys(entries['i'], entries['j']).tolist(), entries['value'].tolist()))
+        self._known.update(known)
+
+    def _lookup_sorted(self, keys):
+        """
+        :param keys: np.array of uint64
+        :return: np.array of float64, NaN for the missing keys
+        """
+        result = np.full(len(keys), np.nan)
+        sorted_keys = self._sorted['key']
+        if len(sorted_keys) == 0:
+            return result
+
+        positions = np.minimum(np.searchsorted(sorted_keys, keys), len(sorted_keys) - 1)
+        found = sorted_keys[positions] == keys
+        result[found] = self._sorted['value'][positions[found]]
+        return result
+
+    def get(self, i, j):
+        """
+        :param i: int
+        :param j: int
+        :return: float, NaN if the distance is unknown
+        """
+        return float(self.get_many(i, np.array([j]))[0])
+
+    def get_many(self, i, js):
+        """
+        :param i: int
+        :param js: np.array of int
+        :return: np.array of float64
+        """
+        self._index_log()
+        keys = _keys(i, js)
+        values = np.fromiter((self._known.get(key, np.nan) for key in keys.tolist()),
+                             dtype=np.float64, count=len(keys))
+        missing = np.isnan(values)
+        if missing.any():
+            values[missing] = self._lookup_sorted(keys[missing])
+        return values
+
+    def set(self, i, j, value):
+        self.set_many(i, np.array([j]), np.array([value]))
+
+    def set_many(self, i, js, values):
+        # stored as float32, the way they are saved
+        values = np.asarray(values, dtype=np.float32).tolist()
+        for key, value in zip(_keys(i, js).tolist(), values):
+            self._known[key] = value
+            self._pending[key] = value
+
+    def _pending_entries(self):
+        """
+        :return: np.array of _ENTRY_DTYPE
+        """
+        keys = np.fromiter(self._pending.keys(), dtype=np.uint64, count=len(self._pending))
+        entries = np.empty(len(keys), dtype=_ENTRY_DTYPE)
+        entries['i'] = keys >> np.uint64(32)
+        entries['j'] = keys & np.uint64(0xffffffff)
+        entries['value'] = np.fromiter(self._pending.values(), dtype=np.float32, count=len(keys))
+        return entries
+
+    def save(self, path):
+        """
+        Append the samples and the distances added since the last save,
+        compact the log if it is large
+        :param path: str, directory of the cache
+        :return: None
+        """
+        make_sure_exists(path)
+        names_file = os.path.join(path, _NAMES_FILE)
+        entries_file = os.path.join(path, _ENTRIES_FILE)
+
+        # an interrupted save may leave a partial record or line behind
+        append_lines(names_file, self._names[len(read_lines(names_file)):])
+
+        entries = self._pending_entries()
+        with open(entries_file, 'ab') as f:
+            size = f.seek(0, os.SEEK_END)
+            size -= size % _ENTRY_DTYPE.itemsize
+            f.truncate(size)
+            f.write(entries.tobytes())
+
+        self._pending = {}
+        log_size = size // _ENTRY_DTYPE.itemsize + len(entries)
+        if log_size > max(self._COMPACT_SIZE, self._COMPACT_RATIO * len(self._sorted)):
+            self.compact(path)
+
+    def compact(self, path):
+        """
+        Merge the log into the sorted records of the saved cache
+        :param path: str, directory of the cache
+        :return: None
+        """
+        sorted_file = os.path.join(path, _SORTED_FILE)
+        entries_file = os.path.join(path, _ENTRIES_FILE)
+        entries = _read_records(entries_file, _ENTRY_DTYPE)
+        saved = _read_records(sorted_file, _SORTED_DTYPE)
+
+        keys = np.concatenate([saved['key'], _keys(entries['i'], entries['j'])])
+        values = np.concatenate([saved['value'], entries['value']])
+        # the last record of a key wins
+        keys, first = np.unique(keys[::-1], return_index=True)
+        records = np.empty(len(keys), dtype=_SORTED_DTYPE)
+        records['key'] = keys
+        records['value'] = values[::-1][first]
+
+        # the sorted file is replaced first, a crash before the log is
+        # truncated only leaves records that are in both of them
+        tmp_file = sorted_file + '.tmp'
+        records.tofile(tmp_file)
+        os.replace(tmp_file, sorted_file)
+        with open(entries_file, 'ab') as f:
+            f.truncate(0)
+
+        self._sorted = _read_records(sorted_file, _SORTED_DTYPE)
+
+    @staticmethod
+    def load(path):
+        """
+        :param path: str, directory of the cache
+        :return: DistanceCache, the distances are read on demand
+        """
+        cache = DistanceCache(read_lines(os.path.join(path, _NAMES_FILE)))
+        cache._sorted = _read_records(os.path.join(path, _SORTED_FILE), _SORTED_DTYPE)
+        cache._log_file = os.path.join(path, _ENTRIES_FILE)
+        return cache
+
+    @property
+    def names(self):
+        return self._names
+
+    @property
+    def matrix(self):
+        """
+        :return: np.ndarray, a dense copy of the distances for export
+        """
+        self._index_log()
+        n = len(self._names)
+        result = np.full((n, n), np.nan, dtype=np.float32)
+
+        keys = np.concatenate([self._sorted['key'],
+                               np.fromiter(self._known.keys(), dtype=np.uint64, count=len(self._known))])
+        values = np.concatenate([self._sorted['value'],
+                                 np.fromiter(self._known.values(), dtype=np.float32, count=len(self._known))])
+        i = (keys >> np.uint64(32)).astype(np.int64)
+        j = (keys & np.uint64(0xffffffff)).astype(np.int64)
+        known = (i < n) & (j < n)
+        result[i[known], j[known]] = values[known]
+        result[j[known], i[known]] = values[known]
+        return result
+
+    @property
+    def dataframe(self):
+        """
+        :return: pd.DataFrame, a copy of the distances for export
+        """
+        return pd.DataFrame(self.matrix, index=self._names, columns=self._names)
+
+    @staticmethod
+    def from_dataframe(dataframe):
+        """
+        :param dataframe: pd.DataFrame
+        :return: DistanceCache
+        """
+        names = list(dataframe.columns)
+        values = dataframe.reindex(index=names, columns=names).values
+        return DistanceCache(names, values)
@@ -0,0 +1,85 @@
+import numpy as np
+import multiprocessing as mp
+from typing import List
+from amquery.utils.benchmarking import measure_time
+from amquery.utils.multiprocess import Pool
+from amquery.utils.ui import progress_bar
+
+
+class TileFunction:
+    def __init__(self, distance_function, output_file: str, upper: bool, queue: mp.Queue):
+        """
+        :param distance_function: SamplePairwiseDistanceFunction
+        :param output_file: str
+        :param upper: bool
+        :param queue: mp.Queue
+        """
+        self.distance_function = distance_function
+        self.output_file = output_file
+        self.upper = upper
+        self.queue = queue
+
+    def __call__(self, tile):
+        """
+        Compute a tile of the matrix and write it right into the memory-mapped output
+        :param tile: Tuple[int, Sequence[Sample], int, Sequence[Sample]]
+        :return: None
+        """
+        row, row_samples, col, col_samples = tile
+        if row == col:
+            values = self._diagonal(row_samples)
+        else:
+            values = self.distance_function.tile(row_samples, col_samples)
+        values[np.isnan(values)] = 0.0
+
+        matrix = np.load(self.output_file, mmap_mode='r+')
+        row_end, col_end = row + len(row_samples), col + len(col_samples)
+        matrix[row:row_end, col:col_end] = values
+        if row != col and not self.upper:
+            matrix[col:col_end, row:row_end] = values.T
+        matrix.flush()
+
+        self.queue.put(1)
+
+    def _diagonal(self, samples):
+        """
+        A tile on the diagonal of the matrix, every pair is computed once
+        :param samples: Sequence[Sample]
+        :return: np.ndarray, the upper triangle, mirrored unless only it is required
+        """
+        values = np.zeros((len(samples), len(samples)), dtype=np.float64)
+        for i, sample in enumerate(samples):
+            values[i, i:] = self.distance_function.batch(sample, samples[i:])
+
+        if not self.upper:
+            values += np.triu(values, 1).T
+        return values
+
+
+@measure_time(enabled=True)
+def distance_matrix(distance_function, samples: List, output_file: str, upper: bool=False,
+                    tile_size: int=256):
+    """
+    Compute the all-vs-all distance matrix by square tiles spread across the pool.
+    The matrix is stored as a .npy file, so it can be opened with np.load(mmap_mode='r')
+    :param distance_function: SamplePairwiseDistanceFunction
+    :param samples: Sequence[Sample]
+    :param output_file: str
+    :param upper: bool, compute only the upper triangle, the rest is zero
+    :param tile_size: int
+    :return: None
+    """
+    n = len(samples)
+    matrix = np.lib.format.open_memmap(output_file, mode='w+', dtype=np.float64, shape=(n, n))
+    del matrix
+
+    tiles = [(row, samples[row:row + tile_size], col, samples[col:col + tile_size])
+             for row in range(0, n, tile_size)
+             for col in range(row, n, tile_size)]
+
+    packed_task = TileFunction(distance_function, output_file, upper, Pool.instance().queue)
+    result = Pool.instance().map_async(packed_task, tiles)
+    progress_bar(result, Pool.instance().queue, len(tiles), 'Computing distances:')
+
+    result.get()
+    Pool.instance().clear()
@@ -3,9 +3,10 @@ import abc
 import numpy as np
 import pandas as pd
 from amquery.core.distance.metrics import distances
+from ._distance_cache import DistanceCache
 from amquery.core.sample import Sample
 from amquery.core.sample_map import SampleMap
-from amquery.utils.config import get_distance_path
+from amquery.utils.config import get_distance_path, get_distances_dir
 
 
 class PairwiseDistance:
@@ -21,13 +22,17 @@ class PairwiseDistance:
 
 
 class SamplePairwiseDistance(PairwiseDistance):
-    def __init__(self, distance_function, dataframe=pd.DataFrame(), sample_map=SampleMap()):
+    def __init__(self, distance_function, cache=None, sample_map=None):
         """
         :param distance_function: amquery.core.metrics.SamplePairwiseDistanceFunction
+        :param cache: DistanceCache
+        :param sample_map: SampleMap
         """
         self._distance_function = distance_function
-        self._dataframe = dataframe
-        self._sample_map = sample_map
+        self._cache = cache if cache is not None else DistanceCache()
+        self._sample_map = sample_map if sample_map is not None else SampleMap()
+        # calls of the distance function, the cached distances are not counted
+        self.evaluations = 0
 
     @staticmethod
     def load(config):
@@ -35,33 +40,52 @@ class SamplePairwiseDistance(PairwiseDistance):
         :param config: Config 
         :return: SamplePairwiseDistance
         """
+        if os.path.exists(get_distances_dir()):
+            cache = DistanceCache.load(get_distances_dir())
+        else:
+            cache = SamplePairwiseDistance._load_text()
+
+        sample_map = SampleMap.load()
+        method = config.get('distance', 'method')
+        return SamplePairwiseDistance(distances[method](config), cache=cache, sample_map=sample_map)
+
+    @staticmethod
+    def _load_text():
+        """
+        Read the distances of an index saved in the former text format,
+        they are converted to the binary one on the next save
+        :return: DistanceCache
+        """
         if os.path.exists(get_distance_path()):
             try:
                 dataframe = pd.read_csv(get_distance_path(), sep='\t')
-                dataframe['id'] = dataframe.keys()
-                dataframe = dataframe.set_index('id')
+                # the table is exported without the index, its rows are in the order of its columns
+                dataframe.index = dataframe.columns
+                return DistanceCache.from_dataframe(dataframe)
             except ValueError:
-                dataframe = pd.DataFrame()
-        else:
-            dataframe = pd.DataFrame()
+                pass
 
-        sample_map = SampleMap.load()
-        method = config.get('distance', 'method')
-        return SamplePairwiseDistance(distances[method](config), dataframe=dataframe, sample_map=sample_map)
+        return DistanceCache()
 
     def save(self):
-        self._dataframe.to_csv(get_distance_path(), sep='\t', na_rep="N/A", index=False)
+        self._cache.save(get_distances_dir())
         self._sample_map.save()
 
+    def export(self, output_file):
+        """
+        Write the cached distances as a tab-separated table
+        :param output_file: str
+        :return: None
+        """
+        self.dataframe.to_csv(output_file, sep='\t', na_rep="N/A", index=False)
+
     def add_sample(self, sample):
         """
         :param sample: Sample
         :return: None
         """
-        if sample.name not in self.labels:
-            init_values = [np.nan for x in range(len(self._dataframe))]
-            self._dataframe[sample.name] = pd.Series(init_values, index=self.dataframe.index)
-            self._dataframe.loc[sample.name] = init_values + [np.nan]
+        if sample.name not in self._cache:
+            self._cache.add(sample.name)
             self._sample_map[sample.name] = sample
 
     def add_samples(self, samples):
@@ -72,25 +96,84 @@ class SamplePairwiseDistance(PairwiseDistance):
         for sample in samples:
             self.add_sample(sample)
 
-    def __getitem__(self, pair):
-        a, b = pair
-        if isinstance(a, np.str) and self._sample_map:
-            a = self._sample_map[a]
-        if isinstance(b, np.str) and self._sample_map:
-            b = self._sample_map[b]
+    def _sample(self, x):
+        """
+        :param x: Union[str, Sample]
+        :return: Sample
+        """
+        if isinstance(x, np.str) and self._sample_map:
+            x = self._sample_map[x]
+
+        assert isinstance(x, Sample)
+        if x.name not in self._cache:
+            self.add_sample(x)
 
-        assert isinstance(a, Sample)
-        assert isinstance(b, Sample)
+        return x
 
-        for x in [a, b]:
-            if x.name not in self.labels:
-                self.add_sample(x)
+    def one_to_many(self, a, bs):
+        """
+        Distances from one sample to many, the missing ones are computed in a single batch
+        :param a: Union[str, Sample]
+        :param bs: Sequence[Union[str, Sample]]
+        :return: np.array
+        """
+        a = self._sample(a)
+        bs = [self._sample(b) for b in bs]
+
+        i = self._cache.id(a.name)
+        js = self._cache.ids([b.name for b in bs])
+        values = self._cache.get_many(i, js)
+        missing = np.flatnonzero(np.isnan(values))
+        if len(missing) > 0:
+            computed = self._distance_function.batch(a, [bs[k] for k in missing])
+            self.evaluations += len(missing)
+            computed[np.isnan(computed)] = 0.0
+            self._cache.set_many(i, js[missing], computed)
+            values[missing] = self._cache.get_many(i, js[missing])
+
+        return values
 
-        if np.isnan(self.dataframe[a.name][b.name]):
+    def __getitem__(self, pair):
+        a, b = pair
+        a = self._sample(a)
+        b = self._sample(b)
+
+        i = self._cache.id(a.name)
+        j = self._cache.id(b.name)
+        value = self._cache.get(i, j)
+        if np.isnan(value):
             value = self._distance_function(a, b)
-            self._dataframe[a.name][b.name] = value if not np.isnan(value) else 0.0
+            self.evaluations += 1
+            self._cache.set(i, j, value if not np.isnan(value) else 0.0)
+            value = self._cache.get(i, j)
 
-        return self.dataframe[a.name][b.name]
+        return value
+
+    def bounded(self, a, b, threshold):
+        """
+        Distance that may be computed only until it is known to exceed the threshold.
+        Such lower bounds are not cached
+        :param a: Union[str, Sample]
+        :param b: Union[str, Sample]
+        :param threshold: float
+        :return: float, exact if not greater than the threshold, otherwise a lower bound greater than it
+        """
+        a = self._sample(a)
+        b = self._sample(b)
+
+        i = self._cache.id(a.name)
+        j = self._cache.id(b.name)
+        value = self._cache.get(i, j)
+        if np.isnan(value):
+            value = self._distance_function.bounded(a, b, threshold)
+            self.evaluations += 1
+            if np.isnan(value):
+                value = 0.0
+            if value <= threshold:
+                self._cache.set(i, j, value)
+                value = self._cache.get(i, j)
+
+        return value
 
     def __call__(self, a, b):
         """
@@ -101,18 +184,29 @@ class SamplePairwiseDistance(PairwiseDistance):
         return self[(a, b)]
 
 
+    @property
+    def distance_function(self):
+        return self._distance_function
+
     @property
     def labels(self):
-        return self._dataframe.columns
+        return self._cache.names
 
     @property
     def sample_map(self):
         return self._sample_map
 
+    @property
+    def cache(self):
+        return self._cache
+
     @property
     def dataframe(self):
-        return self._dataframe
+        """
+        :return: pd.DataFrame, exported copy of the cached distances
+        """
+        return self._cache.dataframe
 
     @property
     def matrix(self):
-        return self._dataframe.as_matrix()
\ No newline at end of file
+        return self._cache.matrix
@@ -1,6 +1,17 @@
 from amquery.core.distance import SamplePairwiseDistance, distances, WEIGHTED_UNIFRAC
 
 
+def _check_method(config):
+    """
+    :param config: Config
+    :return: str, the distance method of the index
+    """
+    method = config.get('distance', 'method')
+    if method not in distances:
+        raise ValueError("%s is not a metric and can not be used for an index" % method)
+    return method
+
+
 class Factory:
     @staticmethod
     def create(config):
@@ -8,7 +19,7 @@ class Factory:
         :param config: Config
         :return: PairwiseDistance 
         """
-        method = config.get('distance', 'method')
+        method = _check_method(config)
         return SamplePairwiseDistance(distances[method](config))
 
     @staticmethod
@@ -17,4 +28,5 @@ class Factory:
         :param config: Config
         :return: PairWiseDistance 
         """
+        _check_method(config)
         return SamplePairwiseDistance.load(config)
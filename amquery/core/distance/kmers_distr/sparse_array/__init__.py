@@ -1,4 +1,4 @@
-from ._sparse_array import SparseArray
+from ._sparse_array import SparseArray, CompactSparseArray, entropy_terms
 
 
 __license__ = "MIT"
@@ -1,9 +1,120 @@
 import numpy as np
 
+
+def entropy_terms(data: np.array):
+    """
+    :param data: np.array of frequencies
+    :return: np.array of -p * log2(p), zero for p = 0
+    """
+    data = np.asarray(data, dtype=np.float64)
+    result = np.zeros(len(data), dtype=np.float64)
+    positive = data > 0
+    result[positive] = -data[positive] * np.log2(data[positive])
+    return result
+
+
+def _resident_nbytes(*arrays):
+    """
+    :param arrays: Sequence[Optional[np.array]]
+    :return: int, bytes of the arrays held in memory, views of memory-mapped files take none
+    """
+    return sum(x.nbytes for x in arrays if x is not None and not isinstance(x, np.memmap))
+
+
 class SparseArray:
-    def __init__(self, cols: np.array, data: np.array):
+    def __init__(self, cols: np.array, data: np.array, entropy: np.array=None, mass: float=None):
+        """
+        :param cols: np.array of k-mer ranks
+        :param data: np.array of k-mer frequencies
+        :param entropy: np.array of -p * log2(p) for every frequency, computed if not given
+        :param mass: float, sum of the frequencies, computed if not given
+        """
         self.cols = cols
         self.data = data
+        self._entropy = entropy
+        self._mass = mass
 
     def __len__(self):
         return len(self.cols)
+
+    @property
+    def entropy(self):
+        # profiles pickled before the entropy terms were added lack the attribute
+        if getattr(self, '_entropy', None) is None:
+            self._entropy = entropy_terms(self.data)
+        return self._entropy
+
+    @property
+    def mass(self):
+        if getattr(self, '_mass', None) is None:
+            self._mass = float(np.sum(self.data))
+        return self._mass
+
+    @property
+    def nbytes(self):
+        return self.cols.nbytes + self.data.nbytes + self.entropy.nbytes
+
+    @property
+    def resident_nbytes(self):
+        return _resident_nbytes(self.cols, self.data, getattr(self, '_entropy', None))
+
+
+_UINT32_MAX = np.iinfo(np.uint32).max
+
+
+class CompactSparseArray:
+    """
+    K-mer profile of raw uint32 counts with delta-encoded uint32 columns:
+    deltas[0] is the first column, deltas[i] = cols[i] - cols[i - 1].
+    It takes 8 bytes per k-mer instead of 24 of a SparseArray with its
+    entropy terms; the frequencies are counts / total
+    """
+    def __init__(self, deltas: np.array, counts: np.array, total: int):
+        """
+        :param deltas: np.array of uint32
+        :param counts: np.array of uint32
+        :param total: int, sum of the counts
+        """
+        self.deltas = deltas
+        self.counts = counts
+        self.total = total
+
+    def __len__(self):
+        return len(self.deltas)
+
+    @staticmethod
+    def from_counts(cols: np.array, counts: np.array):
+        """
+        :param cols: np.array of sorted k-mer ranks
+        :param counts: np.array of k-mer counts
+        :return: Optional[CompactSparseArray], None if the profile does not fit 32-bit values
+        """
+        deltas = np.diff(cols, prepend=np.uint64(0)) if len(cols) else np.array([], dtype=np.uint64)
+        if len(cols) and (deltas.max() > _UINT32_MAX or counts.max() > _UINT32_MAX):
+            return None
+
+        return CompactSparseArray(deltas.astype(np.uint32), counts.astype(np.uint32), int(np.sum(counts)))
+
+    @property
+    def cols(self):
+        return np.cumsum(self.deltas, dtype=np.uint64)
+
+    @property
+    def data(self):
+        return self.counts / float(self.total)
+
+    @property
+    def entropy(self):
+        return entropy_terms(self.data)
+
+    @property
+    def mass(self):
+        return 1.0
+
+    @property
+    def nbytes(self):
+        return self.deltas.nbytes + self.counts.nbytes
+
+    @property
+    def resident_nbytes(self):
+        return _resident_nbytes(self.deltas, self.counts)
@@ -1,10 +1,17 @@
 from ._metrics import distances, \
+    matrix_distances, \
     Ffp_JSD, \
     FFP_JSD, \
     WEIGHTED_UNIFRAC, \
     WeightedUnifrac, \
+    ANGULAR, \
+    Angular, \
+    BRAY_CURTIS, \
+    BrayCurtis, \
+    KMER_DISTANCES, \
     DEFAULT_DISTANCE, \
     SamplePairwiseDistanceFunction
+from ._unifrac import UnifracCache
 
 __license__ = "MIT"
 __version__ = "0.2.1"
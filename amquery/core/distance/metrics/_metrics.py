@@ -1,18 +1,30 @@
 import os
 import abc
+import shutil
+import itertools
 import biom
 import numpy as np
 import amquery.utils.iof as iof
-from skbio import read
-from skbio.tree import TreeNode
-from skbio.diversity.beta import weighted_unifrac
-from ctypes import cdll, POINTER, c_uint64, c_size_t, c_double
+from scipy.sparse import csr_matrix, diags
+from ctypes import cdll, byref, POINTER, Structure, c_uint32, c_uint64, c_size_t, c_double, c_void_p
+from amquery.core.distance.kmers_distr.sparse_array import CompactSparseArray
+from amquery.utils.multiprocess import available_threads
+from amquery.utils.iof import make_sure_exists
+from amquery.utils.config import get_unifrac_dir, get_biom_additions_dir
+from ._unifrac import UnifracCache
 
 
 jsdlib = None
+# upper bound of the target profiles held for a single batch call, in bytes
+_BATCH_SIZE = 1 << 26
+# upper bound of the k-mer pairs of two profiles matched at once by a tile
+_PAIRS_BLOCK_SIZE = 1 << 22
 
 
 class SamplePairwiseDistanceFunction:
+    # threads a single native call may use, set by the owner of the function
+    threads = 1
+
     @abc.abstractmethod
     def __call__(self, a, b):
         """
@@ -22,6 +34,64 @@ class SamplePairwiseDistanceFunction:
         """
         raise NotImplementedError
 
+    def batch(self, a, samples):
+        """
+        :param a: Sample
+        :param samples: Sequence[Sample]
+        :return: np.array
+        """
+        return np.array([self(a, b) for b in samples], dtype=np.float64)
+
+    def tile(self, row_samples, col_samples):
+        """
+        :param row_samples: Sequence[Sample]
+        :param col_samples: Sequence[Sample]
+        :return: np.ndarray, (len(row_samples), len(col_samples)) distances
+        """
+        return np.array([self.batch(a, col_samples) for a in row_samples], dtype=np.float64)
+
+    def bounded(self, a, b, threshold):
+        """
+        Distance that may stop early once it is known to exceed the threshold
+        :param a: Sample
+        :param b: Sample
+        :param threshold: float
+        :return: float, exact if not greater than the threshold, otherwise a lower bound greater than it
+        """
+        return self(a, b)
+
+    def add_table(self, biom_fp):
+        """
+        Take the OTU table of the samples to be added. Distances that do not use it ignore it
+        :param biom_fp: str
+        :return: None
+        """
+        pass
+
+
+class _Profile(Structure):
+    """
+    profile_t of jsd.cpp
+    """
+    _fields_ = [('cols', c_void_p),
+                ('data', c_void_p),
+                ('entropy', c_void_p),
+                ('len', c_uint64),
+                ('mass', c_double),
+                ('compact', c_uint32)]
+
+
+def _profile(x):
+    """
+    Describe a profile for the native code without copying or widening its arrays
+    :param x: Union[SparseArray, CompactSparseArray]
+    :return: _Profile
+    """
+    if isinstance(x, CompactSparseArray):
+        return _Profile(x.deltas.ctypes.data, x.counts.ctypes.data, None, len(x), x.total, 1)
+    return _Profile(x.cols.ctypes.data, x.data.ctypes.data, x.entropy.ctypes.data, len(x), x.mass, 0)
+
+
 # Jenson-Shanon divergence
 class Ffp_JSD(SamplePairwiseDistanceFunction):
     def __init__(self, _):
@@ -30,11 +100,194 @@ class Ffp_JSD(SamplePairwiseDistanceFunction):
     def __call__(self, a, b):
         x = a.kmer_index
         y = b.kmer_index
-        xcols_p = x.cols.ctypes.data_as(POINTER(c_uint64))
-        xdata_p = x.data.ctypes.data_as(POINTER(c_double))
-        ycols_p = y.cols.ctypes.data_as(POINTER(c_uint64))
-        ydata_p = y.data.ctypes.data_as(POINTER(c_double))
-        return jsdlib.jsd(xcols_p, xdata_p, len(x), ycols_p, ydata_p, len(y))
+        return jsdlib.jsd(byref(_profile(x)), byref(_profile(y)))
+
+    def bounded(self, a, b, threshold):
+        """
+        :param a: Sample
+        :param b: Sample
+        :param threshold: float
+        :return: float, exact if not greater than the threshold, otherwise a lower bound greater than it
+        """
+        x = a.kmer_index
+        y = b.kmer_index
+        return jsdlib.jsd_bounded(byref(_profile(x)), byref(_profile(y)), threshold)
+
+    def batch(self, a, samples):
+        """
+        :param a: Sample
+        :param samples: Sequence[Sample]
+        :return: np.array
+        """
+        x = a.kmer_index
+        result = []
+        profiles = []
+        size = 0
+        for b in samples:
+            profiles.append(b.kmer_index)
+            size += profiles[-1].nbytes
+            if size >= _BATCH_SIZE:
+                result.append(self._batch(x, profiles))
+                profiles = []
+                size = 0
+
+        if profiles:
+            result.append(self._batch(x, profiles))
+
+        return np.concatenate(result) if result else np.array([], dtype=np.float64)
+
+    def _batch(self, x, profiles):
+        """
+        Compute the distances to the profiles in a single native call
+        :param x: Union[SparseArray, CompactSparseArray]
+        :param profiles: Sequence[Union[SparseArray, CompactSparseArray]]
+        :return: np.array
+        """
+        ys = (_Profile * len(profiles))(*[_profile(y) for y in profiles])
+        result = np.empty(len(profiles), dtype=np.float64)
+        jsdlib.jsd_batch(byref(_profile(x)), ys, len(profiles),
+                         result.ctypes.data_as(POINTER(c_double)),
+                         available_threads(self.threads))
+        return result
+
+
+def profile_matrix(profiles, columns):
+    """
+    :param profiles: Sequence[SparseArray]
+    :param columns: np.array, sorted k-mer ranks that are mapped to the matrix columns
+    :return: csr_matrix of the k-mer frequencies, a row per profile
+    """
+    lengths = np.array([len(x) for x in profiles], dtype=np.int64)
+    indptr = np.concatenate([[0], np.cumsum(lengths)])
+    cols = np.searchsorted(columns, np.concatenate([x.cols for x in profiles]))
+    data = np.concatenate([x.data for x in profiles]).astype(np.float64)
+    return csr_matrix((data, cols, indptr), shape=(len(profiles), len(columns)))
+
+
+def _normalize(x):
+    """
+    :param x: csr_matrix
+    :return: csr_matrix with the rows of unit L2 norm
+    """
+    norms = np.sqrt(np.asarray(x.multiply(x).sum(axis=1)).ravel())
+    norms[norms == 0] = 1.0
+    return diags(1.0 / norms) @ x
+
+
+def _sum_of_minimums(x, y):
+    """
+    Sum of the elementwise minimums of every row of x with every row of y.
+    Only the pairs of nonzero values of a column can have a nonzero minimum,
+    they are enumerated a column at a time and summed by their pair of rows
+    :param x: csc_matrix
+    :param y: csc_matrix, of the same columns
+    :return: np.ndarray, (x.shape[0], y.shape[0])
+    """
+    x_counts = np.diff(x.indptr)
+    y_counts = np.diff(y.indptr)
+    pair_counts = x_counts * y_counts
+    columns = np.flatnonzero(pair_counts)
+    # the blocks are made of whole columns, a column has at most x.shape[0] * y.shape[0] pairs
+    ends = np.cumsum(pair_counts[columns])
+    bounds = np.searchsorted(ends, np.arange(_PAIRS_BLOCK_SIZE, ends[-1], _PAIRS_BLOCK_SIZE)) + 1 \
+        if len(columns) else np.array([], dtype=np.int64)
+
+    result = np.zeros(x.shape[0] * y.shape[0], dtype=np.float64)
+    for block in np.split(columns, bounds):
+        if len(block) == 0:
+            continue
+        counts = pair_counts[block]
+        starts = np.cumsum(counts) - counts
+        column = np.repeat(np.arange(len(block)), counts)
+        offsets = np.arange(len(column)) - starts[column]
+        y_count = y_counts[block][column]
+        x_index = x.indptr[block][column] + offsets // y_count
+        y_index = y.indptr[block][column] + offsets % y_count
+
+        pairs = x.indices[x_index].astype(np.int64) * y.shape[0] + y.indices[y_index]
+        values = np.minimum(x.data[x_index], y.data[y_index])
+        result += np.bincount(pairs, weights=values, minlength=len(result))
+    return result.reshape(x.shape[0], y.shape[0])
+
+
+class SparseProfileDistance(SamplePairwiseDistanceFunction):
+    """
+    K-mer profile distance computed by sparse linear algebra over the
+    CSR matrices of the profiles, one-vs-many and tiles of all-vs-all
+    distances are evaluated at once
+    """
+    def __init__(self, _):
+        pass
+
+    def __call__(self, a, b):
+        x = a.kmer_index
+        y = b.kmer_index
+        x_data = np.asarray(x.data, dtype=np.float64)
+        y_data = np.asarray(y.data, dtype=np.float64)
+        # a single pair needs the shared k-mers only, no matrices
+        _, i, j = np.intersect1d(x.cols, y.cols, assume_unique=True, return_indices=True)
+        return self._pair(x_data, y_data, i, j)
+
+    def batch(self, a, samples):
+        return self.tile([a], samples)[0]
+
+    def tile(self, row_samples, col_samples):
+        if len(row_samples) == 0 or len(col_samples) == 0:
+            return np.empty((len(row_samples), len(col_samples)), dtype=np.float64)
+
+        xs = [sample.kmer_index for sample in row_samples]
+        ys = [sample.kmer_index for sample in col_samples]
+        # the k-mer space is far too wide for the matrices, only the present k-mers get columns
+        columns = np.unique(np.concatenate([x.cols for x in itertools.chain(xs, ys)]))
+        return self._tile(profile_matrix(xs, columns), profile_matrix(ys, columns))
+
+    @abc.abstractmethod
+    def _pair(self, x, y, i, j):
+        """
+        :param x: np.array, frequencies of a profile
+        :param y: np.array, frequencies of the other one
+        :param i: np.array, positions of the shared k-mers in x
+        :param j: np.array, positions of the shared k-mers in y
+        :return: float
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def _tile(self, x, y):
+        """
+        :param x: csr_matrix
+        :param y: csr_matrix
+        :return: np.ndarray, (x.shape[0], y.shape[0]) distances
+        """
+        raise NotImplementedError
+
+
+# Angle between the profiles, scaled to [0, 1]
+class Angular(SparseProfileDistance):
+    def _pair(self, x, y, i, j):
+        norms = np.linalg.norm(x) * np.linalg.norm(y)
+        similarity = np.dot(x[i], y[j]) / norms if norms > 0 else 0.0
+        return float(np.arccos(np.clip(similarity, 0.0, 1.0)) / (np.pi / 2))
+
+    def _tile(self, x, y):
+        x = _normalize(x)
+        y = _normalize(y)
+        similarity = np.clip((x @ y.T).toarray(), 0.0, 1.0)
+        return np.arccos(similarity) / (np.pi / 2)
+
+
+# Bray-Curtis dissimilarity, 1 - 2 * sum(min(x, y)) / (sum(x) + sum(y))
+class BrayCurtis(SparseProfileDistance):
+    def _pair(self, x, y, i, j):
+        common = np.sum(np.minimum(x[i], y[j]))
+        return float(np.clip(1.0 - 2.0 * common / (np.sum(x) + np.sum(y)), 0.0, 1.0))
+
+    def _tile(self, x, y):
+        x_sums = np.asarray(x.sum(axis=1)).ravel()
+        y_sums = np.asarray(y.sum(axis=1)).ravel()
+        common = _sum_of_minimums(x.tocsc(), y.tocsc())
+        # the rounding may take the distance of equal profiles below zero
+        return np.clip(1.0 - 2.0 * common / (x_sums[:, None] + y_sums[None, :]), 0.0, 1.0)
 
 
 class WeightedUnifrac(SamplePairwiseDistanceFunction):
@@ -44,17 +297,39 @@ class WeightedUnifrac(SamplePairwiseDistanceFunction):
 
         assert(biom_fp and tree_path)
 
-        self.otu_table = biom.load_table(biom_fp)
-        self.sample_names = self.otu_table.ids(axis="sample")
+        self.biom_fp = biom_fp
+        self.tree_path = tree_path
+        self.cache = UnifracCache.open(biom_fp, tree_path, get_unifrac_dir(), self.additions())
+        self.sample_names = self.cache.sample_names
+
+    @staticmethod
+    def additions():
+        """
+        :return: List[str], the tables added to the master one, in the order of addition
+        """
+        additions_dir = get_biom_additions_dir()
+        if not os.path.exists(additions_dir):
+            return []
+        return [os.path.join(additions_dir, name) for name in sorted(os.listdir(additions_dir))]
 
-        tree = read(tree_path, format="newick", into=TreeNode).root_at_midpoint()
-        self.tips = [tip.name for tip in tree.tips()]
+    def add_table(self, biom_fp):
+        """
+        Keep a copy of the table next to the master one and append its samples
+        to the cache. The master table is not rewritten; the cache is rebuilt
+        only if the table can not be appended
+        :param biom_fp: str
+        :return: None
+        """
+        additions = self.additions()
+        make_sure_exists(get_biom_additions_dir())
+        addition = os.path.join(get_biom_additions_dir(), '%06d.biom' % len(additions))
+        shutil.copyfile(biom_fp, addition)
 
-        ids = self.otu_table.ids(axis="observation")
-        self.id_mask = np.array([id_ in self.tips for id_ in ids], dtype=bool)
-        self.masked_ids = ids[self.id_mask]
-        tree = tree.shear(self.masked_ids)
-        self.tree_index = tree.to_array(nan_length_value=0.0)
+        if self.cache.can_append(biom.load_table(addition)):
+            self.cache.append(get_unifrac_dir(), addition)
+        else:
+            self.cache = UnifracCache.open(self.biom_fp, self.tree_path, get_unifrac_dir(), additions + [addition])
+        self.sample_names = self.cache.sample_names
 
     def __call__(self, a, b):
         """
@@ -62,15 +337,40 @@ class WeightedUnifrac(SamplePairwiseDistanceFunction):
         :param b: Sample
         :return: float
         """
-        s1 = self.otu_table.data(a.name)[self.id_mask]
-        s2 = self.otu_table.data(b.name)[self.id_mask]
-        return weighted_unifrac(s1, s2, self.masked_ids, self.tree_index, normalized=False)
+        return self.cache.distance(self.cache.sample_ids[a.name], self.cache.sample_ids[b.name])
+
+    def _ids(self, samples):
+        return np.array([self.cache.sample_ids[sample.name] for sample in samples], dtype=np.int64)
+
+    def batch(self, a, samples):
+        """
+        :param a: Sample
+        :param samples: Sequence[Sample]
+        :return: np.array
+        """
+        return self.cache.one_to_many(self.cache.sample_ids[a.name], self._ids(samples))
+
+    def tile(self, row_samples, col_samples):
+        """
+        :param row_samples: Sequence[Sample]
+        :param col_samples: Sequence[Sample]
+        :return: np.ndarray
+        """
+        return self.cache.many_to_many(self._ids(row_samples), self._ids(col_samples))
 
 
 FFP_JSD = 'ffp-jsd'
 WEIGHTED_UNIFRAC = 'weighted-unifrac'
+ANGULAR = 'angular'
+BRAY_CURTIS = 'bray-curtis'
 DEFAULT_DISTANCE = FFP_JSD
-distances = {FFP_JSD: Ffp_JSD, WEIGHTED_UNIFRAC: WeightedUnifrac}
+# metrics, that an index can be built on
+distances = {FFP_JSD: Ffp_JSD, WEIGHTED_UNIFRAC: WeightedUnifrac, ANGULAR: Angular}
+# Bray-Curtis breaks the triangle inequality the VP-tree pruning relies on,
+# so it only fills distance matrices
+matrix_distances = dict(distances, **{BRAY_CURTIS: BrayCurtis})
+# distances between the k-mer profiles of the samples
+KMER_DISTANCES = {FFP_JSD, ANGULAR, BRAY_CURTIS}
 
 
 if __name__ == "__main__":
@@ -78,6 +378,10 @@ if __name__ == "__main__":
 else:
     libdir = os.path.dirname(os.path.abspath(__file__))
     jsdlib = cdll.LoadLibrary(iof.find_lib(libdir, "jsd"))
-    jsdlib.jsd.argtypes = [POINTER(c_uint64), POINTER(c_double), c_size_t,
-                           POINTER(c_uint64), POINTER(c_double), c_size_t]
+    jsdlib.jsd.argtypes = [POINTER(_Profile), POINTER(_Profile)]
     jsdlib.jsd.restype = c_double
+    jsdlib.jsd_bounded.argtypes = [POINTER(_Profile), POINTER(_Profile), c_double]
+    jsdlib.jsd_bounded.restype = c_double
+    jsdlib.jsd_batch.argtypes = [POINTER(_Profile), POINTER(_Profile), c_size_t,
+                                 POINTER(c_double), c_size_t]
+    jsdlib.jsd_batch.restype = None
@@ -0,0 +1,353 @@
+import os
+import json
+import shutil
+import biom
+import numpy as np
+from skbio import read
+from skbio.tree import TreeNode
+from scipy.sparse import csr_matrix
+from amquery.utils.iof import append_lines, make_sure_exists, read_lines
+
+
+_SOURCE_FILE = 'source.json'
+_SAMPLES_FILE = 'samples'
+_OTUS_FILE = 'otus.json'
+_TIPS_FILE = 'tips.json'
+_LENGTHS_FILE = 'lengths.npy'
+_INDPTR_FILE = 'ancestors_indptr.npy'
+_INDICES_FILE = 'ancestors_indices.npy'
+_EMBEDDING_FILE = 'embedding'
+# bump it whenever the cached arrays change
+_CACHE_VERSION = 4
+
+
+def _signature(path):
+    """
+    :param path: str
+    :return: List, identifies the version of the file
+    """
+    return [os.path.abspath(path), os.path.getsize(path), os.stat(path).st_mtime_ns]
+
+
+def _source(biom_fp, tree_path, additions):
+    """
+    :param biom_fp: str
+    :param tree_path: str
+    :param additions: Sequence[str], tables added to the master one
+    :return: dict, identifies the versions of the input files
+    """
+    return {'biom_table': _signature(biom_fp),
+            'rep_tree': _signature(tree_path),
+            'additions': [_signature(path) for path in additions],
+            'version': _CACHE_VERSION}
+
+
+def _read_json(filename):
+    with open(filename) as f:
+        return json.load(f)
+
+
+def _write_json(filename, value):
+    with open(filename, 'w') as f:
+        json.dump(value, f)
+
+
+def _rows(filename, n_rows, n_cols):
+    """
+    :param filename: str, raw float64 binary file
+    :param n_rows: int
+    :param n_cols: int
+    :return: np.ndarray, (n_rows, n_cols) memory-mapped rows of the file
+    """
+    if n_rows * n_cols == 0:
+        return np.zeros((n_rows, n_cols), dtype=np.float64)
+    return np.memmap(filename, dtype=np.float64, mode='r', shape=(n_rows, n_cols))
+
+
+def _append_rows(filename, n_rows, rows):
+    """
+    :param filename: str, raw float64 binary file
+    :param n_rows: int, number of the rows committed before
+    :param rows: np.ndarray
+    :return: None
+    """
+    rows = np.ascontiguousarray(rows, dtype=np.float64)
+    with open(filename, 'ab') as f:
+        # drops the rows of an interrupted append
+        f.truncate(n_rows * rows.shape[1] * rows.itemsize)
+        rows.tofile(f)
+
+
+def _ancestors(tree_index, tips):
+    """
+    :param tree_index: dict, result of TreeNode.to_array
+    :param tips: np.array, node indices of the tips
+    :return: csr_matrix, (nodes, tips) with ones where the node is the tip or its ancestor
+    """
+    n_nodes = len(tree_index['length'])
+    parents = np.full(n_nodes, -1, dtype=np.int64)
+    for node, first, last in tree_index['child_index']:
+        parents[first:last + 1] = node
+
+    rows, cols = [], []
+    nodes = tips.copy()
+    tip_ids = np.arange(len(tips))
+    while len(nodes) > 0:
+        rows.append(nodes)
+        cols.append(tip_ids)
+        nodes = parents[nodes]
+        tip_ids = tip_ids[nodes >= 0]
+        nodes = nodes[nodes >= 0]
+
+    rows = np.concatenate(rows)
+    cols = np.concatenate(cols)
+    return csr_matrix((np.ones(len(rows)), (rows, cols)), shape=(n_nodes, len(tips)))
+
+
+def embed(counts, lengths, ancestors):
+    """
+    Weighted UniFrac embedding: the share of the sample counts under every
+    node times the length of its branch. The not normalized weighted UniFrac
+    of two samples is the L1 distance between their embeddings
+    :param counts: np.ndarray, (samples, OTUs) counts
+    :param lengths: np.array, branch length of every node
+    :param ancestors: csr_matrix, (nodes, OTUs) incidence of the OTU tips and their ancestors
+    :return: np.ndarray, (samples, nodes)
+    """
+    counts = np.atleast_2d(counts)
+    totals = counts.sum(axis=1, keepdims=True)
+    totals[totals == 0] = 1.0
+    proportions = np.asarray(ancestors @ (counts / totals).T).T
+    return np.ascontiguousarray(proportions * lengths, dtype=np.float64)
+
+
+def _load_table(biom_fp, additions):
+    """
+    :param biom_fp: str
+    :param additions: Sequence[str]
+    :return: biom.Table, the master table merged with the added ones
+    """
+    otu_table = biom.load_table(biom_fp)
+    for path in additions:
+        otu_table = otu_table.merge(biom.load_table(path))
+    return otu_table
+
+
+def _masked_counts(otu_table, otu_ids):
+    """
+    :param otu_table: biom.Table
+    :param otu_ids: Sequence[str]
+    :return: np.ndarray, (samples, len(otu_ids)) counts, zero for the OTUs missing in the table
+    """
+    table_ids = {id_: i for i, id_ in enumerate(otu_table.ids(axis="observation"))}
+    present = np.array([i for i, id_ in enumerate(otu_ids) if id_ in table_ids], dtype=np.int64)
+    rows = np.array([table_ids[otu_ids[i]] for i in present], dtype=np.int64)
+
+    counts = np.zeros((len(otu_table.ids(axis="sample")), len(otu_ids)), dtype=np.float64)
+    if len(present) > 0:
+        counts[:, present] = otu_table.matrix_data.tocsr()[rows, :].T.toarray()
+    return counts
+
+
+class UnifracCache:
+    """
+    Preprocessed input of the weighted UniFrac: the branch lengths of the
+    tree sheared to the OTUs of the table, the tip-to-ancestors incidence
+    matrix and the UniFrac embeddings of the samples, a row per sample.
+    It is built once from the BIOM table and the newick tree and kept
+    as binary files, so loading it does not parse any of them. The samples
+    of the tables added later are appended to the files as new rows
+    """
+    def __init__(self, sample_names, otu_ids, tips, lengths, ancestors, embedding, source=None):
+        """
+        :param sample_names: Sequence[str]
+        :param otu_ids: Sequence[str], OTUs of the table present in the tree
+        :param tips: Sequence[str], all the tips of the tree
+        :param lengths: np.array, branch length of every node
+        :param ancestors: csr_matrix, (nodes, OTUs) incidence of the OTU tips and their ancestors
+        :param embedding: np.ndarray, (samples, nodes) embeddings of the samples
+        :param source: dict, versions of the input files
+        """
+        self.sample_names = list(sample_names)
+        self.sample_ids = {name: i for i, name in enumerate(self.sample_names)}
+        self.otu_ids = list(otu_ids)
+        self.tips = list(tips)
+        self.lengths = lengths
+        self.ancestors = ancestors
+        self.embedding = embedding
+        self.source = source
+        # directory of the saved cache, if any
+        self.path = None
+
+    @staticmethod
+    def build(biom_fp, tree_path, additions=()):
+        """
+        :param biom_fp: str
+        :param tree_path: str
+        :param additions: Sequence[str], tables to merge into the master one
+        :return: UnifracCache
+        """
+        otu_table = _load_table(biom_fp, additions)
+        tree = read(tree_path, format="newick", into=TreeNode).root_at_midpoint()
+        tips = [tip.name for tip in tree.tips()]
+        tip_set = set(tips)
+
+        ids = otu_table.ids(axis="observation")
+        id_mask = np.array([id_ in tip_set for id_ in ids], dtype=bool)
+        masked_ids = ids[id_mask]
+        tree_index = tree.shear(masked_ids).to_array(nan_length_value=0.0)
+
+        node_ids = {name: i for i, name in enumerate(tree_index['name'])}
+        tip_nodes = np.array([node_ids[id_] for id_ in masked_ids], dtype=np.int64)
+
+        counts = otu_table.matrix_data.T.tocsr()[:, np.flatnonzero(id_mask)].toarray()
+        lengths = np.asarray(tree_index['length'], dtype=np.float64)
+        ancestors = _ancestors(tree_index, tip_nodes)
+        return UnifracCache(otu_table.ids(axis="sample"), masked_ids, tips, lengths, ancestors,
+                            embed(counts, lengths, ancestors), _source(biom_fp, tree_path, additions))
+
+    def save(self, path):
+        """
+        :param path: str
+        :return: None
+        """
+        # the cache is written aside and then replaces the old one
+        tmp_path = path + '.tmp'
+        if os.path.exists(tmp_path):
+            shutil.rmtree(tmp_path)
+        make_sure_exists(tmp_path)
+
+        np.save(os.path.join(tmp_path, _LENGTHS_FILE), self.lengths)
+        np.save(os.path.join(tmp_path, _INDPTR_FILE), self.ancestors.indptr)
+        np.save(os.path.join(tmp_path, _INDICES_FILE), self.ancestors.indices)
+        np.ascontiguousarray(self.embedding, dtype=np.float64).tofile(os.path.join(tmp_path, _EMBEDDING_FILE))
+        with open(os.path.join(tmp_path, _SAMPLES_FILE), 'w') as f:
+            f.writelines(name + '\n' for name in self.sample_names)
+        _write_json(os.path.join(tmp_path, _OTUS_FILE), self.otu_ids)
+        _write_json(os.path.join(tmp_path, _TIPS_FILE), self.tips)
+        _write_json(os.path.join(tmp_path, _SOURCE_FILE), self.source)
+
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        os.rename(tmp_path, path)
+        self.path = path
+
+    @staticmethod
+    def load(path):
+        """
+        :param path: str
+        :return: UnifracCache, the arrays are memory-mapped
+        """
+        def load_array(name):
+            return np.load(os.path.join(path, name), mmap_mode='r')
+
+        sample_names = read_lines(os.path.join(path, _SAMPLES_FILE))
+        otu_ids = _read_json(os.path.join(path, _OTUS_FILE))
+        lengths = load_array(_LENGTHS_FILE)
+        indptr = load_array(_INDPTR_FILE)
+        indices = load_array(_INDICES_FILE)
+        ancestors = csr_matrix((np.ones(len(indices)), indices, indptr), shape=(len(lengths), len(otu_ids)))
+        embedding = _rows(os.path.join(path, _EMBEDDING_FILE), len(sample_names), len(lengths))
+        cache = UnifracCache(sample_names, otu_ids, _read_json(os.path.join(path, _TIPS_FILE)),
+                             lengths, ancestors, embedding, _read_json(os.path.join(path, _SOURCE_FILE)))
+        cache.path = path
+        return cache
+
+    @staticmethod
+    def open(biom_fp, tree_path, path, additions=()):
+        """
+        Load the cache, or build and save it if the input files changed since it was built
+        :param biom_fp: str
+        :param tree_path: str
+        :param path: str
+        :param additions: Sequence[str], tables added to the master one
+        :return: UnifracCache
+        """
+        source_file = os.path.join(path, _SOURCE_FILE)
+        if os.path.exists(source_file) and _read_json(source_file) == _source(biom_fp, tree_path, additions):
+            return UnifracCache.load(path)
+
+        cache = UnifracCache.build(biom_fp, tree_path, additions)
+        cache.save(path)
+        return cache
+
+    def can_append(self, otu_table):
+        """
+        :param otu_table: biom.Table
+        :return: bool, False if the table has samples of the cache or OTUs
+        of the tree sheared off before, then the cache has to be rebuilt
+        """
+        if any(name in self.sample_ids for name in otu_table.ids(axis="sample")):
+            return False
+
+        known = set(self.otu_ids)
+        tips = set(self.tips)
+        return all(id_ in known or id_ not in tips for id_ in otu_table.ids(axis="observation"))
+
+    def append(self, path, addition):
+        """
+        Append the samples of a table to the cache saved in the path
+        :param path: str
+        :param addition: str, a table the cache can_append
+        :return: None
+        """
+        otu_table = biom.load_table(addition)
+        counts = _masked_counts(otu_table, self.otu_ids)
+        names = list(otu_table.ids(axis="sample"))
+
+        n_rows = len(self.sample_names)
+        _append_rows(os.path.join(path, _EMBEDDING_FILE), n_rows, embed(counts, self.lengths, self.ancestors))
+        # the samples file commits the appended rows
+        append_lines(os.path.join(path, _SAMPLES_FILE), names)
+
+        self.source['additions'].append(_signature(addition))
+        _write_json(os.path.join(path, _SOURCE_FILE), self.source)
+
+        for name in names:
+            self.sample_ids[name] = len(self.sample_names)
+            self.sample_names.append(name)
+        self.embedding = _rows(os.path.join(path, _EMBEDDING_FILE), len(self.sample_names), len(self.lengths))
+        self.path = path
+
+    def __getstate__(self):
+        # a saved cache is sent to the pool workers by its directory, they map the files themselves
+        if self.path is None:
+            return self.__dict__
+        return {'path': self.path}
+
+    def __setstate__(self, state):
+        if list(state) == ['path']:
+            state = UnifracCache.load(state['path']).__dict__
+        self.__dict__.update(state)
+
+    def __len__(self):
+        return len(self.sample_names)
+
+    def distance(self, i, j):
+        """
+        Weighted UniFrac, not normalized
+        :param i: int, sample id
+        :param j: int, sample id
+        :return: float
+        """
+        return float(np.sum(np.abs(self.embedding[i] - self.embedding[j])))
+
+    def one_to_many(self, i, js):
+        """
+        :param i: int, sample id
+        :param js: Sequence[int], sample ids
+        :return: np.array
+        """
+        return np.sum(np.abs(self.embedding[js] - self.embedding[i]), axis=1)
+
+    def many_to_many(self, rows, cols):
+        """
+        :param rows: Sequence[int], sample ids
+        :param cols: Sequence[int], sample ids
+        :return: np.ndarray, (len(rows), len(cols)) distances
+        """
+        targets = self.embedding[cols]
+        result = np.empty((len(rows), len(cols)), dtype=np.float64)
+        for k, i in enumerate(rows):
+            result[k] = np.sum(np.abs(targets - self.embedding[i]), axis=1)
+        return result
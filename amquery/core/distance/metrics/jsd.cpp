@@ -1,160 +1,246 @@
 #include <cstdint>
 #include <cstddef>
 #include <vector>
-#include <functional>
+#include <thread>
 #include <algorithm>
 #include <cmath>
-#include <numeric>
 
 typedef double num_t;
 typedef uint64_t index_t;
-typedef std::function<num_t(num_t, num_t)> transformer;
 
-template <typename IndexType, typename T>
-struct sparse_array_t
+// A k-mer profile as it is passed from Python. A wide profile has
+// uint64 ranks, float64 frequencies and their entropy terms, mass is
+// the sum of the frequencies. A compact profile has uint32 rank deltas
+// and uint32 counts, mass is the total count
+struct profile_t
 {
-    std::vector<IndexType> idx;
-    std::vector<T> data;
+    const void* cols;
+    const void* data;
+    const num_t* entropy;
+    uint64_t len;
+    num_t mass;
+    uint32_t compact;
+};
 
-    typedef std::vector<IndexType> idx_t;
-    typedef std::vector<T> data_t;
+inline num_t h(num_t x)
+{
+    return -x * log2(x);
+}
 
-    sparse_array_t(size_t size=0)
-        : idx(std::vector<IndexType>(size))
-        , data(std::vector<T>(size))
-    {}
+// log2 of the small counts, that are the most of the counts of a profile
+static const uint32_t log2_table_size = 1 << 16;
 
-    sparse_array_t(const sparse_array_t&) = delete;
+const std::vector<num_t>& log2_table()
+{
+    static const std::vector<num_t> table = [] {
+        std::vector<num_t> result(log2_table_size);
+        for (uint32_t i = 1; i < log2_table_size; ++i)
+            result[i] = log2(num_t(i));
+        return result;
+    }();
+    return table;
+}
 
-    sparse_array_t(idx_t&& other_idx, data_t&& other_data)
-        : idx(std::move(other_idx))
-        , data(std::move(other_data))
-    {}
+inline num_t log2_count(const std::vector<num_t>& table, uint32_t count)
+{
+    return count < log2_table_size ? table[count] : log2(num_t(count));
+}
 
-    sparse_array_t(sparse_array_t&& other)
-        : sparse_array_t(std::move(other.idx),
-                         std::move(other.data))
+// Sequential access to a wide profile
+struct wide_cursor
+{
+    const index_t* pos;
+    const num_t* val;
+    const num_t* ent;
+    const size_t len;
+    size_t i;
+
+    wide_cursor(const profile_t& p)
+        : pos(static_cast<const index_t*>(p.cols))
+        , val(static_cast<const num_t*>(p.data))
+        , ent(p.entropy)
+        , len(p.len)
+        , i(0)
     {}
 
-    // WARNING: dangerous
-    sparse_array_t& operator=(sparse_array_t&& other)
-    {
-        std::swap(idx, other.idx);
-        std::swap(data, other.data);
-        return *this;
-    }
-
-    sparse_array_t copy() const
-    {
-        sparse_array_t result(size());
-        std::copy(idx.begin(), idx.end(), result.idx.begin());
-        std::copy(data.begin(), data.end(), result.data.begin());
-        return result;
-    }
+    static num_t mass(const profile_t& p) { return p.mass; }
+    bool done() const { return i >= len; }
+    index_t rank() const { return pos[i]; }
+    num_t value() const { return val[i]; }
+    num_t entropy() const { return ent[i]; }
+    void next() { ++i; }
+};
 
-    sparse_array_t&& apply(const std::function<T(T)>& f)
-    {
-        std::transform(data.begin(), data.end(),
-                       data.begin(), f);
-        return std::move(*this);
-    }
+// Sequential access to a compact profile, decodes the ranks and
+// computes h(p) = p * (log2(total) - log2(count)) on the fly
+struct compact_cursor
+{
+    const uint32_t* deltas;
+    const uint32_t* counts;
+    const size_t len;
+    const num_t total;
+    const num_t log2_total;
+    const std::vector<num_t>& table;
+    size_t i;
+    index_t current;
+
+    compact_cursor(const profile_t& p)
+        : deltas(static_cast<const uint32_t*>(p.cols))
+        , counts(static_cast<const uint32_t*>(p.data))
+        , len(p.len)
+        , total(p.mass)
+        , log2_total(log2(p.mass))
+        , table(log2_table())
+        , i(0)
+        , current(p.len > 0 ? deltas[0] : 0)
+    {}
 
-    void push_back(const IndexType& i, const T& value)
+    static num_t mass(const profile_t&) { return 1.0; }
+    bool done() const { return i >= len; }
+    index_t rank() const { return current; }
+    num_t value() const { return counts[i] / total; }
+    num_t entropy() const { return value() * (log2_total - log2_count(table, counts[i])); }
+    void next()
     {
-        idx.push_back(i);
-        data.push_back(value);
+        if (++i < len)
+            current += deltas[i];
     }
+};
 
-    size_t size() const
-    {
-        return idx.size();
-    }
+// h(a) + h(b) - h(a + b), with h(a) and h(b) taken from the profiles
+template <typename X, typename Y>
+inline num_t kernel(const X& x, const Y& y)
+{
+    return x.entropy() + y.entropy() - h(x.value() + y.value());
+}
 
-    void reserve(size_t size)
+// Sums the kernel over the k-mers present in both profiles,
+// walking both sorted profiles in place
+template <typename X, typename Y>
+num_t skipping_merge(X x, Y y)
+{
+    num_t result = 0;
+    while (!x.done() && !y.done())
     {
-        idx.reserve(size);
-        data.reserve(size);
+        if (x.rank() == y.rank())
+        {
+            result += kernel(x, y);
+            x.next();
+            y.next();
+        }
+        else if (x.rank() < y.rank())
+        {
+            x.next();
+        }
+        else
+        {
+            y.next();
+        }
     }
-};
-
-typedef sparse_array_t<index_t, num_t> sparse_array;
+    return result;
+}
 
-sparse_array skipping_merge(sparse_array&& x, sparse_array&& y,
-                            transformer func, num_t default_value = 0)
+// Same as skipping_merge, but gives up as soon as the distance can not be
+// less or equal to the threshold. Every common k-mer adds at most a + b
+// to the kernel sum, so the sum can not exceed its current value plus
+// the mass of both profiles that is not merged yet. On an early exit
+// the distance for that upper bound of the sum is returned, which is
+// a lower bound of the distance greater than the threshold
+template <typename X, typename Y>
+double bounded_merge(X x, const num_t x_mass, Y y, const num_t y_mass, const double threshold)
 {
-    sparse_array result;
-    result.reserve(std::max(x.size(), y.size()));
-
-    long i = 0, j = 0;
-    long xsize = x.size(), ysize = y.size();
-    while (i >= 0 || j >= 0)
+    // the kernel sum needed to get a distance within the threshold
+    const num_t bound = std::max(threshold, 0.0);
+    const num_t needed = 2.0 * (1.0 - bound * bound);
+    // compensates the rounding errors of the running remainders
+    const num_t slack = 1e-9;
+
+    num_t result = 0;
+    num_t x_rest = x_mass + slack;
+    num_t y_rest = y_mass + slack;
+    while (!x.done() && !y.done())
     {
-        num_t temp = 0;
-        index_t index = -1;
+        if (result + x_rest + y_rest < needed)
+            return sqrt(1.0 - 0.5 * (result + x_rest + y_rest));
 
-        if (i >= 0 && j >=0 && x.idx[i] == y.idx[j])
+        if (x.rank() == y.rank())
         {
-            temp = func(x.data[i], y.data[j]);
-            index = x.idx[i];
-            i = i < xsize - 1 ? i + 1 : -1;
-            j = j < ysize - 1 ? j + 1 : -1;
-
-            result.push_back(index, temp);
+            result += kernel(x, y);
+            x_rest -= x.value();
+            y_rest -= y.value();
+            x.next();
+            y.next();
         }
-        else if (j < 0 || (i >= 0 && x.idx[i] < y.idx[j]))
+        else if (x.rank() < y.rank())
         {
-            i = i < xsize - 1 ? i + 1 : -1;
+            x_rest -= x.value();
+            x.next();
         }
         else
         {
-            j = j < ysize - 1? j + 1 : -1;
+            y_rest -= y.value();
+            y.next();
         }
     }
-    return result;
+    return sqrt(1.0 - 0.5 * result);
+}
 
+template <typename X, typename Y>
+double _fast_jsd(const profile_t& x, const profile_t& y, const double threshold)
+{
+    if (!(threshold < 1.0))
+        return sqrt(1.0 - 0.5 * skipping_merge(X(x), Y(y)));
+
+    return bounded_merge(X(x), X::mass(x), Y(y), Y::mass(y), threshold);
 }
 
-num_t h(num_t x)
+// Dispatches the pair of profiles to the merge of their representations
+double _fast_jsd(const profile_t& x, const profile_t& y, const double threshold)
 {
-    return -x * log2(x);
+    if (x.compact && y.compact)
+        return _fast_jsd<compact_cursor, compact_cursor>(x, y, threshold);
+    if (x.compact)
+        return _fast_jsd<compact_cursor, wide_cursor>(x, y, threshold);
+    if (y.compact)
+        return _fast_jsd<wide_cursor, compact_cursor>(x, y, threshold);
+    return _fast_jsd<wide_cursor, wide_cursor>(x, y, threshold);
 }
 
-num_t kernel(num_t a, num_t b)
+// Distances from one profile to the profiles ys[first, last)
+void _fast_jsd_batch(const profile_t* x, const profile_t* ys,
+                     const size_t first, const size_t last, double* out)
 {
-    return h(a) + h(b) - h(a + b);
+    for (size_t i = first; i < last; ++i)
+        out[i] = _fast_jsd(*x, ys[i], INFINITY);
 }
 
+extern "C" {
+    double jsd(const profile_t* x, const profile_t* y)
+    {
+        return _fast_jsd(*x, *y, INFINITY);
+    }
 
-double _fast_jsd(const index_t* x_pos, const num_t* x_val,
-                 const size_t x_len,
-                 const index_t* y_pos, const num_t* y_val,
-                 const size_t y_len)
-{
-    sparse_array x(
-        std::vector<index_t>(x_pos, x_pos + x_len),
-        std::vector<num_t>(x_val, x_val + x_len)
-    );
-
-    sparse_array y(
-        std::vector<index_t>(y_pos, y_pos + y_len),
-        std::vector<num_t>(y_val, y_val + y_len)
-    );
-
-    sparse_array f = skipping_merge(std::move(x), std::move(y), kernel);
-    double result = 0;
-    for (auto v : f.data)
+    double jsd_bounded(const profile_t* x, const profile_t* y, const double threshold)
     {
-        result += v;
+        return _fast_jsd(*x, *y, threshold);
     }
-    return sqrt(1.0 - 0.5 * result);
-}
 
-extern "C" {
-    double jsd(const index_t* x_pos, const num_t* x_val,
-               const size_t x_len,
-               const index_t* y_pos, const num_t* y_val,
-               const size_t y_len)
+    void jsd_batch(const profile_t* x, const profile_t* ys,
+                   const size_t n, double* out, const size_t n_threads)
     {
-        return _fast_jsd(x_pos, x_val, x_len, y_pos, y_val, y_len);
+        const size_t threads = std::max<size_t>(1, std::min(n_threads, n));
+        if (threads == 1)
+        {
+            _fast_jsd_batch(x, ys, 0, n, out);
+            return;
+        }
+
+        std::vector<std::thread> workers;
+        const size_t step = (n + threads - 1) / threads;
+        for (size_t first = 0; first < n; first += step)
+            workers.emplace_back(_fast_jsd_batch, x, ys, first, std::min(n, first + step), out);
+
+        for (auto& worker : workers)
+            worker.join();
     }
-}
\ No newline at end of file
+}
@@ -1,13 +1,28 @@
 import os
 import abc
 from amquery.core.distance.factory import Factory as DistanceFactory
+from amquery.core.distance import distance_matrix, matrix_distances, KMER_DISTANCES
 from amquery.core.preprocessing.factory import Factory as PreprocessorFactory
-from amquery.core.biom import merge_biom_tables
 from amquery.core.storage.factory import Factory as StorageFactory
 from amquery.utils.config import read_config
-from amquery.core.sample import Sample
+from amquery.core.sample import Sample, KmerIndexCache
 from amquery.utils.split_fasta import split_fasta
-from amquery.utils.config import get_sample_dir
+from amquery.utils.multiprocess import Pool
+from amquery.utils.config import get_sample_dir, get_profiles_dir
+from amquery.core.profile_store import ProfileStore
+
+
+# share of the unreferenced values of the profile store that triggers its compaction
+_MAX_PROFILE_GARBAGE = 0.5
+
+
+def _resize_profile_cache(memory_budget):
+    """
+    Limit the k-mer profiles kept in memory by the process, the pool workers run it on their start
+    :param memory_budget: int, bytes
+    :return: None
+    """
+    KmerIndexCache.instance().resize(memory_budget)
 
 
 class SampleReference:
@@ -31,55 +46,75 @@ class SampleCollection:
 
 
 class Index:
-    def __init__(self, distance, preprocessor, storage):
+    def __init__(self, distance, preprocessor, storage, jobs=1):
         """
         :param distance: SampleDistance
         :param preprocessor: Preprocessor
         :param storage: MetricIndexStorage
+        :param jobs: int, number of threads the distance computations may use
         """
         self._distance = distance
         self._preprocessor = preprocessor
         self._storage = storage
+        self._jobs = jobs
+        self._distance.distance_function.threads = jobs
 
     def __len__(self):
         """
         :return: int 
         """
-        return len(self._storage) if self._storage else 0
+        return len(self.distance.sample_map)
+
+    @staticmethod
+    def _configure(config):
+        """
+        :param config: Config
+        :return: None
+        """
+        memory_budget = config.getint('distance', 'profile_memory_budget', fallback=0) * 2 ** 20
+        _resize_profile_cache(memory_budget)
+        Pool.instance().set_initializer(_resize_profile_cache, memory_budget)
 
     @staticmethod
-    def init(config):
+    def init(config, jobs=1):
         """
+        :param config: Config
+        :param jobs: int
         :return: Index
         """
+        Index._configure(config)
         distance = DistanceFactory.create(config)
         preprocessor = PreprocessorFactory.create(config)
         storage = StorageFactory.create(config)
-        return Index(distance, preprocessor, storage)
+        return Index(distance, preprocessor, storage, jobs)
 
     #@measure_time(enabled=True)
     def save(self):
         self.distance.save()
         self.storage.save()
 
+        # the profiles of the samples added again shadow their former ones
+        store = ProfileStore.open(get_profiles_dir())
+        if store.garbage > _MAX_PROFILE_GARBAGE:
+            store.compact()
+
     @staticmethod
     def _load():
         config = read_config()
+        Index._configure(config)
         distance = DistanceFactory.load(config)
         preprocessor = PreprocessorFactory.create(config)
         storage = StorageFactory.load(config)
         return distance, preprocessor, storage, config
 
     @staticmethod
-    def load():
-        distance, preprocessor, storage, config = Index._load()
-        return Index(distance, preprocessor, storage), config
-
-    def _reload(self):
+    def load(jobs=1):
+        """
+        :param jobs: int
+        :return: Tuple[Index, Config]
+        """
         distance, preprocessor, storage, config = Index._load()
-        self._distance = distance
-        self._preprocessor = preprocessor
-        self._storage = storage
+        return Index(distance, preprocessor, storage, jobs), config
 
     def build(self, config, input_files):
         """
@@ -91,32 +126,30 @@ class Index:
         input_file = input_files[0]
 
         samples = [Sample(sample_file) for sample_file in split_fasta(input_file, get_sample_dir())]
-        processed_samples = [self._preprocessor(sample) for sample in samples]
+        processed_samples = self._preprocessor.process(samples)
         self.distance.add_samples(processed_samples)
         self.storage.build(self.distance, processed_samples)
 
     def refine(self):
         raise NotImplementedError
 
-    def add(self, config, input_files):
+    def add(self, config, input_files, biom_table=None):
         """
         :param config: configparser.ConfigParser
         :param sample_files: Sequence[str] 
+        :param biom_table: str, OTU table of the added samples
         :return: None
         """
         #assert (len(input_files) == 1)
         #input_file = input_files[0]
 
         # update biom table if present
-        if config.has_option("distance", "biom_table"):
-            master_table = config.get("distance", "biom_table")
-            additional_table = config.get("additional", "biom_table")
-            merge_biom_tables(master_table, additional_table)
-            self._reload()
+        if biom_table and config.has_option("distance", "biom_table"):
+            self.distance.distance_function.add_table(biom_table)
 
         #samples = [Sample(sample_file) for sample_file in split_fasta(input_file, get_sample_dir())]
         samples = [Sample(sample_file) for sample_file in input_files]
-        processed_samples = [self._preprocessor(sample) for sample in samples]
+        processed_samples = self._preprocessor.process(samples)
 
         self.distance.add_samples(processed_samples)
         self.storage.add_samples(processed_samples, self.distance)
@@ -129,7 +162,7 @@ class Index:
         :return: Tuple[Sequence[np.float], Sequence[np.str]]
         """
 
-        if sample_name in self.distance.labels:
+        if sample_name in self.distance.cache:
             processed_samples = [self.distance.sample_map[sample_name]]
         else:
             samples = [Sample(sample_file) for sample_file in split_fasta(sample_name, get_sample_dir())]
@@ -137,6 +170,28 @@ class Index:
 
         return self.storage.find(self.distance, processed_samples[0], k)
 
+    def matrix(self, config, output_file, upper=False, method=None):
+        """
+        :param config: configparser.ConfigParser
+        :param output_file: str, a .npy file for the matrix
+        :param upper: bool
+        :param method: str, a distance of matrix_distances, the one of the index if not given
+        :return: Sequence[str] names of the samples in the matrix order
+        """
+        distance_function = self.distance.distance_function
+        index_method = config.get('distance', 'method')
+        if method and method != index_method:
+            # the samples of the index are preprocessed for its own method
+            if not (method in KMER_DISTANCES and index_method in KMER_DISTANCES):
+                raise ValueError("%s can not be computed on an index of %s" % (method, index_method))
+            distance_function = matrix_distances[method](config)
+            distance_function.threads = self._jobs
+
+        names = sorted(self.distance.sample_map.labels)
+        samples = [self.distance.sample_map[name] for name in names]
+        distance_matrix(distance_function, samples, output_file, upper)
+        return names
+
     @property
     def distance(self):
         """
@@ -157,3 +212,10 @@ class Index:
         :return: Sequence[Sample]
         """
         return list(self.distance.sample_map.values())
+
+    @property
+    def sample_names(self):
+        """
+        :return: Sequence[str]
+        """
+        return list(self.distance.sample_map.labels)
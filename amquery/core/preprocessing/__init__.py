@@ -1,5 +1,6 @@
 from ._preprocessor import Preprocessor
 from .dummy import DummyPreprocessor
+from .cache import ProfileCache
 from .kmer_counter import KmerCounter
 
 
@@ -9,3 +9,10 @@ class Preprocessor:
         :return: Sample
         """
         raise NotImplementedError
+
+    def process(self, samples):
+        """
+        :param samples: Sequence[Sample]
+        :return: Sequence[Sample]
+        """
+        return [self(sample) for sample in samples]
@@ -1,4 +1,4 @@
-from ._biom import merge_biom_tables
+from ._cache import ProfileCache
 
 
 __license__ = "MIT"
@@ -0,0 +1,104 @@
+import os
+import hashlib
+import tempfile
+import joblib
+from amquery.utils.iof import make_sure_exists
+
+
+# bump it whenever the stored profiles change
+_CACHE_VERSION = 2
+_HASH_BLOCK_SIZE = 1 << 20
+
+
+class ProfileCache:
+    """
+    K-mer profiles keyed by a content hash of the sample file and the
+    preprocessing parameters. The least recently used profiles are
+    evicted by shrink() once the cache outgrows its size limit
+    """
+    def __init__(self, path, max_size):
+        """
+        :param path: str
+        :param max_size: int, bytes
+        """
+        self.path = path
+        self.max_size = max_size
+
+    @staticmethod
+    def key(sample, *params):
+        """
+        :param sample: Sample
+        :param params: Sequence[Any] preprocessing parameters
+        :return: str
+        """
+        digest = hashlib.sha1(repr((_CACHE_VERSION,) + params).encode())
+        with open(sample.source_file.path, 'rb') as f:
+            for block in iter(lambda: f.read(_HASH_BLOCK_SIZE), b''):
+                digest.update(block)
+        return digest.hexdigest()
+
+    def _filename(self, key):
+        return os.path.join(self.path, key)
+
+    def get(self, key):
+        """
+        A missing or unreadable profile is a miss, an unreadable one is removed
+        :param key: str
+        :return: Optional[SparseArray]
+        """
+        filename = self._filename(key)
+        try:
+            profile = joblib.load(filename)
+            os.utime(filename)
+            return profile
+        except FileNotFoundError:
+            return None
+        except Exception:
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+            return None
+
+    def put(self, key, profile):
+        """
+        :param key: str
+        :param profile: SparseArray
+        :return: None
+        """
+        make_sure_exists(self.path)
+
+        # write to a temporary file first, so that concurrent workers
+        # never see a partially written profile
+        fd, temp_filename = tempfile.mkstemp(dir=self.path, prefix='.')
+        os.close(fd)
+        joblib.dump(profile, temp_filename)
+        os.replace(temp_filename, self._filename(key))
+
+    def shrink(self):
+        """
+        Evict the least recently used profiles until the cache fits its size limit
+        :return: None
+        """
+        if not os.path.exists(self.path):
+            return
+
+        entries = []
+        for f in os.listdir(self.path):
+            if f.startswith('.'):
+                continue
+            try:
+                stat = os.stat(self._filename(f))
+                entries.append((stat.st_mtime, stat.st_size, f))
+            except OSError:
+                pass
+
+        size = sum(entry_size for _, entry_size, _ in entries)
+        for _, entry_size, f in sorted(entries):
+            if size <= self.max_size:
+                break
+            try:
+                os.remove(self._filename(f))
+            except OSError:
+                pass
+            size -= entry_size
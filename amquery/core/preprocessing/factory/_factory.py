@@ -1,5 +1,6 @@
-from amquery.core.distance import FFP_JSD, WEIGHTED_UNIFRAC
-from amquery.core.preprocessing import KmerCounter, DummyPreprocessor
+from amquery.core.distance import KMER_DISTANCES, WEIGHTED_UNIFRAC
+from amquery.core.preprocessing import KmerCounter, DummyPreprocessor, ProfileCache
+from amquery.utils.config import get_cache_dir
 
 
 class Factory:
@@ -10,8 +11,13 @@ class Factory:
         :return: Preprocessor 
         """
         method = config.get('distance', 'method')
-        if method == FFP_JSD:
+        if method in KMER_DISTANCES:
             kmer_size = int(config.get('distance', 'kmer_size'))
-            return KmerCounter(kmer_size)
+            dereplicate = config.getboolean('distance', 'dereplicate', fallback=True)
+            memory_budget = config.getint('distance', 'kmer_memory_budget', fallback=0)
+            cache_size = config.getint('distance', 'profile_cache_size', fallback=1024)
+            cache = ProfileCache(get_cache_dir(), cache_size * 2 ** 20) if cache_size > 0 else None
+            compact = config.getboolean('distance', 'compact_profiles', fallback=False)
+            return KmerCounter(kmer_size, dereplicate, memory_budget * 2 ** 20, cache, compact)
         elif method == WEIGHTED_UNIFRAC:
             return DummyPreprocessor()
@@ -1,50 +1,166 @@
+import os
+import tempfile
 import numpy as np
+import multiprocessing as mp
 from collections import Counter
-from ctypes import POINTER, c_uint8, c_uint64
+from ctypes import POINTER, c_uint8, c_uint64, c_double
 from typing import List
 from amquery.core.preprocessing.kmer_counter.lexrank import ranklib
-from amquery.core.distance.kmers_distr.sparse_array import SparseArray
+from amquery.core.distance.kmers_distr.sparse_array import SparseArray, CompactSparseArray, entropy_terms
 from amquery.utils.benchmarking import measure_time
 from amquery.utils.multiprocess import Pool
 from amquery.utils.ui import progress_bar
+from amquery.utils.iof import make_sure_exists
+from amquery.utils.config import get_profiles_dir, get_sample_dir
 from amquery.core.preprocessing import Preprocessor
 
 
+# any code greater than 3 separates reads for the native counter
+_SEPARATOR = b'\xff'
+
+
+def _check(counter):
+    """
+    :param counter: a native k-mer counter
+    :return: None, raises OSError if the counter failed to spill k-mers to the disk
+    """
+    error = ranklib.kmer_counter_error(counter)
+    if error:
+        raise OSError(error, "Failed to spill k-mers to %s: %s" % (tempfile.gettempdir(), os.strerror(error)))
+
+
+def _dereplicate(seqs, min_length):
+    """
+    Collapse identical reads
+    :param seqs: Iterable[np.array]
+    :param min_length: int
+    :return: Tuple[np.array, np.array] unique reads joined by the separator and their multiplicities
+    """
+    counter = Counter(seq.tobytes() for seq in seqs if len(seq) >= min_length)
+    codes = np.frombuffer(_SEPARATOR.join(counter.keys()), dtype=np.uint8)
+    weights = np.fromiter(counter.values(), dtype=np.uint64, count=len(counter))
+    return codes, weights
+
+
 class KmerCounter(Preprocessor):
-    def __init__(self, k):
+    def __init__(self, k, dereplicate=True, memory_budget=0, cache=None, compact=False):
+        """
+        :param k: int
+        :param dereplicate: bool
+        :param memory_budget: int, bytes per sample; sorted k-mer runs are
+        spilled to the temporary directory beyond it. 0 means unlimited
+        :param cache: Optional[ProfileCache]
+        :param compact: bool, keep raw uint32 counts with delta-encoded columns
+        instead of float64 frequencies, where the profile fits them
+        """
         self.k = k
+        self.dereplicate = dereplicate
+        self.memory_budget = memory_budget
+        self.cache = cache
+        self.compact = compact
+
+    def _iter_dereplicated(self, sample):
+        # with a memory budget identical reads are only collapsed within a block
+        if self.memory_budget:
+            for seqs in sample.iter_seq_chunks():
+                yield _dereplicate(seqs, self.k)
+        else:
+            yield _dereplicate(sample.iter_seqs(), self.k)
 
-    def _count_seq(self, seq):
-        if seq.size > 0 and seq.size >= self.k:
-            ranks = np.zeros(len(seq) - self.k + 1, dtype=np.uint64)
-            seq_pointer = seq.ctypes.data_as(POINTER(c_uint8))
-            ranks_pointer = ranks.ctypes.data_as(POINTER(c_uint64))
-            ranklib.count_kmer_ranks(seq_pointer, ranks_pointer,
-                                     len(seq), self.k)
-            return ranks
+    def _add_sample(self, counter, sample):
+        if self.dereplicate:
+            for codes, weights in self._iter_dereplicated(sample):
+                ranklib.kmer_counter_add_weighted(counter, codes.ctypes.data_as(POINTER(c_uint8)), len(codes),
+                                                  weights.ctypes.data_as(POINTER(c_uint64)))
         else:
-            return seq
+            for codes in sample.iter_blocks():
+                ranklib.kmer_counter_add(counter, codes.ctypes.data_as(POINTER(c_uint8)), len(codes))
 
     def __call__(self, sample):
         """
         :param sample: Sample
         :return: Sample
         """
-        kmer_refs = np.concatenate(list(self._count_seq(seq) for seq in sample.iter_seqs()))
-        counter = Counter(kmer_refs)
-        cols = np.array(sorted(list(counter.keys())), dtype=np.uint64)
-        data = np.array([counter[key] for key in cols], dtype=np.float)
-        data /= np.sum(data)
-        sample.set_kmer_index(SparseArray(cols, data))
+        if self.cache:
+            params = (self.k, 'compact') if self.compact else (self.k,)
+            key = self.cache.key(sample, *params)
+            profile = self.cache.get(key)
+            if profile is not None:
+                sample.set_kmer_index(profile)
+                return sample
+
+        counter = ranklib.kmer_counter_new(self.k, self.memory_budget,
+                                           os.fsencode(tempfile.gettempdir()))
+        try:
+            self._add_sample(counter, sample)
+
+            size = ranklib.kmer_counter_size(counter)
+            _check(counter)
+            cols = np.empty(size, dtype=np.uint64)
+            if self.compact:
+                counts = np.empty(size, dtype=np.uint64)
+                ranklib.kmer_counter_counts(counter,
+                                            cols.ctypes.data_as(POINTER(c_uint64)),
+                                            counts.ctypes.data_as(POINTER(c_uint64)))
+            else:
+                data = np.empty(size, dtype=np.float64)
+                ranklib.kmer_counter_result(counter,
+                                            cols.ctypes.data_as(POINTER(c_uint64)),
+                                            data.ctypes.data_as(POINTER(c_double)))
+            _check(counter)
+        finally:
+            ranklib.kmer_counter_free(counter)
+
+        profile = CompactSparseArray.from_counts(cols, counts) if self.compact else None
+        if profile is None:
+            # profiles that do not fit 32-bit values stay wide
+            if self.compact:
+                data = counts / float(np.sum(counts))
+            profile = SparseArray(cols, data, entropy_terms(data), float(np.sum(data)))
+        if self.cache:
+            self.cache.put(key, profile)
+
+        sample.set_kmer_index(profile)
+        return sample
+
+    def process(self, samples):
+        """
+        :param samples: Sequence[Sample]
+        :return: Sequence[Sample]
+        """
+        samples = kmerize_samples(samples, self)
+        if self.cache:
+            self.cache.shrink()
+        return samples
+
+
+class KmerCountFunction:
+    def __init__(self, counter: KmerCounter, queue: mp.Queue):
+        self.counter = counter
+        self.queue = queue
+
+    def __call__(self, sample):
+        """
+        Count k-mers of a sample in a worker process and persist the profile
+        there, so that only the lightweight Sample object is sent back
+        :param sample: Sample
+        :return: Sample
+        """
+        sample = self.counter(sample)
+        sample.save()
+        self.queue.put(1)
         return sample
 
 
 @measure_time(enabled=True)
-def kmerize_samples(sample_files: List[str], k: int):
-    packed_task = KmerCountFunction(k, Pool.instance().queue)
-    result = Pool.instance().map_async(packed_task, sample_files)
-    progress_bar(result, Pool.instance().queue, len(sample_files), 'Counting k-mers:')
+def kmerize_samples(samples: List, counter: KmerCounter):
+    make_sure_exists(get_sample_dir())
+    make_sure_exists(get_profiles_dir())
+
+    packed_task = KmerCountFunction(counter, Pool.instance().queue)
+    result = Pool.instance().map_async(packed_task, samples)
+    progress_bar(result, Pool.instance().queue, len(samples), 'Counting k-mers:')
 
     samples = result.get()
     Pool.instance().clear()
-    return dict([(sample.name, sample) for sample in samples])
+    return samples
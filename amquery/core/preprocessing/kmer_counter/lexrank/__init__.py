@@ -2,13 +2,26 @@ if __name__ == "__main__":
     raise RuntimeError()
 else:
     import os
-    from ctypes import cdll, POINTER, c_uint8, c_uint64, c_size_t, c_int
+    from ctypes import cdll, POINTER, c_uint8, c_uint64, c_size_t, c_int, c_void_p, c_double, c_char_p
     import amquery.utils.iof as iof
 
     libdir = os.path.dirname(os.path.abspath(__file__))
     ranklib = cdll.LoadLibrary(iof.find_lib(libdir, "lexrank"))
     ranklib.count_kmer_ranks.argtypes = [POINTER(c_uint8), POINTER(c_uint64),
                                          c_size_t, c_int]
+    ranklib.kmer_counter_new.argtypes = [c_int, c_size_t, c_char_p]
+    ranklib.kmer_counter_new.restype = c_void_p
+    ranklib.kmer_counter_add.argtypes = [c_void_p, POINTER(c_uint8), c_size_t]
+    ranklib.kmer_counter_add_weighted.argtypes = [c_void_p, POINTER(c_uint8), c_size_t,
+                                                  POINTER(c_uint64)]
+    ranklib.kmer_counter_size.argtypes = [c_void_p]
+    ranklib.kmer_counter_size.restype = c_size_t
+    ranklib.kmer_counter_result.argtypes = [c_void_p, POINTER(c_uint64), POINTER(c_double)]
+    ranklib.kmer_counter_counts.argtypes = [c_void_p, POINTER(c_uint64), POINTER(c_uint64)]
+    ranklib.kmer_counter_counts.restype = c_uint64
+    ranklib.kmer_counter_error.argtypes = [c_void_p]
+    ranklib.kmer_counter_error.restype = c_int
+    ranklib.kmer_counter_free.argtypes = [c_void_p]
 
 
 
@@ -1,5 +1,14 @@
 #include <cstdint>
 #include <cstddef>
+#include <cstdio>
+#include <cstdlib>
+#include <vector>
+#include <queue>
+#include <string>
+#include <algorithm>
+#include <functional>
+#include <cerrno>
+#include <unistd.h>
 
 
 uint64_t ipow(uint64_t base, uint64_t exp)
@@ -28,9 +37,389 @@ void kmer_ranks(const uint8_t* in, uint64_t* out, const size_t n, const size_t k
         out[i] = m * (out[i-1] - in[i-1] * ipow(m, k - 1)) + in[i+k-1];
 }
 
+// A sorted run of (rank, count) pairs spilled to a temporary file
+struct run_reader_t
+{
+    FILE* file;
+    uint64_t rank;
+    uint64_t count;
+
+    run_reader_t(FILE* file)
+        : file(file)
+        , rank(0)
+        , count(0)
+    {}
+
+    bool next()
+    {
+        uint64_t pair[2];
+        if (fread(pair, sizeof(uint64_t), 2, file) != 2)
+            return false;
+
+        rank = pair[0];
+        count = pair[1];
+        return true;
+    }
+};
+
+// Accumulates sorted (rank, count) pairs of distinct k-mers.
+// Weighted ranks are buffered by chunks; every full chunk is sorted,
+// run-length encoded and merged into the distinct k-mers, so the memory
+// is bounded by the number of distinct k-mers plus the chunk size.
+// If a memory budget is set, the distinct k-mers are spilled to disk as
+// sorted runs whenever they outgrow it, and the runs are merged at the end.
+// Once max_runs runs are open, they are merged into a single one, so the
+// number of open files stays bounded. An I/O failure stops the counting
+// and is kept as an errno value in error, the result is not valid then
+struct kmer_counter_t
+{
+    static const size_t max_chunk_size = 1 << 21;
+    static const size_t max_runs = 16;
+
+    typedef std::pair<uint64_t, uint64_t> weighted_rank;
+
+    const size_t k;
+    const uint64_t mask;
+    const std::string tmp_dir;
+    size_t chunk_size;
+    size_t max_distinct;
+    std::vector<weighted_rank> buffer;
+    std::vector<uint64_t> cols;
+    std::vector<uint64_t> counts;
+    std::vector<FILE*> runs;
+    uint64_t total;
+    int error;
+
+    kmer_counter_t(size_t k, size_t memory_budget, const char* tmp_dir)
+        : k(k)
+        , mask(k < 32 ? (uint64_t(1) << (2 * k)) - 1 : ~uint64_t(0))
+        , tmp_dir(tmp_dir ? tmp_dir : "/tmp")
+        , chunk_size(max_chunk_size)
+        , max_distinct(0)
+        , total(0)
+        , error(0)
+    {
+        // a quarter of the budget for the chunk, the rest is for merging
+        // the chunk into the distinct k-mers
+        if (memory_budget > 0)
+        {
+            const size_t quarter = std::max<size_t>(memory_budget / (4 * sizeof(weighted_rank)), 1);
+            chunk_size = std::min(chunk_size, quarter);
+            max_distinct = quarter;
+        }
+
+        buffer.reserve(chunk_size);
+    }
+
+    ~kmer_counter_t()
+    {
+        for (FILE* run : runs)
+            fclose(run);
+    }
+
+    // Codes greater than 3 are ambiguous bases, k-mers that contain them are skipped.
+    // If weights are given, reads are separated by a single ambiguous code
+    // and every k-mer of the i-th read is counted weights[i] times
+    void add(const uint8_t* in, const size_t n, const uint64_t* weights)
+    {
+        if (error)
+            return;
+
+        uint64_t rank = 0;
+        size_t valid = 0;
+        size_t read = 0;
+        for (size_t i = 0; i < n; ++i)
+        {
+            if (in[i] > 3)
+            {
+                valid = 0;
+                rank = 0;
+                ++read;
+                continue;
+            }
+
+            rank = ((rank << 2) | in[i]) & mask;
+            if (++valid >= k)
+            {
+                const uint64_t weight = weights ? weights[read] : 1;
+                buffer.push_back(weighted_rank(rank, weight));
+                total += weight;
+                if (buffer.size() >= chunk_size)
+                    flush();
+            }
+        }
+    }
+
+    void flush()
+    {
+        if (buffer.empty() || error)
+            return;
+
+        std::sort(buffer.begin(), buffer.end());
+
+        std::vector<uint64_t> merged_cols, merged_counts;
+        merged_cols.reserve(cols.size() + buffer.size());
+        merged_counts.reserve(cols.size() + buffer.size());
+
+        size_t i = 0, j = 0;
+        while (i < cols.size() || j < buffer.size())
+        {
+            if (j == buffer.size() || (i < cols.size() && cols[i] < buffer[j].first))
+            {
+                merged_cols.push_back(cols[i]);
+                merged_counts.push_back(counts[i]);
+                ++i;
+                continue;
+            }
+
+            const uint64_t value = buffer[j].first;
+            uint64_t count = 0;
+            while (j < buffer.size() && buffer[j].first == value)
+            {
+                count += buffer[j].second;
+                ++j;
+            }
+
+            if (i < cols.size() && cols[i] == value)
+            {
+                count += counts[i];
+                ++i;
+            }
+
+            merged_cols.push_back(value);
+            merged_counts.push_back(count);
+        }
+
+        buffer.clear();
+        merged_cols.shrink_to_fit();
+        merged_counts.shrink_to_fit();
+        std::swap(cols, merged_cols);
+        std::swap(counts, merged_counts);
+
+        if (max_distinct > 0 && cols.size() >= max_distinct)
+            spill();
+    }
+
+    // Keeps the errno of the first failure
+    void fail(const int code)
+    {
+        if (!error)
+            error = code ? code : EIO;
+    }
+
+    // Creates an anonymous temporary file for a run
+    FILE* open_run()
+    {
+        std::string path = tmp_dir + "/amq_kmers_XXXXXX";
+        const int fd = mkstemp(&path[0]);
+        if (fd < 0)
+        {
+            fail(errno);
+            return nullptr;
+        }
+        unlink(path.c_str());
+
+        FILE* run = fdopen(fd, "w+b");
+        if (!run)
+        {
+            fail(errno);
+            close(fd);
+        }
+        return run;
+    }
+
+    bool write_pair(FILE* run, const uint64_t rank, const uint64_t count)
+    {
+        const uint64_t pair[2] = {rank, count};
+        if (fwrite(pair, sizeof(uint64_t), 2, run) != 2)
+        {
+            fail(errno);
+            return false;
+        }
+        return true;
+    }
+
+    // Adds a written run, or closes it if writing it has failed
+    void commit_run(FILE* run)
+    {
+        if (!error && fflush(run) != 0)
+            fail(errno);
+
+        if (error)
+            fclose(run);
+        else
+            runs.push_back(run);
+    }
+
+    // Moves the distinct k-mers to a run
+    void spill()
+    {
+        FILE* run = open_run();
+        if (!run)
+            return;
+
+        for (size_t i = 0; i < cols.size() && !error; ++i)
+            write_pair(run, cols[i], counts[i]);
+        commit_run(run);
+
+        std::vector<uint64_t>().swap(cols);
+        std::vector<uint64_t>().swap(counts);
+
+        if (runs.size() >= max_runs)
+            cascade();
+    }
+
+    // Merges all the runs into a single one
+    void cascade()
+    {
+        FILE* run = open_run();
+        if (!run)
+            return;
+
+        merge_runs([this, run](uint64_t rank, uint64_t count) { write_pair(run, rank, count); });
+        for (FILE* merged : runs)
+            fclose(merged);
+        runs.clear();
+        commit_run(run);
+    }
+
+    void finalize()
+    {
+        flush();
+        if (!runs.empty() && !cols.empty())
+            spill();
+    }
+
+    // k-way merge of the spilled runs, emit is called once per distinct k-mer
+    template <typename Function>
+    void merge_runs(Function emit)
+    {
+        typedef std::pair<uint64_t, size_t> heap_item;
+        std::priority_queue<heap_item, std::vector<heap_item>, std::greater<heap_item>> heap;
+
+        std::vector<run_reader_t> readers;
+        for (FILE* run : runs)
+        {
+            rewind(run);
+            readers.push_back(run_reader_t(run));
+            if (readers.back().next())
+                heap.push(heap_item(readers.back().rank, readers.size() - 1));
+        }
+
+        while (!heap.empty() && !error)
+        {
+            const uint64_t rank = heap.top().first;
+            uint64_t count = 0;
+            while (!heap.empty() && heap.top().first == rank)
+            {
+                run_reader_t& reader = readers[heap.top().second];
+                const size_t index = heap.top().second;
+                heap.pop();
+
+                count += reader.count;
+                if (reader.next())
+                    heap.push(heap_item(reader.rank, index));
+            }
+
+            emit(rank, count);
+        }
+
+        // a run that ended by a read error is truncated
+        for (FILE* run : runs)
+        {
+            if (ferror(run))
+                fail(EIO);
+        }
+    }
+
+    size_t size()
+    {
+        finalize();
+        if (error)
+            return 0;
+        if (runs.empty())
+            return cols.size();
+
+        size_t result = 0;
+        merge_runs([&result](uint64_t, uint64_t) { ++result; });
+        return result;
+    }
+
+    // Writes sorted ranks of the distinct k-mers, emit converts their counts
+    template <typename Function>
+    void result(uint64_t* out_cols, Function emit)
+    {
+        finalize();
+        if (error)
+            return;
+        if (runs.empty())
+        {
+            for (size_t i = 0; i < cols.size(); ++i)
+            {
+                out_cols[i] = cols[i];
+                emit(i, counts[i]);
+            }
+            return;
+        }
+
+        size_t i = 0;
+        merge_runs([&](uint64_t rank, uint64_t count) {
+            out_cols[i] = rank;
+            emit(i, count);
+            ++i;
+        });
+    }
+};
+
 extern "C" {
     void count_kmer_ranks(const uint8_t* in, uint64_t* out, const size_t n, const uint8_t k)
     {
         kmer_ranks(in, out, n, k);
     }
+
+    kmer_counter_t* kmer_counter_new(const uint8_t k, const size_t memory_budget, const char* tmp_dir)
+    {
+        return new kmer_counter_t(k, memory_budget, tmp_dir);
+    }
+
+    void kmer_counter_add(kmer_counter_t* counter, const uint8_t* in, const size_t n)
+    {
+        counter->add(in, n, nullptr);
+    }
+
+    void kmer_counter_add_weighted(kmer_counter_t* counter, const uint8_t* in, const size_t n,
+                                   const uint64_t* weights)
+    {
+        counter->add(in, n, weights);
+    }
+
+    size_t kmer_counter_size(kmer_counter_t* counter)
+    {
+        return counter->size();
+    }
+
+    // relative frequencies of the k-mers
+    void kmer_counter_result(kmer_counter_t* counter, uint64_t* cols, double* data)
+    {
+        const double total = counter->total;
+        counter->result(cols, [data, total](size_t i, uint64_t count) { data[i] = count / total; });
+    }
+
+    // raw counts of the k-mers, returns their total
+    uint64_t kmer_counter_counts(kmer_counter_t* counter, uint64_t* cols, uint64_t* counts)
+    {
+        counter->result(cols, [counts](size_t i, uint64_t count) { counts[i] = count; });
+        return counter->total;
+    }
+
+    // errno of the failure of the counter, 0 if there is none
+    int kmer_counter_error(kmer_counter_t* counter)
+    {
+        return counter->error;
+    }
+
+    void kmer_counter_free(kmer_counter_t* counter)
+    {
+        delete counter;
+    }
 }
@@ -0,0 +1,272 @@
+import os
+import fcntl
+import shutil
+import numpy as np
+from contextlib import contextmanager
+from amquery.core.distance.kmers_distr.sparse_array import SparseArray, CompactSparseArray
+from amquery.utils.iof import append_lines, make_sure_exists
+
+
+_COLS_FILE = 'cols'
+_DATA_FILE = 'data'
+_ENTROPY_FILE = 'entropy'
+_DELTAS_FILE = 'deltas'
+_COUNTS_FILE = 'counts'
+_COMPACT = 'compact'
+_ROWS_FILE = 'rows'
+_LOCK_FILE = 'lock'
+
+
+def _size(filename, itemsize=8):
+    """
+    :param filename: str
+    :param itemsize: int
+    :return: int, number of values in the file
+    """
+    return os.path.getsize(filename) // itemsize if os.path.exists(filename) else 0
+
+
+def _finish_compaction(path):
+    """
+    Complete a compaction interrupted after the compacted store was written
+    :param path: str
+    :return: None
+    """
+    old_path = path + '.old'
+    if not os.path.exists(old_path):
+        return
+    if not os.path.exists(path):
+        os.rename(path + '.tmp', path)
+    shutil.rmtree(old_path)
+
+
+def _row(name, start, end, mass, compact):
+    """
+    :return: str, a line of the rows file
+    """
+    if compact:
+        return '%s\t%d\t%d\t%d\t%s' % (name, start, end, mass, _COMPACT)
+    return '%s\t%d\t%d\t%r' % (name, start, end, float(mass))
+
+
+def _memmap(filename, dtype, size):
+    if size == 0:
+        return np.array([], dtype=dtype)
+    return np.memmap(filename, dtype=dtype, mode='r', shape=(size,))
+
+
+class ProfileStore:
+    """
+    Append-only CSR-like storage of the k-mer profiles of an index.
+    Columns, values and -p * log2(p) entropy terms of all profiles are
+    concatenated in flat binary files that are opened with np.memmap;
+    the rows file maps sample names to [start, end) ranges in them and
+    keeps the total mass of every profile. Compact profiles are kept in
+    their own uint32 deltas and counts files, their rows are marked and
+    keep the total count instead. A row is committed by appending its
+    line to the rows file, so a crashed append leaves only unreferenced
+    data behind. Appends from several processes are serialized by a lock file.
+    The space of the shadowed profiles is reclaimed by compact()
+    """
+    _instances = {}
+
+    def __init__(self, path):
+        """
+        :param path: str
+        """
+        self.path = path
+        self._rows = {}
+        # the rows file read so far, its inode changes when it is compacted
+        self._rows_inode = None
+        self._rows_offset = 0
+        self._cols = np.array([], dtype=np.uint64)
+        self._data = np.array([], dtype=np.float64)
+        self._entropy = np.array([], dtype=np.float64)
+        self._deltas = np.array([], dtype=np.uint32)
+        self._counts = np.array([], dtype=np.uint32)
+        _finish_compaction(path)
+        self.refresh()
+
+    @classmethod
+    def open(cls, path):
+        """
+        :param path: str
+        :return: ProfileStore shared by all the callers within a process
+        """
+        path = os.path.abspath(path)
+        if path not in cls._instances:
+            cls._instances[path] = cls(path)
+        return cls._instances[path]
+
+    def _file(self, name):
+        return os.path.join(self.path, name)
+
+    def refresh(self):
+        """
+        Read the rows committed by other processes since the last refresh.
+        The rows file is read anew only if it was replaced by a compaction
+        :return: None
+        """
+        try:
+            stat = os.stat(self._file(_ROWS_FILE))
+        except FileNotFoundError:
+            return
+
+        if stat.st_ino != self._rows_inode or stat.st_size < self._rows_offset:
+            self._rows = {}
+            self._rows_inode = stat.st_ino
+            self._rows_offset = 0
+        elif stat.st_size == self._rows_offset:
+            return
+
+        with open(self._file(_ROWS_FILE), 'rb') as f:
+            f.seek(self._rows_offset)
+            tail = f.read(stat.st_size - self._rows_offset)
+
+        # the last line may be incomplete after a crash
+        size = tail.rfind(b'\n') + 1
+        for line in tail[:size].decode().splitlines():
+            fields = line.split('\t')
+            name, start, end, mass = fields[:4]
+            compact = len(fields) > 4 and fields[4] == _COMPACT
+            self._rows[name] = (int(start), int(end), float(mass), compact)
+
+        self._rows_offset += size
+        self._remap()
+
+    def _remap(self):
+        size = max((end for _, end, _, compact in self._rows.values() if not compact), default=0)
+        compact_size = max((end for _, end, _, compact in self._rows.values() if compact), default=0)
+        self._deltas = _memmap(self._file(_DELTAS_FILE), np.uint32, compact_size)
+        self._counts = _memmap(self._file(_COUNTS_FILE), np.uint32, compact_size)
+        self._cols = _memmap(self._file(_COLS_FILE), np.uint64, size)
+        self._data = _memmap(self._file(_DATA_FILE), np.float64, size)
+        self._entropy = _memmap(self._file(_ENTROPY_FILE), np.float64, size)
+
+    def __contains__(self, name):
+        if name not in self._rows:
+            self.refresh()
+        return name in self._rows
+
+    def __len__(self):
+        return len(self._rows)
+
+    def __getitem__(self, name):
+        """
+        :param name: str
+        :return: Union[SparseArray, CompactSparseArray], a zero-copy view of the stored profile
+        """
+        if name not in self:
+            raise KeyError(name)
+
+        start, end, mass, compact = self._rows[name]
+        if compact:
+            if end > len(self._deltas):
+                self._remap()
+            return CompactSparseArray(self._deltas[start:end], self._counts[start:end], int(mass))
+
+        if end > len(self._cols):
+            self._remap()
+        return SparseArray(self._cols[start:end], self._data[start:end], self._entropy[start:end], mass)
+
+    @contextmanager
+    def _lock(self):
+        with open(self._file(_LOCK_FILE), 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    @staticmethod
+    def _append_arrays(files):
+        """
+        :param files: Sequence[Tuple[str, np.array]] files with the arrays to append to them
+        :return: int, the position of the arrays in the files
+        """
+        # the files are aligned to the same length, in case an earlier append was interrupted
+        start = max(_size(filename, array.itemsize) for filename, array in files)
+        for filename, array in files:
+            with open(filename, 'ab') as f:
+                f.truncate(start * array.itemsize)
+                array.tofile(f)
+        return start
+
+    def append(self, name, profile):
+        """
+        Store the profile of a sample. A profile stored under the same name
+        before is shadowed by the new one
+        :param name: str
+        :param profile: Union[SparseArray, CompactSparseArray]
+        :return: None
+        """
+        make_sure_exists(self.path)
+        compact = isinstance(profile, CompactSparseArray)
+        if compact:
+            files = [(self._file(_DELTAS_FILE), np.ascontiguousarray(profile.deltas, dtype=np.uint32)),
+                     (self._file(_COUNTS_FILE), np.ascontiguousarray(profile.counts, dtype=np.uint32))]
+            mass = profile.total
+        else:
+            files = [(self._file(_COLS_FILE), np.ascontiguousarray(profile.cols, dtype=np.uint64)),
+                     (self._file(_DATA_FILE), np.ascontiguousarray(profile.data, dtype=np.float64)),
+                     (self._file(_ENTROPY_FILE), np.ascontiguousarray(profile.entropy, dtype=np.float64))]
+            mass = profile.mass
+
+        with self._lock():
+            start = self._append_arrays(files)
+
+            end = start + len(profile)
+            append_lines(self._file(_ROWS_FILE), [_row(name, start, end, mass, compact)])
+
+        self._rows[name] = (start, end, float(mass), compact)
+
+    @property
+    def garbage(self):
+        """
+        :return: float, share of the stored values that no row refers to:
+        the shadowed profiles and the ones of the interrupted appends
+        """
+        size = _size(self._file(_COLS_FILE)) + _size(self._file(_DELTAS_FILE), 4)
+        used = sum(end - start for start, end, _, _ in self._rows.values())
+        return 1.0 - used / size if size > 0 else 0.0
+
+    def compact(self):
+        """
+        Rewrite the store with the profiles of its rows only. The store is
+        written aside and then replaces the old one; appends of other
+        processes must not run meanwhile
+        :return: None
+        """
+        if not os.path.exists(self.path):
+            return
+
+        with self._lock():
+            self.refresh()
+            tmp_path = self.path + '.tmp'
+            if os.path.exists(tmp_path):
+                shutil.rmtree(tmp_path)
+            make_sure_exists(tmp_path)
+
+            arrays = {False: [(_COLS_FILE, self._cols), (_DATA_FILE, self._data), (_ENTROPY_FILE, self._entropy)],
+                      True: [(_DELTAS_FILE, self._deltas), (_COUNTS_FILE, self._counts)]}
+            sizes = {False: 0, True: 0}
+            files = {filename: open(os.path.join(tmp_path, filename), 'wb')
+                     for filename, _ in arrays[False] + arrays[True]}
+            try:
+                with open(os.path.join(tmp_path, _ROWS_FILE), 'w') as rows_file:
+                    # the profiles keep their order, the files are read sequentially
+                    for name, (start, end, mass, compact) in sorted(self._rows.items(), key=lambda row: row[1]):
+                        for filename, array in arrays[compact]:
+                            np.ascontiguousarray(array[start:end]).tofile(files[filename])
+                        rows_file.write(_row(name, sizes[compact], sizes[compact] + end - start, mass, compact) + '\n')
+                        sizes[compact] += end - start
+            finally:
+                for f in files.values():
+                    f.close()
+
+            old_path = self.path + '.old'
+            os.rename(self.path, old_path)
+            os.rename(tmp_path, self.path)
+            shutil.rmtree(old_path)
+
+        self.refresh()
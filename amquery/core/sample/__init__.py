@@ -1,4 +1,4 @@
-from ._sample import Sample
+from ._sample import Sample, KmerIndexCache
 
 
 __license__ = "MIT"
@@ -1,21 +1,19 @@
 import os
 import numpy as np
-import functools
 import itertools
-import operator as op
 import joblib
 from Bio import SeqIO
-from amquery.utils.decorators import hide_field
-from amquery.utils.config import get_kmers_dir, get_sample_dir
-from amquery.utils.iof import make_sure_exists
+from amquery.utils.decorators import hide_field, singleton
+from amquery.utils.lru_cache import LruCache
+from amquery.utils.config import get_kmers_dir, get_sample_dir, get_profiles_dir
+from amquery.utils.iof import make_sure_exists, get_file_format, open_file, iter_blocks
+from amquery.core.profile_store import ProfileStore
 
 
 class SampleFile:
     def __init__(self, path: str):
         self._path = path
-        self._format = os.path.splitext(os.path.basename(path))[1][1:]
-        if self._format == 'fna':
-            self._format = 'fasta'
+        self._format = get_file_format(os.path.basename(path))
 
     @property
     def path(self):
@@ -29,29 +27,209 @@ class SampleFile:
 _alphabet = dict(zip([char for char in ('A', 'C', 'G', 'T')],
                      itertools.count()))
 
+# any byte outside of the alphabet is encoded with this code
+_AMBIGUOUS = len(_alphabet)
+_BLOCK_SIZE = 1 << 24
 
-def _isvalid(sequence):
-    return functools.reduce(op.and_, [char in _alphabet for char in sequence])
+_codes = np.full(256, _AMBIGUOUS, dtype=np.uint8)
+for _char, _code in _alphabet.items():
+    _codes[ord(_char)] = _code
 
 
-def _validate(sequence):
-    return sequence if _isvalid(sequence) else []
+def _encode(raw):
+    """
+    :param raw: bytes
+    :return: np.array
+    """
+    return _codes[np.frombuffer(raw, dtype=np.uint8)]
 
 
-def _transform(sequence):
-    return np.array([_alphabet[char] for char in sequence], dtype=np.uint8)
+def _split_ambiguous(codes):
+    """
+    Split encoded sequences into the runs of unambiguous bases
+    :param codes: np.array
+    :return: Iterable[np.array]
+    """
+    valid = np.concatenate(([False], codes < _AMBIGUOUS, [False]))
+    bounds = np.flatnonzero(valid[1:] != valid[:-1])
+    for start, end in zip(bounds[::2], bounds[1::2]):
+        yield codes[start:end]
+
+
+def _read_fasta_blocks(path, block_size=_BLOCK_SIZE):
+    """
+    Read a fasta file by large blocks, cutting them at the record boundaries
+    :param path: str
+    :param block_size: int
+    :return: Iterable[bytes]
+    """
+    buf = bytearray()
+    for chunk in iter_blocks(path, block_size):
+        buf += chunk
+        cut = buf.rfind(b'\n>') + 1
+        if cut > 0:
+            yield bytes(buf[:cut])
+            del buf[:cut]
+
+    if buf:
+        yield bytes(buf)
+
+
+def _decode_fasta_block(block):
+    """
+    Encode a block of fasta records into a single array of codes.
+    Header lines are encoded as ambiguous bases, so they separate the records
+    :param block: bytes
+    :return: np.array
+    """
+    raw = np.frombuffer(block, dtype=np.uint8)
+    codes = _codes[raw]
+
+    newlines = np.flatnonzero(raw == ord('\n'))
+    line_starts = np.concatenate(([0], newlines + 1))
+    line_starts = line_starts[line_starts < len(raw)]
+    header_starts = line_starts[raw[line_starts] == ord('>')]
+    line_ends = np.append(newlines, len(raw))
+    header_ends = line_ends[np.searchsorted(line_ends, header_starts)]
+
+    header_mask = np.zeros(len(raw) + 1, dtype=np.int8)
+    header_mask[header_starts] += 1
+    header_mask[header_ends] -= 1
+    codes[np.cumsum(header_mask[:-1]) > 0] = _AMBIGUOUS
+
+    return codes[(raw != ord('\n')) & (raw != ord('\r'))]
+
+
+def _read_fastq_blocks(path, block_size=_BLOCK_SIZE):
+    """
+    Read a fastq file by large blocks, cutting them at the record boundaries.
+    Records are expected to take four lines, the blocks of other ones are
+    rejected by _decode_fastq_block
+    :param path: str
+    :param block_size: int
+    :return: Iterable[bytes]
+    """
+    buf = bytearray()
+    for chunk in iter_blocks(path, block_size):
+        buf += chunk
+        raw = np.frombuffer(buf, dtype=np.uint8)
+        newlines = np.flatnonzero(raw == ord('\n'))
+        del raw
+
+        records = len(newlines) // 4
+        if records > 0:
+            # blank lines after the last record stay in the buffer:
+            # they either end the file or start a malformed record
+            line = 4 * records - 1
+            while line >= 0 and buf[newlines[line - 1] + 1 if line > 0 else 0:newlines[line]] in (b'', b'\r'):
+                line -= 1
+            if line >= 0:
+                cut = newlines[line - line % 4 + 3] + 1
+                yield bytes(buf[:cut])
+                del buf[:cut]
+
+    if buf:
+        yield bytes(buf)
+
+
+def _check_fastq_block(block, raw, line_starts, line_ends):
+    """
+    Make sure the block is made of whole four-line records: a header, a
+    sequence, a separator and qualities of the length of the sequence
+    :param block: bytes
+    :param raw: np.array
+    :param line_starts: np.array
+    :param line_ends: np.array
+    :return: None
+    """
+    def fail(line, reason):
+        record = block[line_starts[line - line % 4]:line_ends[line]].decode(errors='replace')
+        raise ValueError("Malformed fastq record, %s: %r" % (reason, record))
+
+    if len(line_starts) % 4 != 0:
+        fail(len(line_starts) - 1, "truncated record")
+
+    headers = np.flatnonzero(raw[line_starts[0::4]] != ord('@'))
+    if len(headers) > 0:
+        fail(4 * headers[0], "no '@' header")
+
+    separators = np.flatnonzero(raw[line_starts[2::4]] != ord('+'))
+    if len(separators) > 0:
+        fail(4 * separators[0] + 2, "no '+' separator")
+
+    # line ends of the sequences and the qualities may be \r\n alike
+    lengths = line_ends - line_starts
+    mismatches = np.flatnonzero(lengths[1::4] != lengths[3::4])
+    if len(mismatches) > 0:
+        fail(4 * mismatches[0] + 3, "sequence and quality lengths differ")
+
+
+def _decode_fastq_block(block):
+    """
+    Encode a block of fastq records into a single array of codes.
+    All lines except sequences are encoded as ambiguous bases, so they separate the records
+    :param block: bytes
+    :return: np.array
+    """
+    raw = np.frombuffer(block, dtype=np.uint8)
+    codes = _codes[raw]
+
+    newlines = np.flatnonzero(raw == ord('\n'))
+    line_starts = np.concatenate(([0], newlines + 1))
+    line_ends = np.append(newlines, len(raw))
+    line_ends = line_ends[line_starts < len(raw)]
+    line_starts = line_starts[line_starts < len(raw)]
+
+    # empty lines at the end of the file do not make a record, unless they
+    # are the sequence and qualities of an empty read
+    blank = (line_ends - line_starts == 0) | (raw[np.minimum(line_starts, len(raw) - 1)] == ord('\r'))
+    filled = np.flatnonzero(~blank)
+    lines = min(len(line_starts), (filled[-1] // 4 + 1) * 4 if len(filled) > 0 else 0)
+    line_starts, line_ends = line_starts[:lines], line_ends[:lines]
+    _check_fastq_block(block, raw, line_starts, line_ends)
+
+    seq_mask = np.zeros(len(raw) + 1, dtype=np.int8)
+    seq_mask[line_starts[1::4]] += 1
+    seq_mask[line_ends[1::4]] -= 1
+    codes[np.cumsum(seq_mask[:-1]) <= 0] = _AMBIGUOUS
+
+    return codes[(raw != ord('\n')) & (raw != ord('\r'))]
+
+
+_block_readers = {'fasta': (_read_fasta_blocks, _decode_fasta_block),
+                  'fastq': (_read_fastq_blocks, _decode_fastq_block)}
+
+
+@singleton
+class KmerIndexCache(LruCache):
+    """
+    K-mer profiles of the samples, shared by all the Sample objects of a process.
+    Only the profiles read into memory count against its size, the views of
+    the memory-mapped profile store are paged by the OS
+    """
+    def __init__(self, max_size=0):
+        """
+        :param max_size: int, bytes
+        """
+        super(KmerIndexCache, self).__init__(max_size, sizeof=lambda profile: profile.resident_nbytes)
 
 
 def _parse_sample_name(sample_file):
-    with open(sample_file, 'r') as f:
-        line = ' '
-        while line[0] != '>':
-            line = f.readline()
-        
-        return line.split('_')[0].split('>')[1].strip()
-        
+    with open_file(sample_file, 'rt') as f:
+        for line_number, line in enumerate(f, 1):
+            if line[0] in ('>', '@'):
+                sample_name = line[1:].split('_')[0].strip()
+                if not sample_name:
+                    raise ValueError("%s:%d: no sample name in the header %r" %
+                                     (sample_file, line_number, line.rstrip('\r\n')))
+                return sample_name
+
+    raise ValueError("%s: no '>' or '@' header" % sample_file)
+
 
 class Sample:
+    _kmer_index_changed = False
+
     def __init__(self, sample_file):
         self._name = _parse_sample_name(sample_file)
         self._source_file = SampleFile(sample_file)
@@ -78,8 +256,13 @@ class Sample:
         sample = joblib.load(object_file)
         return sample
 
-    def load_kmer_index(self):
-        self._kmer_index = joblib.load(Sample.make_kmer_index_obj_filename(self.source_file.path))
+    def _load_kmer_index(self):
+        store = ProfileStore.open(get_profiles_dir())
+        if self.name in store:
+            return store[self.name]
+        else:
+            # indices built before the profile store keep a pickle per sample
+            return joblib.load(Sample.make_kmer_index_obj_filename(self.source_file.path))
 
     @hide_field("_kmer_index")
     def _save(self):
@@ -88,10 +271,16 @@ class Sample:
 
     def save(self):
         make_sure_exists(get_sample_dir())
+
+        # only dump a k-mer index that is not on the disk yet
+        kmer_index_changed, self._kmer_index_changed = self._kmer_index_changed, False
         self._save()
 
-        if self._kmer_index:
-            joblib.dump(self._kmer_index, Sample.make_kmer_index_obj_filename(self.source_file.path))
+        if kmer_index_changed and self._kmer_index is not None:
+            ProfileStore.open(get_profiles_dir()).append(self.name, self._kmer_index)
+            # from now on the profile is served by the shared cache
+            self._kmer_index = None
+            KmerIndexCache.instance().discard(self.name)
 
     @property
     def source_file(self):
@@ -99,16 +288,47 @@ class Sample:
 
     @property
     def kmer_index(self):
-        if not self._kmer_index:
-            self.load_kmer_index()
+        """
+        A profile that is not saved yet is kept by the sample itself,
+        the saved ones are loaded through the KmerIndexCache
+        :return: SparseArray
+        """
+        if self._kmer_index is None:
+            return KmerIndexCache.instance().get(self.name, self._load_kmer_index)
 
         return self._kmer_index
 
     def set_kmer_index(self, index):
         self._kmer_index = index
+        self._kmer_index_changed = True
+
+    def iter_blocks(self):
+        """
+        Iterate over the encoded blocks of reads. Reads inside a block are
+        separated by ambiguous base codes
+        :return: Iterable[np.array]
+        """
+        if self.source_file.file_format in _block_readers:
+            read_blocks, decode_block = _block_readers[self.source_file.file_format]
+            for block in read_blocks(self.source_file.path):
+                yield decode_block(block)
+        else:
+            with open_file(self.source_file.path, 'rt') as f:
+                for seq_rec in SeqIO.parse(f, self.source_file.file_format):
+                    yield _encode(str(seq_rec.seq).encode())
+
+    def iter_seq_chunks(self):
+        """
+        Iterate over the encoded reads grouped by the blocks they were read by
+        :return: Iterable[Iterable[np.array]]
+        """
+        for codes in self.iter_blocks():
+            yield _split_ambiguous(codes)
 
     def iter_seqs(self):
-        seqs_records = SeqIO.parse(open(self.source_file.path),
-                                   self.source_file.file_format)
-        for seq_rec in seqs_records:
-            yield _transform(_validate(seq_rec.seq))
+        """
+        Iterate over the encoded reads. Reads are split at ambiguous bases,
+        each yielded array is contiguous
+        :return: Iterable[np.array]
+        """
+        return itertools.chain.from_iterable(self.iter_seq_chunks())
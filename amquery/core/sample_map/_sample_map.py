@@ -1,27 +1,57 @@
 import os
 import json
-from amquery.utils.iof import make_sure_exists
-from amquery.utils.config import get_samplemap_path, get_sample_dir, get_kmers_dir
+from collections.abc import MutableMapping
+from amquery.utils.config import get_samplemap_path, get_sample_dir
 from amquery.core.sample import Sample
 
 
-class SampleMap(dict):
+class SampleMap(MutableMapping):
+    """
+    Sample name to Sample mapping backed by the index manifest.
+    Loaded maps only know the sample names; a Sample object is
+    materialized on the first access to it
+    """
     def __init__(self, *args, **kwargs):
-        super(SampleMap, self).__init__(*args, **kwargs)
+        self._samples = dict(*args, **kwargs)
 
     @staticmethod
     def load():
         with open(get_samplemap_path()) as json_data:
             hash_list = json.load(json_data)
-            return SampleMap({id: Sample.load(os.path.join(get_sample_dir(), id)) for id in hash_list})
+            return SampleMap.fromkeys(hash_list)
 
-    def _save(self):
-        make_sure_exists(get_kmers_dir())
+    @classmethod
+    def fromkeys(cls, names, value=None):
+        return cls(dict.fromkeys(names, value))
+
+    def __getitem__(self, name):
+        sample = self._samples[name]
+        if sample is None:
+            sample = Sample.load(os.path.join(get_sample_dir(), name))
+            self._samples[name] = sample
+        return sample
+
+    def __setitem__(self, name, sample):
+        self._samples[name] = sample
+
+    def __delitem__(self, name):
+        del self._samples[name]
+
+    def __contains__(self, name):
+        return name in self._samples
 
-        for sample in self.samples:
+    def __iter__(self):
+        return iter(self._samples)
+
+    def __len__(self):
+        return len(self._samples)
+
+    def _save(self):
+        # samples that were never materialized are already on the disk
+        for sample in self.loaded_samples:
             sample.save()
 
-        hash_list = [sample.name for sample in self.samples]
+        hash_list = list(self._samples.keys())
         with open(get_samplemap_path(), 'w') as outfile:
             json.dump(hash_list, outfile)
 
@@ -36,6 +66,10 @@ class SampleMap(dict):
     def samples(self):
         return self.values()
 
+    @property
+    def loaded_samples(self):
+        return [sample for sample in self._samples.values() if sample is not None]
+
     @property
     def paths(self):
         return [sample.kmer_index for sample in self.values()]
@@ -1,124 +1,384 @@
 #!/usr/bin/env python3
 
+import os
 import numpy as np
 import itertools
 import json
 import random
 from amquery.core.storage.vptree.search import neighbors
 from amquery.utils.benchmarking import measure_time
-from amquery.utils.config import get_storage_path
+from amquery.utils.config import get_storage_path, get_vptree_path
 from amquery.core.storage import Storage
 
 
+def _distances(func, points, vp):
+    """
+    :param func: Callable
+    :param points: Sequence
+    :param vp: Any
+    :return: np.array
+    """
+    # one-vs-many distances are computed by a single batch, if supported
+    if hasattr(func, 'one_to_many'):
+        return np.asarray(func.one_to_many(vp, points))
+
+    return np.array(list(map(func, points, itertools.repeat(vp))))
+
+
+_NONE = -1
+_INDEX_DTYPE = np.dtype('<i8')
+_MEDIAN_DTYPE = np.dtype('<f8')
+_OFFSET_DTYPE = np.dtype('<u8')
+
+# The binary format: a header of _HEADER_FIELDS uint64 values, that are
+# the magic, the format version, the number of nodes, the number of names
+# and the size of the names in bytes, then the vp, median, left, right
+# and size arrays of the nodes, the offsets of the names and the utf-8
+# names. Every array starts at a multiple of 8 bytes
+_MAGIC = np.frombuffer(b'AMQVPTRE', dtype=_OFFSET_DTYPE)[0]
+# bump it whenever the layout changes
+_FORMAT_VERSION = 1
+_HEADER_FIELDS = 8
+
+
+class _Names:
+    """
+    Sample names of a binary tree, decoded one by one on access
+    """
+    def __init__(self, offsets, data):
+        """
+        :param offsets: np.array, the name i is data[offsets[i]:offsets[i + 1]]
+        :param data: np.array of uint8, utf-8 names
+        """
+        self.offsets = offsets
+        self.data = data
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return bytes(self.data[self.offsets[i]:self.offsets[i + 1]]).decode()
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+
 # Vantage-point tree
 class BaseVpTree:
-    def __init__(self, vp, size, median, left, right):
-        self.vp = vp
-        self.size = size
-        self.median = median
-        self.left = left
-        self.right = right
-    
+    """
+    Vantage-point tree kept in parallel arrays, a node per array element.
+    The root is the node 0; a node has the id of its vantage-point sample,
+    the median distance from it to the points of the subtree, the node
+    indices of the left (<= median) and right (> median) subtrees, _NONE
+    if missing, and the size of the subtree. A leaf has the NaN median.
+    Sample ids index the names, so nothing is recursive and the tree can
+    be stored as a single binary blob. A tree loaded from the blob keeps
+    read-only views of it and copies the arrays on the first insert
+    """
+    _INITIAL_CAPACITY = 64
+
+    def __init__(self, names=(), vp=None, median=None, left=None, right=None, size=None):
+        """
+        :param names: Sequence[str], sample names by their ids
+        :param vp: np.array, sample id of the vantage point of every node
+        :param median: np.array
+        :param left: np.array, node indices
+        :param right: np.array, node indices
+        :param size: np.array, sizes of the subtrees
+        """
+        self.names = names if isinstance(names, _Names) else list(names)
+        if vp is None:
+            self._n_nodes = 0
+            self.vp = np.full(self._INITIAL_CAPACITY, _NONE, dtype=_INDEX_DTYPE)
+            self.median = np.full(self._INITIAL_CAPACITY, np.nan, dtype=_MEDIAN_DTYPE)
+            self.left = np.full(self._INITIAL_CAPACITY, _NONE, dtype=_INDEX_DTYPE)
+            self.right = np.full(self._INITIAL_CAPACITY, _NONE, dtype=_INDEX_DTYPE)
+            self.size = np.zeros(self._INITIAL_CAPACITY, dtype=_INDEX_DTYPE)
+        else:
+            self._n_nodes = len(vp)
+            self.vp, self.median, self.left, self.right, self.size = vp, median, left, right, size
+
+    def __len__(self):
+        """
+        :return: int, number of the points in the tree
+        """
+        return int(self.size[0]) if self._n_nodes > 0 else 0
+
+    @property
+    def n_nodes(self):
+        return self._n_nodes
+
+    def _grow(self, capacity):
+        n = self._n_nodes
+        for name, fill in [('vp', _NONE), ('median', np.nan), ('left', _NONE), ('right', _NONE), ('size', 0)]:
+            array = getattr(self, name)
+            grown = np.full(capacity, fill, dtype=array.dtype)
+            grown[:n] = array[:n]
+            setattr(self, name, grown)
+
+    def _reserve(self, n_nodes):
+        """
+        Make the arrays writable and large enough for the number of nodes
+        :param n_nodes: int
+        :return: None
+        """
+        capacity = len(self.vp)
+        if n_nodes > capacity or not self.vp.flags.writeable:
+            self._grow(max(self._INITIAL_CAPACITY, n_nodes, 2 * capacity))
+
+    def _new_node(self, vp, size):
+        """
+        :param vp: int, sample id
+        :param size: int
+        :return: int, index of the node
+        """
+        node = self._n_nodes
+        self._reserve(node + 1)
+
+        self.vp[node] = vp
+        self.size[node] = size
+        self._n_nodes += 1
+        return node
+
+    def _add_name(self, name):
+        """
+        :param name: str
+        :return: int, sample id
+        """
+        if isinstance(self.names, _Names):
+            self.names = list(self.names)
+        self.names.append(name)
+        return len(self.names) - 1
+
     def build(self, func, points):
         """
         :param func: Callable
-        :param points: np.array
+        :param points: Sequence[str], sample names
         :return: BaseVpTree
         """
-        if len(points) == 1:
-            self.vp = points[0]
-            self.size = 1
-        elif len(points) > 0:
+        if len(points) == 0:
+            return self
+
+        ids = np.array([self._add_name(point) for point in points], dtype=_INDEX_DTYPE)
+        names = np.array(self.names, dtype=object)
+
+        # (parent node, whether it is the left child, sample ids of the subtree)
+        stack = [(_NONE, True, ids)]
+        while stack:
+            parent, is_left, ids = stack.pop()
+
             # Random vantage-point
-            vpi = random.randrange(len(points))
-            self.vp = points[vpi]
-            self.size = 1
-            points = np.delete(points, vpi, 0)
+            vpi = random.randrange(len(ids))
+            node = self._new_node(ids[vpi], len(ids))
+            if parent != _NONE:
+                (self.left if is_left else self.right)[parent] = node
 
-            dists = map(func, points, itertools.repeat(self.vp))
-            distarr = np.array(list(dists))
-            self.median = np.median(distarr)
+            ids = np.delete(ids, vpi)
+            if len(ids) == 0:
+                continue
 
-            # Subtree construction
-            leftside = [points[i] for i in range(len(points))
-                        if distarr[i] <= self.median]
-            rightside = [points[i] for i in range(len(points))
-                         if distarr[i] > self.median]
+            distarr = _distances(func, names[ids], names[self.vp[node]])
+            self.median[node] = np.median(distarr)
 
-            if len(leftside) > 0:
-                self.left = BaseVpTree.from_points(func, leftside)
-                self.size += self.left.size
+            # Subtree construction
+            rightside = ids[distarr > self.median[node]]
+            leftside = ids[distarr <= self.median[node]]
             if len(rightside) > 0:
-                self.right = BaseVpTree.from_points(func, rightside)
-                self.size += self.right.size
+                stack.append((node, False, rightside))
+            if len(leftside) > 0:
+                stack.append((node, True, leftside))
 
         return self
 
     def insert(self, point, func):
-        if self.size == 0:
-            self.vp = point
-        else:
-            distance_value = func(point, self.vp)
-            if not self.median:
-                self.median = distance_value
-
-            if distance_value <= self.median:
-                if not self.left:
-                    self.left = BaseVpTree.from_points(func, [point])
-                else:
-                    self.left.insert(point, func)
-            else:
-                if not self.right:
-                    self.right = BaseVpTree.from_points(func, [point])
-                else:
-                    self.right.insert(point, func)
-
-        self.size += 1
+        """
+        :param point: str, sample name
+        :param func: Callable
+        :return: None
+        """
+        sample_id = self._add_name(point)
+        self._reserve(self._n_nodes + 1)
+        if self._n_nodes == 0:
+            self._new_node(sample_id, 1)
+            return
+
+        node = 0
+        while True:
+            self.size[node] += 1
+            distance_value = func(point, self.names[self.vp[node]])
+            if np.isnan(self.median[node]):
+                self.median[node] = distance_value
+
+            is_left = distance_value <= self.median[node]
+            child = (self.left if is_left else self.right)[node]
+            if child == _NONE:
+                # a new node may reallocate the arrays
+                child = self._new_node(sample_id, 1)
+                (self.left if is_left else self.right)[node] = child
+                return
+            node = child
+
+    def vp_name(self, node):
+        """
+        :param node: int
+        :return: str, name of the vantage point of the node
+        """
+        return self.names[self.vp[node]]
+
+    def _chunks(self):
+        """
+        :return: Iterable[bytes], the parts of the binary format
+        """
+        n = self._n_nodes
+        names = [name.encode() for name in self.names]
+        offsets = np.zeros(len(names) + 1, dtype=_OFFSET_DTYPE)
+        np.cumsum([len(name) for name in names], out=offsets[1:])
+        names_size = int(offsets[-1])
+
+        header = np.zeros(_HEADER_FIELDS, dtype=_OFFSET_DTYPE)
+        header[:5] = [_MAGIC, _FORMAT_VERSION, n, len(names), names_size]
+        for array in [header, self.vp[:n], self.median[:n], self.left[:n], self.right[:n],
+                      self.size[:n], offsets]:
+            yield np.ascontiguousarray(array).tobytes()
+        yield b''.join(names)
+
+    def to_bytes(self):
+        """
+        :return: bytes, the tree in the binary format
+        """
+        return b''.join(self._chunks())
+
+    @classmethod
+    def from_bytes(cls, buffer):
+        """
+        :param buffer: bytes-like, the tree in the binary format
+        :return: BaseVpTree, with read-only views of the buffer
+        """
+        header = np.frombuffer(buffer, dtype=_OFFSET_DTYPE, count=_HEADER_FIELDS)
+        magic, version, n, n_names, names_size = (int(x) for x in header[:5])
+        if magic != _MAGIC:
+            raise ValueError("Not a VP-tree file")
+        if version != _FORMAT_VERSION:
+            raise ValueError("Unsupported VP-tree format version: %d" % version)
+
+        offset = header.nbytes
+        arrays = []
+        for dtype, count in [(_INDEX_DTYPE, n), (_MEDIAN_DTYPE, n), (_INDEX_DTYPE, n), (_INDEX_DTYPE, n),
+                             (_INDEX_DTYPE, n), (_OFFSET_DTYPE, n_names + 1)]:
+            arrays.append(np.frombuffer(buffer, dtype=dtype, count=count, offset=offset))
+            offset += count * dtype.itemsize
+
+        data = np.frombuffer(buffer, dtype=np.uint8, count=names_size, offset=offset)
+        return cls(_Names(arrays.pop(), data), *arrays)
+
+    def save(self, path):
+        """
+        :param path: str
+        :return: None
+        """
+        # the file is written aside, as the tree may be a view of the file it replaces
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            for chunk in self._chunks():
+                f.write(chunk)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Map the file into the memory; the nodes and the names are read on access
+        :param path: str
+        :return: BaseVpTree
+        """
+        return cls.from_bytes(np.memmap(path, dtype=np.uint8, mode='r'))
 
     def to_dict(self):
-        json_dict = {'vp': self.vp, 'size': self.size }
-        if self.median:
-            json_dict['median'] = self.median
-        if self.left: 
-            json_dict['left'] = self.left.to_dict()
-        if self.right:
-            json_dict['right'] = self.right.to_dict()
+        """
+        :return: dict, nested nodes of the JSON storage format
+        """
+        if self._n_nodes == 0:
+            return {'vp': None, 'size': 0}
+
+        dicts = [None] * self._n_nodes
+        # children have greater indices than their parents
+        for node in reversed(range(self._n_nodes)):
+            json_dict = {'vp': self.vp_name(node), 'size': int(self.size[node])}
+            if not np.isnan(self.median[node]):
+                json_dict['median'] = float(self.median[node])
+            if self.left[node] != _NONE:
+                json_dict['left'] = dicts[self.left[node]]
+            if self.right[node] != _NONE:
+                json_dict['right'] = dicts[self.right[node]]
+            dicts[node] = json_dict
 
-        return json_dict
+        return dicts[0]
 
     @classmethod
     def from_dict(cls, json_dict):
-        vp = json_dict['vp']
-        size = json_dict['size']
-        median = json_dict['median'] if 'median' in json_dict else None
-        left = cls.from_dict(json_dict['left']) if 'left' in json_dict else None
-        right = cls.from_dict(json_dict['right']) if 'right' in json_dict else None
-        return cls(vp, size, median, left, right)
+        """
+        :param json_dict: dict, result of to_dict
+        :return: BaseVpTree
+        """
+        tree = cls()
+        if json_dict.get('vp') is None:
+            return tree
+
+        stack = [(_NONE, True, json_dict)]
+        while stack:
+            parent, is_left, json_dict = stack.pop()
+            node = tree._new_node(tree._add_name(json_dict['vp']), json_dict['size'])
+            if parent != _NONE:
+                (tree.left if is_left else tree.right)[parent] = node
+            if json_dict.get('median') is not None:
+                tree.median[node] = json_dict['median']
+
+            if 'right' in json_dict:
+                stack.append((node, False, json_dict['right']))
+            if 'left' in json_dict:
+                stack.append((node, True, json_dict['left']))
+
+        return tree
 
     @classmethod
     def from_points(cls, func, points):
         return cls.empty().build(func, points)
 
-    @classmethod
-    def from_tree(cls, tree):
-        return cls(tree.vp, tree.size, tree.median, tree.left, tree.right)
-
     @classmethod
     def empty(cls):
-        return cls(None, 0, None, None, None)
+        return cls()
 
 
 class VpTree(Storage):
     def __init__(self, vptree = None):
-        self.tree = vptree if vptree else BaseVpTree.empty()
+        self.tree = vptree if vptree is not None else BaseVpTree.empty()
+        # counters of the last search
+        self.stats = {}
 
     def save(self):
-        with open(get_storage_path(), 'w') as outfile:
-            json.dump(self.tree.to_dict(), outfile)
+        self.tree.save(get_vptree_path())
 
     @classmethod
     def load(cls):
-        with open(get_storage_path(), 'r') as infile:
+        # indices saved before the binary format have the JSON storage only
+        if not os.path.exists(get_vptree_path()) and os.path.exists(get_storage_path()):
+            return cls.import_json(get_storage_path())
+        return cls(BaseVpTree.load(get_vptree_path()))
+
+    def export_json(self, path):
+        """
+        :param path: str
+        :return: None
+        """
+        with open(path, 'w') as outfile:
+            json.dump(self.tree.to_dict(), outfile)
+
+    @classmethod
+    def import_json(cls, path):
+        """
+        :param path: str
+        :return: VpTree
+        """
+        with open(path, 'r') as infile:
             json_dict = json.loads(infile.read())
             return cls(BaseVpTree.from_dict(json_dict))
 
@@ -129,14 +389,14 @@ class VpTree(Storage):
         :param samples: Sequence[Sample]
         :return: VpTree
         """
-        self.tree.build(distance, np.array([sample.name for sample in samples]))
+        self.tree.build(distance, [sample.name for sample in samples])
         return self
 
     def __len__(self):
         """
         :return: int 
         """
-        return self.tree.size if self.tree else 0
+        return len(self.tree)
 
     @measure_time(enabled=True)
     def add_samples(self, samples, tree_distance):
@@ -144,4 +404,4 @@ class VpTree(Storage):
             self.tree.insert(sample.name, tree_distance)
 
     def find(self, distance, sample, k):
-        return neighbors(self.tree, distance, sample, k)
+        return neighbors(self.tree, distance, sample, k, self.stats)
@@ -1,47 +1,108 @@
+import heapq
 import numpy as np
-import queue
 
 
-def _neighbors(tree, distance, sample, k):
+# node index of a missing child, as in BaseVpTree
+_NONE = -1
+
+
+def _distance(distance, sample, tree, node, tau):
+    """
+    Distance to the vantage point, computed exactly only if it can matter:
+    either the point may become a neighbor (d <= tau) or it decides
+    whether to visit the left subtree (d < median + tau). Beyond that
+    a lower bound greater than both leads to the same decisions
+    :param distance: PairwiseDistance
+    :param sample: Union[str, Sample]
+    :param tree: BaseVpTree
+    :param node: int
+    :param tau: float
+    :return: float
+    """
+    vp = tree.vp_name(node)
+    if not hasattr(distance, 'bounded') or np.isinf(tau):
+        return distance(sample, vp)
+
+    median = tree.median[node]
+    threshold = tau if np.isnan(median) else max(tau, median + tau)
+    return distance.bounded(sample, vp, threshold)
+
+
+def _neighbors(tree, distance, sample, k, stats):
+    """
+    Best-first search: the subtrees are visited in the order of the lower
+    bounds of the distances to their points, so the nearest candidates are
+    found early and tau shrinks fast
+    :param tree: BaseVpTree
+    :param distance: PairwiseDistance
+    :param sample: Union[str, Sample]
+    :param k: int
+    :param stats: dict, the counters to update
+    :return: List[Tuple[float, str]], (-distance, name) of at most k neighbors
+    """
     tau = np.inf
-    neighbors = queue.PriorityQueue()
-    node_queue = queue.Queue()
-    node_queue.put(tree)
-
-    while not node_queue.empty():
-        node = node_queue.get()
-        if node:
-            d = distance(sample, node.vp)
-
-            if len(neighbors.queue) < k:
-                neighbors.put((-d, node.vp))
-            elif d < tau:
-                neighbors.put((-d, node.vp))
-                if len(neighbors.queue) > k:
-                    neighbors.get()
-
-                tau, _ = neighbors.queue[0]
-                tau *= -1
-
-            if not node.median:
-                continue
+    # a max-heap of the k nearest points found so far
+    neighbors = []
+    # a min-heap of the (lower bound, node) subtrees to visit
+    candidates = [(0.0, 0)] if tree.n_nodes > 0 else []
 
-            if d < node.median:
-                if d < node.median + tau:
-                    node_queue.put(node.left)
-                if d >= node.median - tau:
-                    node_queue.put(node.right)
+    while candidates:
+        bound, node = heapq.heappop(candidates)
+        if bound > tau:
+            stats['nodes_pruned'] += int(tree.size[node])
+            continue
+
+        d = _distance(distance, sample, tree, node, tau)
+        stats['nodes_visited'] += 1
+        stats['distances_computed'] += 1
+
+        if len(neighbors) < k:
+            heapq.heappush(neighbors, (-d, tree.vp_name(node)))
+        elif d < tau:
+            heapq.heapreplace(neighbors, (-d, tree.vp_name(node)))
+        if len(neighbors) == k:
+            tau = -neighbors[0][0]
+
+        median = tree.median[node]
+        if np.isnan(median):
+            continue
+
+        # the points of the left subtree are within the median from the
+        # vantage point, the points of the right one are beyond it
+        for child, child_bound in [(tree.left[node], d - median), (tree.right[node], median - d)]:
+            if child == _NONE:
+                continue
+            child_bound = max(bound, child_bound, 0.0)
+            if child_bound > tau:
+                stats['nodes_pruned'] += int(tree.size[child])
             else:
-                if d < node.median + tau:
-                    node_queue.put(node.left)
-                if d >= node.median - tau:
-                    node_queue.put(node.right)
+                heapq.heappush(candidates, (child_bound, int(child)))
+
+    return neighbors
 
-    return neighbors.queue
 
+def neighbors(vptree, distance, sample, k, stats=None):
+    """
+    :param vptree: BaseVpTree
+    :param distance: PairwiseDistance
+    :param sample: Union[str, Sample]
+    :param k: int
+    :param stats: dict, if given, gets the number of the visited nodes, the
+    computed distances and the nodes in the pruned subtrees
+    :return: Tuple[np.array, np.array], distances and names of the neighbors
+    """
+    counters = {'nodes_visited': 0, 'distances_computed': 0, 'nodes_pruned': 0}
+    # a distance that counts its evaluations does not compute the cached ones,
+    # any other one computes a distance per visited node
+    evaluations = getattr(distance, 'evaluations', None)
+    result = _neighbors(vptree, distance, sample, k, counters)
+    if evaluations is not None:
+        counters['distances_computed'] = distance.evaluations - evaluations
+    if stats is not None:
+        stats.update(counters)
 
-def neighbors(vptree, distance, sample, k):
-    result = _neighbors(vptree, distance, sample, k)
     result = sorted([(-value, point) for value, point in result])
+    if not result:
+        return np.array([]), np.array([])
     values, points = zip(*result)
     return np.array(values), np.array(points)
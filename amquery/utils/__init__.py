@@ -2,6 +2,7 @@ from .benchmarking import *
 from .config import *
 from .decorators import *
 from .iof import *
+from .lru_cache import *
 from .multiprocess import *
 from .ui import *
 from .split_fasta import split_fasta
@@ -8,7 +8,7 @@ def measure_time(enabled):
         @wraps(func)
         def wrapper(*args, **kwargs):
             start = time.time()
-            result = func(*args)
+            result = func(*args, **kwargs)
             end = time.time()
             click.secho("%s elapsed time: %f" % (func.__name__, end - start), fg='yellow')
             return result
@@ -2,10 +2,16 @@ from ._config import get_default_config, \
     read_config, \
     save_config, \
     get_biom_path, \
+    get_biom_additions_dir, \
     get_distance_path, \
+    get_distances_dir, \
     get_storage_path, \
+    get_vptree_path, \
     get_kmers_dir, \
+    get_cache_dir, \
+    get_profiles_dir, \
     get_sample_dir, \
+    get_unifrac_dir, \
     get_samplemap_path
 
 
@@ -23,18 +23,42 @@ def get_distance_path():
     return os.path.join(get_index_path(), 'distance.txt')
 
 
+def get_distances_dir():
+    return os.path.join(get_index_path(), 'distances')
+
+
 def get_storage_path():
     return os.path.join(get_index_path(), 'storage.json')
 
 
+def get_vptree_path():
+    return os.path.join(get_index_path(), 'storage.vpt')
+
+
 def get_kmers_dir():
     return os.path.join(get_index_path(), 'kmers')
 
 
+def get_profiles_dir():
+    return os.path.join(get_index_path(), 'profiles')
+
+
+def get_cache_dir():
+    return os.path.join(get_index_path(), 'cache')
+
+
 def get_biom_path():
     return os.path.join(get_index_path(), 'otu_table.biom')
 
 
+def get_unifrac_dir():
+    return os.path.join(get_index_path(), 'unifrac')
+
+
+def get_biom_additions_dir():
+    return os.path.join(get_index_path(), 'biom_additions')
+
+
 def get_sample_dir():
     return os.path.join(get_index_path(), 'samples')
 
@@ -1,8 +1,13 @@
 from collections import defaultdict
 import glob
 import os
+import bz2
+import gzip
+import lzma
+import queue
+import threading
 from Bio import SeqIO
-from typing import Mapping, List
+from typing import Iterable, Mapping, List
 
 
 def normalize(path: str):
@@ -57,6 +62,44 @@ def read_coords(filename: str) -> List[str]:
     return [line.rstrip('\n') for line in open(filename)]
 
 
+def read_lines(filename: str) -> List[str]:
+    """
+    Read an append-only file of lines, an incomplete last line left by
+    an interrupted append is skipped
+    :param filename: str
+    :return: List[str], the complete lines without the line endings
+    """
+    if not os.path.exists(filename):
+        return []
+
+    with open(filename) as f:
+        return f.read().split('\n')[:-1]
+
+
+def append_lines(filename: str, lines: Iterable[str]):
+    """
+    Append lines to an append-only file of lines, dropping an incomplete
+    last line left by an interrupted append first
+    :param filename: str
+    :param lines: Iterable[str]
+    :return: None
+    """
+    with open(filename, 'ab+') as f:
+        size = f.seek(0, os.SEEK_END)
+        tail = 0
+        while tail < size:
+            tail = min(size, max(2 * tail, 4096))
+            f.seek(size - tail)
+            last_newline = f.read(tail).rfind(b'\n')
+            if last_newline >= 0:
+                size -= tail - last_newline - 1
+                break
+        else:
+            size = 0
+        f.truncate(size)
+        f.write(''.join(line + '\n' for line in lines).encode())
+
+
 def find_lib(directory: str, prefix: str) -> str:
     for f in os.listdir(directory):
         fullname = os.path.join(directory, f)
@@ -65,3 +108,102 @@ def find_lib(directory: str, prefix: str) -> str:
             return fullname
 
     raise ValueError("Library '%s' not found" % prefix)
+
+
+_openers = {'.gz': gzip.open, '.bz2': bz2.open, '.xz': lzma.open}
+_file_formats = {'fasta': 'fasta', 'fna': 'fasta', 'fa': 'fasta', 'fas': 'fasta',
+                 'fastq': 'fastq', 'fq': 'fastq'}
+
+
+def split_compression(path: str):
+    """
+    :param path: str
+    :return: Tuple[str, str] the path without the compression extension and the extension
+    """
+    root, ext = os.path.splitext(path)
+    return (root, ext) if ext in _openers else (path, '')
+
+
+def get_file_format(path: str) -> str:
+    """
+    Sequence file format by the extension, compression extensions are skipped
+    :param path: str
+    :return: str
+    """
+    ext = os.path.splitext(split_compression(path)[0])[1][1:]
+    return _file_formats.get(ext, ext)
+
+
+def open_file(path: str, mode: str='rb'):
+    """
+    Open a file, decompressing it on the fly if it is gzip, bz2 or xz-compressed
+    :param path: str
+    :param mode: str
+    :return: file
+    """
+    return _openers.get(split_compression(path)[1], open)(path, mode)
+
+
+def iter_blocks(path: str, block_size: int, prefetch: int=2):
+    """
+    Read a (possibly compressed) file by blocks. Reading and decompression
+    run in a background thread, overlapping with the processing of the blocks
+    :param path: str
+    :param block_size: int
+    :param prefetch: int, number of blocks to read ahead
+    :return: Iterable[bytes]
+    """
+    blocks = queue.Queue(maxsize=prefetch)
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                blocks.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def read():
+        try:
+            with open_file(path, 'rb') as f:
+                for block in iter(lambda: f.read(block_size), b''):
+                    put(block)
+                    if stop.is_set():
+                        return
+        except Exception as e:
+            put(e)
+        finally:
+            put(None)
+
+    reader = threading.Thread(target=read, daemon=True)
+    reader.start()
+    try:
+        while True:
+            block = blocks.get()
+            if block is None:
+                break
+            if isinstance(block, Exception):
+                raise block
+            yield block
+    finally:
+        stop.set()
+        reader.join()
+
+
+def iter_lines(path: str, block_size: int=1 << 24):
+    """
+    Iterate over the lines of a (possibly compressed) file, keeping the line endings
+    :param path: str
+    :param block_size: int
+    :return: Iterable[bytes]
+    """
+    tail = b''
+    for block in iter_blocks(path, block_size):
+        lines = (tail + block).split(b'\n')
+        tail = lines.pop()
+        for line in lines:
+            yield line + b'\n'
+
+    if tail:
+        yield tail
@@ -0,0 +1,9 @@
+from ._lru_cache import LruCache
+
+
+__license__ = "MIT"
+__version__ = "0.2.1"
+__author__ = "Nikolay Romashchenko"
+__maintainer__ = "Nikolay Romashchenko"
+__email__ = "nikolay.romashchenko@gmail.com"
+__status__ = "Development"
@@ -0,0 +1,84 @@
+import sys
+from collections import OrderedDict
+from typing import Any, Callable, Hashable
+
+
+class LruCache:
+    """
+    Least recently used cache bounded by the total size of its values
+    """
+    def __init__(self, max_size: int=0, sizeof: Callable=sys.getsizeof):
+        """
+        :param max_size: int, 0 means unlimited
+        :param sizeof: Callable[[Any], int]
+        """
+        self.max_size = max_size
+        self._sizeof = sizeof
+        self._items = OrderedDict()
+        self._sizes = {}
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: Hashable, load: Callable) -> Any:
+        """
+        :param key: Hashable
+        :param load: Callable[[], Any], called on a miss
+        :return: Any
+        """
+        if key in self._items:
+            self.hits += 1
+            self._items.move_to_end(key)
+            return self._items[key]
+
+        self.misses += 1
+        value = load()
+        self.put(key, value)
+        return value
+
+    def put(self, key: Hashable, value: Any):
+        if key in self._items:
+            self._remove(key)
+
+        self._items[key] = value
+        self._sizes[key] = self._sizeof(value)
+        self.size += self._sizes[key]
+        self._evict()
+
+    def discard(self, key: Hashable):
+        if key in self._items:
+            self._remove(key)
+
+    def resize(self, max_size: int):
+        self.max_size = max_size
+        self._evict()
+
+    def clear(self):
+        self._items.clear()
+        self._sizes.clear()
+        self.size = 0
+
+    def _remove(self, key):
+        del self._items[key]
+        self.size -= self._sizes.pop(key)
+
+    def _evict(self):
+        # the most recently used value is kept even if it does not fit alone
+        while self.max_size and self.size > self.max_size and len(self._items) > 1:
+            self._remove(next(iter(self._items)))
+            self.evictions += 1
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def __len__(self):
+        return len(self._items)
+
+    @property
+    def stats(self):
+        """
+        :return: Mapping[str, int]
+        """
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                'size': self.size, 'count': len(self)}
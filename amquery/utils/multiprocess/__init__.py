@@ -1,6 +1,7 @@
 from ._multiprocess import Pool,\
                            PackedUnaryFunction,\
-                           PackedBinaryFunction
+                           PackedBinaryFunction,\
+                           available_threads
 
 
 __license__ = "MIT"
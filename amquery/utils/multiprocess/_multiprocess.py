@@ -8,11 +8,31 @@ from amquery.utils.decorators import singleton
 @singleton
 class Pool:
     def __init__(self, **kwargs):
-        self.pool = mp.Pool(processes=kwargs.get("jobs", 1))
+        self.jobs = kwargs.get("jobs", 1)
+        # the workers are started on the first task, after the index configured them
+        self.pool = None
+        self.initializer = None
+        self.initargs = ()
         self.manager = mp.Manager()
         self.queue = self.manager.Queue()
 
+    def set_initializer(self, initializer: Callable, *initargs):
+        """
+        Set up the process state every worker starts with. The workers
+        started before are replaced
+        :param initializer: Callable, a module-level function
+        :param initargs: arguments of the initializer
+        :return: None
+        """
+        self.initializer = initializer
+        self.initargs = initargs
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool = None
+
     def map_async(self, *args):
+        if self.pool is None:
+            self.pool = mp.Pool(processes=self.jobs, initializer=self.initializer, initargs=self.initargs)
         return self.pool.map_async(*args)
 
     def clear(self):
@@ -45,6 +65,16 @@ class PackedBinaryFunction:
         return self.func(a, b)
 
 
+def available_threads(jobs: int) -> int:
+    """
+    Number of threads a native call may use: the given number of jobs in
+    the main process, one inside the pool workers, which already occupy the cores
+    :param jobs: int
+    :return: int
+    """
+    return max(jobs, 1) if mp.parent_process() is None else 1
+
+
 def run(fn: Callable, data: Iterable) -> List:
     try:
         return list(map(fn, data))
@@ -2,33 +2,133 @@ import click
 import os
 import os.path
 import collections
-import Bio
-from amquery.utils.iof import make_sure_exists
+from amquery.utils.iof import make_sure_exists, get_file_format, iter_lines
 
 
-def split_fasta(input_file, output_dir):
+class _OutputFiles:
     """
-    Split a fasta by sample names
+    A bounded pool of open per-sample output files. The least recently
+    written file is closed when the pool is full and reopened for appending
+    """
+    def __init__(self, output_dir, extension, max_open_files):
+        self._output_dir = output_dir
+        self._extension = extension
+        self._max_open_files = max_open_files
+        self._handles = collections.OrderedDict()
+        self.paths = collections.OrderedDict()
+
+    def get(self, sample_name):
+        """
+        :param sample_name: str
+        :return: file
+        """
+        if sample_name in self._handles:
+            self._handles.move_to_end(sample_name)
+            return self._handles[sample_name]
+
+        if len(self._handles) >= self._max_open_files:
+            _, handle = self._handles.popitem(last=False)
+            handle.close()
+
+        if sample_name in self.paths:
+            handle = open(self.paths[sample_name], 'ab')
+        else:
+            self.paths[sample_name] = os.path.join(self._output_dir, sample_name + self._extension)
+            handle = open(self.paths[sample_name], 'wb')
+
+        self._handles[sample_name] = handle
+        return handle
+
+    def close(self):
+        for handle in self._handles.values():
+            handle.close()
+        self._handles.clear()
+
+
+def _parse_sample_name(header, input_file, line_number):
+    """
+    :param header: bytes
     :param input_file: str
-    :param output_dir: str
-    :return: 
+    :param line_number: int, of the header in the input file
+    :return: str
+    """
+    fields = header[1:].split(maxsplit=1)
+    sample_name = fields[0].decode().split("_")[0] if fields else ''
+    if not sample_name:
+        raise ValueError("%s:%d: no sample name in the header %r" %
+                         (input_file, line_number, header.decode(errors='replace')))
+    return sample_name
+
+
+def _fastq_lines(lines):
     """
-    read_mapping = collections.defaultdict(list)
-    with open(input_file, 'r') as infile:
-        for seq_record in Bio.SeqIO.parse(infile, "fasta"):
-            sample_name = seq_record.id.split(" ")[0]
-            sample_name = sample_name.split("_")[0]
-            read_mapping[sample_name].append(seq_record)
+    Check that the lines make four-line fastq records: a header, a sequence,
+    a separator and qualities of the length of the sequence
+    :param lines: Iterable[bytes]
+    :return: Iterable[Tuple[bool, bytes]], the lines flagged if they are headers
+    """
+    def fail(reason):
+        raise ValueError("Malformed fastq record, %s: %r" % (reason, b''.join(record).decode(errors='replace')))
+
+    record = []
+    # empty lines are allowed at the end of the file only
+    blank = False
+    for line in lines:
+        if not record and not line.strip():
+            blank = True
+            continue
+        if blank:
+            record.append(line)
+            fail("empty line between records")
+
+        record.append(line)
+        if len(record) == 1 and not line.startswith(b'@'):
+            fail("no '@' header")
+        if len(record) == 3 and not line.startswith(b'+'):
+            fail("no '+' separator")
+        if len(record) == 4:
+            if len(line.rstrip(b'\r\n')) != len(record[1].rstrip(b'\r\n')):
+                fail("sequence and quality lengths differ")
+            record = []
+
+        yield len(record) == 1, line
 
-    # writing split files
-    result = []
+    if record:
+        fail("truncated record")
+
+
+def split_fasta(input_file, output_dir, max_open_files=128):
+    """
+    Split a fasta or a fastq file, possibly compressed, by sample names.
+    Records are written uncompressed as they are read, so the memory does
+    not depend on the input size. Fastq records are expected to take four
+    lines, malformed ones raise ValueError
+    :param input_file: str
+    :param output_dir: str
+    :param max_open_files: int
+    :return: List[str]
+    """
+    file_format = get_file_format(input_file)
     output_dir = make_sure_exists(output_dir)
-    for sample in read_mapping.keys():
-        output_file = os.path.join(output_dir, sample + ".fasta")
-        Bio.SeqIO.write(read_mapping[sample], output_file, "fasta")
-        result.append(output_file)
+    output_files = _OutputFiles(output_dir, "." + file_format, max_open_files)
+
+    try:
+        outfile = None
+        if file_format == 'fastq':
+            lines = _fastq_lines(iter_lines(input_file))
+        else:
+            lines = ((line.startswith(b'>'), line) for line in iter_lines(input_file))
+
+        for line_number, (is_header, line) in enumerate(lines, 1):
+            if is_header:
+                outfile = output_files.get(_parse_sample_name(line, input_file, line_number))
+
+            if outfile:
+                outfile.write(line)
+    finally:
+        output_files.close()
 
-    return result
+    return list(output_files.paths.values())
 
 
 CONTEXT_SETTINGS = dict(help_option_names=['-h', '--help'])
@@ -39,9 +139,11 @@ CONTEXT_SETTINGS = dict(help_option_names=['-h', '--help'])
                 required=True)
 @click.option('--output_dir', '-o', help='Output directory',
               required=True)
-def run(input_files, output_dir):
+@click.option('--max_open_files', type=int, default=128,
+              help='Maximum number of output files kept open')
+def run(input_files, output_dir, max_open_files):
     for input_file in input_files:
-        split_fasta(input_file, output_dir)
+        split_fasta(input_file, output_dir, max_open_files)
 
 
 if __name__ == "__main__":
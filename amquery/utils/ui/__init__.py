@@ -1,4 +1,4 @@
-from ._ui import progress_bar
+from ._ui import progress_bar, cache_stats, search_stats
 
 
 __license__ = "MIT"
@@ -22,3 +22,26 @@ def progress_bar(result, queue: mp.Queue, total_size: int, label: str):
             pbar.update(k)
 
     return result
+
+
+def cache_stats(label: str, stats):
+    """
+    Report the cache usage to stderr, apart from the results
+    :param label: str
+    :param stats: Mapping[str, int] hits, misses, evictions, size in bytes and count of the cached items
+    :return: None
+    """
+    click.secho("%s: %d hits, %d misses, %d evictions, %d items, %.1f MB" %
+                (label, stats['hits'], stats['misses'], stats['evictions'],
+                 stats['count'], stats['size'] / 2 ** 20), fg='yellow', err=True)
+
+
+def search_stats(label: str, stats):
+    """
+    Report the search work to stderr, apart from the results
+    :param label: str
+    :param stats: Mapping[str, int] visited nodes, computed distances and pruned nodes of a search
+    :return: None
+    """
+    click.secho("%s: %d nodes visited, %d distances computed, %d nodes pruned" %
+                (label, stats['nodes_visited'], stats['distances_computed'], stats['nodes_pruned']), fg='yellow', err=True)
@@ -41,7 +41,8 @@ setup(
                            ),
                  Extension('amquery.core.distance.metrics.jsd',
                            sources=['amquery/core/distance/metrics/jsd.cpp'],
-                           extra_compile_args=['-std=c++11'],
+                           extra_compile_args=['-std=c++11', '-pthread'],
+                           extra_link_args=['-pthread'],
                            )
                  ],
 )
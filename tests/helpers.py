@@ -0,0 +1,26 @@
+import bz2
+import gzip
+import lzma
+import random
+import numpy as np
+
+from amquery.core.distance.kmers_distr.sparse_array import SparseArray
+
+
+writers = {'': open, '.gz': gzip.open, '.bz2': bz2.open, '.xz': lzma.open}
+
+
+class SampleMock:
+    def __init__(self, name, kmer_index):
+        self.name = name
+        self.kmer_index = kmer_index
+
+
+def random_read(length):
+    return ''.join(random.choice('ACGTACGTACGTN') for _ in range(length))
+
+
+def random_profile(size, k=6):
+    cols = np.sort(np.random.choice(4 ** k, size, replace=False)).astype(np.uint64)
+    data = np.random.uniform(0, 1, size)
+    return SparseArray(cols, data / np.sum(data))
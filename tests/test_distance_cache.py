@@ -0,0 +1,123 @@
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+
+from amquery.core.distance import DistanceCache, SamplePairwiseDistance
+from amquery.core.sample_map import SampleMap
+from amquery.utils.config import get_default_config, get_distance_path
+
+
+class TestDistanceCache(unittest.TestCase):
+    def test_grow(self):
+        cache = DistanceCache()
+        names = ['s%d' % i for i in range(200)]
+        for i, name in enumerate(names):
+            self.assertEqual(cache.add(name), i)
+            if i > 0:
+                cache.set(i - 1, i, i / 1000.0)
+
+        self.assertEqual(cache.add('s7'), 7)
+        self.assertEqual(len(cache), 200)
+        self.assertAlmostEqual(cache.get(150, 149), 0.15, places=6)
+        self.assertTrue(np.isnan(cache.get(0, 2)))
+
+    def test_sparse(self):
+        # a dense square array of this many samples would take tens of gigabytes
+        cache = DistanceCache('s%d' % i for i in range(100000))
+        cache.set(99999, 5, 0.5)
+        self.assertEqual(cache.get(5, 99999), 0.5)
+        self.assertTrue(np.isnan(cache.get(5, 99998)))
+
+    def test_many(self):
+        cache = DistanceCache(['a', 'b', 'c'])
+        js = cache.ids(['b', 'c'])
+        cache.set_many(cache.id('a'), js, np.array([0.5, 0.25]))
+        np.testing.assert_array_equal(cache.get_many(0, js), [0.5, 0.25])
+        self.assertEqual(cache.get(2, 0), 0.25)
+
+    def test_dataframe(self):
+        cache = DistanceCache(['a', 'b'])
+        cache.set(0, 1, 0.5)
+        restored = DistanceCache.from_dataframe(cache.dataframe)
+        self.assertEqual(restored.names, ['a', 'b'])
+        np.testing.assert_array_equal(restored.matrix, cache.matrix)
+
+    def test_legacy_text(self):
+        cwd = os.getcwd()
+        path = tempfile.mkdtemp()
+        try:
+            os.chdir(path)
+            os.makedirs(os.path.dirname(get_distance_path()))
+            names = ['c', 'a', 'b']
+            cache = DistanceCache(names)
+            cache.set(0, 1, 0.5)
+            cache.set(1, 2, 0.25)
+            # an index written before the binary cache keeps a tab-separated table
+            SamplePairwiseDistance(None, cache=cache, sample_map=SampleMap.fromkeys(names)).export(get_distance_path())
+            SampleMap.fromkeys(names).save()
+
+            config = get_default_config()
+            config.set('distance', 'method', 'ffp-jsd')
+            loaded = SamplePairwiseDistance.load(config)
+            self.assertEqual(loaded.cache.names, names)
+            np.testing.assert_array_equal(loaded.matrix, cache.matrix)
+            self.assertEqual(loaded.cache.get(2, 1), 0.25)
+        finally:
+            os.chdir(cwd)
+            shutil.rmtree(path)
+
+    def test_save_appends(self):
+        path = tempfile.mkdtemp()
+        try:
+            cache = DistanceCache(['a', 'b'])
+            cache.set(0, 1, 0.5)
+            cache.save(path)
+            entries_size = os.path.getsize(os.path.join(path, 'entries'))
+
+            cache.add('c')
+            cache.set_many(2, np.array([0, 1]), np.array([0.25, 0.75]))
+            cache.save(path)
+            self.assertEqual(os.path.getsize(os.path.join(path, 'entries')), 3 * entries_size)
+
+            # an interrupted append is dropped on the next save
+            with open(os.path.join(path, 'entries'), 'ab') as f:
+                f.write(b'\x00' * 5)
+            cache.save(path)
+
+            restored = DistanceCache.load(path)
+            self.assertEqual(restored.names, ['a', 'b', 'c'])
+            np.testing.assert_array_equal(restored.matrix, cache.matrix)
+        finally:
+            shutil.rmtree(path)
+
+    def test_compact(self):
+        path = tempfile.mkdtemp()
+        try:
+            cache = DistanceCache(['s%d' % i for i in range(50)])
+            cache.set_many(0, np.arange(1, 50), np.linspace(0.1, 0.9, 49))
+            cache.save(path)
+            cache.compact(path)
+            self.assertEqual(os.path.getsize(os.path.join(path, 'entries')), 0)
+
+            # the later distances go to the log, a repeated one overrides the sorted record
+            cache.set(3, 4, 0.25)
+            cache.set(0, 1, 0.75)
+            cache.save(path)
+
+            restored = DistanceCache.load(path)
+            np.testing.assert_array_equal(restored.matrix, cache.matrix)
+            self.assertEqual(restored.get(1, 0), 0.75)
+            self.assertEqual(restored.get(4, 3), 0.25)
+            self.assertTrue(np.isnan(restored.get(3, 5)))
+
+            restored.compact(path)
+            self.assertEqual(os.path.getsize(os.path.join(path, 'entries')), 0)
+            np.testing.assert_array_equal(DistanceCache.load(path).matrix, cache.matrix)
+        finally:
+            shutil.rmtree(path)
+
+
+if __name__ == '__main__':
+    unittest.main()
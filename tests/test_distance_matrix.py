@@ -0,0 +1,44 @@
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+
+from amquery.core.distance import distance_matrix
+from amquery.core.distance.metrics import Ffp_JSD
+from tests.helpers import SampleMock, random_profile
+
+
+class TestDistanceMatrix(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.output_file = os.path.join(self.path, 'matrix.npy')
+        # a few tiles, the last ones are partial
+        self.samples = [SampleMock(str(i), random_profile(np.random.randint(1, 300))) for i in range(11)]
+        self.distance = Ffp_JSD(None)
+
+        n = len(self.samples)
+        self.expected = np.array([[self.distance(self.samples[i], self.samples[j]) for j in range(n)]
+                                  for i in range(n)])
+        self.expected[np.isnan(self.expected)] = 0.0
+
+    def test_full(self):
+        distance_matrix(self.distance, self.samples, self.output_file, tile_size=4)
+        matrix = np.load(self.output_file)
+        np.testing.assert_allclose(matrix, self.expected, atol=1e-12)
+        np.testing.assert_array_equal(matrix, matrix.T)
+
+    def test_upper(self):
+        distance_matrix(self.distance, self.samples, self.output_file, upper=True, tile_size=4)
+        np.testing.assert_allclose(np.load(self.output_file), np.triu(self.expected), atol=1e-12)
+
+    def test_single_tile(self):
+        distance_matrix(self.distance, self.samples, self.output_file, tile_size=len(self.samples))
+        np.testing.assert_allclose(np.load(self.output_file), self.expected, atol=1e-12)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+
+if __name__ == '__main__':
+    unittest.main()
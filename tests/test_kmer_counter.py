@@ -0,0 +1,196 @@
+import os
+import re
+import gzip
+import shutil
+import random
+import tempfile
+import unittest
+import numpy as np
+from collections import Counter
+
+from amquery.core.sample import Sample
+from amquery.core.preprocessing import KmerCounter, ProfileCache
+from amquery.core.profile_store import ProfileStore
+from amquery.utils.config import get_profiles_dir
+from amquery.utils.multiprocess import Pool
+from tests.helpers import random_read
+
+
+def naive_profile(reads, k):
+    counter = Counter()
+    for read in reads:
+        for fragment in re.split('[^ACGT]+', read):
+            for i in range(len(fragment) - k + 1):
+                rank = 0
+                for char in fragment[i:i + k]:
+                    rank = 4 * rank + 'ACGT'.index(char)
+                counter[rank] += 1
+
+    cols = np.array(sorted(counter.keys()), dtype=np.uint64)
+    data = np.array([counter[key] for key in cols], dtype=np.float64)
+    return cols, data / np.sum(data)
+
+
+class TestKmerCounter(unittest.TestCase):
+    def setUp(self):
+        self.k = 5
+        variants = [random_read(random.randint(50, 150)) for _ in range(10)]
+        self.reads = [random.choice(variants) for _ in range(200)] + \
+                     [random_read(random.randint(0, 30)) for _ in range(20)]
+
+        sample_file = tempfile.NamedTemporaryFile('w', suffix='.fasta', delete=False)
+        with sample_file:
+            for i, read in enumerate(self.reads):
+                sample_file.write('>sample_%d\n' % i)
+                for j in range(0, len(read), 60):
+                    sample_file.write(read[j:j + 60] + '\n')
+        self.sample_file = sample_file.name
+
+    def _test_profile(self, counter):
+        sample = counter(Sample(self.sample_file))
+        cols, data = naive_profile(self.reads, self.k)
+
+        self.assertEqual(sample.kmer_index.cols.dtype, np.uint64)
+        self.assertTrue(np.array_equal(sample.kmer_index.cols, cols))
+        self.assertTrue(np.allclose(sample.kmer_index.data, data))
+
+    def test_profile(self):
+        self._test_profile(KmerCounter(self.k, dereplicate=False))
+
+    def test_dereplicated_profile(self):
+        self._test_profile(KmerCounter(self.k, dereplicate=True))
+
+    def test_short_fragments(self):
+        # the fragments between the ambiguous bases shorter than k have no k-mers
+        with open(self.sample_file, 'w') as f:
+            f.write('>sample_0\nACGTACG\n>sample_1\nACGNTTGCANGG\n>sample_2\nACG\n')
+        self.reads = ['ACGTACG', 'ACGNTTGCANGG', 'ACG']
+        for dereplicate in [False, True]:
+            self._test_profile(KmerCounter(self.k, dereplicate=dereplicate))
+            self._test_profile(KmerCounter(self.k, dereplicate=dereplicate, memory_budget=1024))
+
+    def test_memory_budget_profile(self):
+        self._test_profile(KmerCounter(self.k, dereplicate=False, memory_budget=1024))
+        self._test_profile(KmerCounter(self.k, dereplicate=True, memory_budget=1024))
+
+    def test_cascaded_runs(self):
+        # a tiny budget spills a run per a few k-mers, far more runs than the merge fan-in
+        self._test_profile(KmerCounter(self.k, dereplicate=False, memory_budget=64))
+
+    def test_spill_failure(self):
+        tempdir = tempfile.tempdir
+        tempfile.tempdir = os.path.join(tempfile.mkdtemp(), 'missing')
+        try:
+            counter = KmerCounter(self.k, dereplicate=False, memory_budget=1024)
+            self.assertRaises(OSError, counter, Sample(self.sample_file))
+        finally:
+            shutil.rmtree(os.path.dirname(tempfile.tempdir))
+            tempfile.tempdir = tempdir
+
+    def test_dereplication_is_exact(self):
+        x = KmerCounter(self.k, dereplicate=False)(Sample(self.sample_file)).kmer_index
+        for counter in [KmerCounter(self.k, dereplicate=True),
+                        KmerCounter(self.k, dereplicate=False, memory_budget=1024)]:
+            y = counter(Sample(self.sample_file)).kmer_index
+            self.assertTrue(np.array_equal(x.cols, y.cols))
+            self.assertTrue(np.array_equal(x.data, y.data))
+
+    def test_compressed_profile(self):
+        with open(self.sample_file, 'rb') as infile, gzip.open(self.sample_file + '.gz', 'wb') as outfile:
+            outfile.write(infile.read())
+
+        try:
+            x = KmerCounter(self.k)(Sample(self.sample_file)).kmer_index
+            y = KmerCounter(self.k)(Sample(self.sample_file + '.gz')).kmer_index
+            self.assertTrue(np.array_equal(x.cols, y.cols))
+            self.assertTrue(np.array_equal(x.data, y.data))
+        finally:
+            os.unlink(self.sample_file + '.gz')
+
+    def test_profile_cache(self):
+        cache_dir = tempfile.mkdtemp()
+        try:
+            cache = ProfileCache(cache_dir, max_size=1 << 20)
+            x = KmerCounter(self.k, cache=cache)(Sample(self.sample_file)).kmer_index
+            self.assertEqual(len(os.listdir(cache_dir)), 1)
+
+            key = cache.key(Sample(self.sample_file), self.k)
+            self.assertNotEqual(key, cache.key(Sample(self.sample_file), self.k + 1))
+            y = cache.get(key)
+            self.assertTrue(np.array_equal(x.cols, y.cols))
+            self.assertTrue(np.array_equal(x.data, y.data))
+
+            cache.max_size = 0
+            cache.shrink()
+            self.assertIsNone(cache.get(key))
+        finally:
+            shutil.rmtree(cache_dir)
+
+    def test_broken_profile_cache(self):
+        cache_dir = tempfile.mkdtemp()
+        try:
+            cache = ProfileCache(cache_dir, max_size=1 << 20)
+            key = cache.key(Sample(self.sample_file), self.k)
+            x = KmerCounter(self.k, cache=cache)(Sample(self.sample_file)).kmer_index
+
+            # a truncated or foreign entry is a miss and is dropped
+            for content in [b'', b'not a pickle', b'\x80\x04\x95']:
+                with open(os.path.join(cache_dir, key), 'wb') as f:
+                    f.write(content)
+                self.assertIsNone(cache.get(key))
+                self.assertFalse(os.path.exists(os.path.join(cache_dir, key)))
+
+            y = KmerCounter(self.k, cache=cache)(Sample(self.sample_file)).kmer_index
+            self.assertTrue(np.array_equal(x.cols, y.cols))
+            self.assertTrue(np.array_equal(cache.get(key).data, x.data))
+        finally:
+            shutil.rmtree(cache_dir)
+
+    def tearDown(self):
+        os.unlink(self.sample_file)
+
+
+class TestPoolCounting(unittest.TestCase):
+    def setUp(self):
+        self.k = 5
+        self.cwd = os.getcwd()
+        self.path = tempfile.mkdtemp()
+        os.chdir(self.path)
+        # the workers are started anew in the index directory
+        Pool.instance().set_initializer(None)
+
+        self.sample_files = []
+        for name in ['S0', 'S1', 'S2', 'S3']:
+            sample_file = os.path.join(self.path, name + '.fasta')
+            with open(sample_file, 'w') as f:
+                for i in range(50):
+                    f.write('>%s_%d\n%s\n' % (name, i, random_read(random.randint(0, 150))))
+            self.sample_files.append(sample_file)
+
+    def test_process(self):
+        counter = KmerCounter(self.k, dereplicate=False)
+        samples = counter.process([Sample(sample_file) for sample_file in self.sample_files])
+        self.assertEqual([sample.name for sample in samples], ['S0', 'S1', 'S2', 'S3'])
+        # the workers store the profiles and send back the samples without them
+        self.assertTrue(all(sample._kmer_index is None for sample in samples))
+
+        store = ProfileStore.open(get_profiles_dir())
+        for sample, sample_file in zip(samples, self.sample_files):
+            expected = KmerCounter(self.k, dereplicate=False)(Sample(sample_file)).kmer_index
+            self.assertTrue(np.array_equal(store[sample.name].cols, expected.cols))
+            self.assertTrue(np.array_equal(store[sample.name].data, expected.data))
+            self.assertTrue(np.array_equal(sample.kmer_index.cols, expected.cols))
+
+        # the samples do not store their profiles again
+        rows_size = os.path.getsize(os.path.join(get_profiles_dir(), 'rows'))
+        for sample in samples:
+            sample.save()
+        self.assertEqual(os.path.getsize(os.path.join(get_profiles_dir(), 'rows')), rows_size)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.path)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,37 @@
+import unittest
+
+from amquery.utils.lru_cache import LruCache
+
+
+class TestLruCache(unittest.TestCase):
+    def setUp(self):
+        self.cache = LruCache(max_size=3, sizeof=len)
+
+    def test_eviction(self):
+        for key in 'abc':
+            self.cache.get(key, lambda: key)
+        self.cache.get('a', lambda: 'a')
+        self.cache.get('d', lambda: 'dd')
+
+        self.assertIn('a', self.cache)
+        self.assertIn('d', self.cache)
+        self.assertNotIn('b', self.cache)
+        self.assertNotIn('c', self.cache)
+        self.assertEqual(self.cache.stats, {'hits': 1, 'misses': 4, 'evictions': 2, 'size': 3, 'count': 2})
+
+    def test_oversized_value(self):
+        self.cache.get('a', lambda: 'aaaaa')
+        self.assertIn('a', self.cache)
+        self.cache.get('b', lambda: 'b')
+        self.assertNotIn('a', self.cache)
+
+    def test_unlimited(self):
+        self.cache.resize(0)
+        for i in range(100):
+            self.cache.put(i, 'x' * i)
+        self.assertEqual(len(self.cache), 100)
+        self.assertEqual(self.cache.evictions, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,124 @@
+import unittest
+import numpy as np
+
+from amquery.core.distance.kmers_distr.sparse_array import SparseArray, CompactSparseArray
+from scipy.spatial.distance import braycurtis, cosine
+from amquery.core.distance.metrics import Ffp_JSD, Angular, BrayCurtis, BRAY_CURTIS, distances, matrix_distances
+from amquery.core.distance.factory import Factory as DistanceFactory
+from amquery.utils.config import get_default_config
+from tests.helpers import SampleMock, random_profile
+
+
+class TestFfpJsd(unittest.TestCase):
+    def setUp(self):
+        self.samples = [SampleMock(str(i), random_profile(np.random.randint(1, 500))) for i in range(30)]
+        self.distance = Ffp_JSD(None)
+
+    def test_batch(self):
+        for a in self.samples:
+            expected = np.array([self.distance(a, b) for b in self.samples])
+            self.assertTrue(np.array_equal(self.distance.batch(a, self.samples), expected, equal_nan=True))
+
+    def test_range(self):
+        for a in self.samples:
+            values = self.distance.batch(a, self.samples)
+            values = values[~np.isnan(values)]
+            self.assertTrue(np.all((values >= 0) & (values <= 1)))
+
+    def test_bounded(self):
+        for a in self.samples:
+            for b in self.samples:
+                exact = self.distance(a, b)
+                if np.isnan(exact):
+                    continue
+                for threshold in [0.0, 0.5, 0.9, 0.99, exact, 1.0]:
+                    value = self.distance.bounded(a, b, threshold)
+                    if exact <= threshold:
+                        self.assertEqual(value, exact)
+                    else:
+                        self.assertGreater(value, threshold)
+                        self.assertLessEqual(value, exact + 1e-12)
+
+
+class TestCompactProfiles(unittest.TestCase):
+    def setUp(self):
+        self.wide = []
+        self.compact = []
+        for i in range(20):
+            size = np.random.randint(1, 500)
+            cols = np.sort(np.random.choice(4 ** 6, size, replace=False)).astype(np.uint64)
+            counts = np.random.randint(1, 100000, size).astype(np.uint64)
+            self.compact.append(SampleMock(str(i), CompactSparseArray.from_counts(cols, counts)))
+            self.wide.append(SampleMock(str(i), SparseArray(cols, counts / float(np.sum(counts)))))
+        self.distance = Ffp_JSD(None)
+
+    def test_same_distances(self):
+        for a, a_compact in zip(self.wide, self.compact):
+            # self-distances are NaN or about zero, depending on the rounding
+            expected = np.nan_to_num(self.distance.batch(a, self.wide))
+            for x in [a, a_compact]:
+                for ys in [self.wide, self.compact]:
+                    values = np.nan_to_num(self.distance.batch(x, ys))
+                    np.testing.assert_allclose(values, expected, rtol=0, atol=1e-6)
+
+    def test_bounded(self):
+        for a in self.compact:
+            for b in self.wide:
+                exact = self.distance(a, b)
+                if np.isnan(exact):
+                    continue
+                value = self.distance.bounded(a, b, 0.9)
+                if exact <= 0.9:
+                    self.assertEqual(value, exact)
+                else:
+                    self.assertGreater(value, 0.9)
+
+    def test_too_wide(self):
+        cols = np.array([1, 2 ** 40], dtype=np.uint64)
+        self.assertIsNone(CompactSparseArray.from_counts(cols, np.array([1, 1], dtype=np.uint64)))
+
+
+def dense(profile):
+    values = np.zeros(4 ** 6)
+    values[profile.cols.astype(np.int64)] = profile.data
+    return values
+
+
+class TestSparseMetrics(unittest.TestCase):
+    def setUp(self):
+        self.samples = [SampleMock(str(i), random_profile(np.random.randint(1, 500))) for i in range(20)]
+
+    def _test_metric(self, distance, reference):
+        expected = np.array([[reference(dense(a.kmer_index), dense(b.kmer_index)) for b in self.samples]
+                             for a in self.samples])
+        np.testing.assert_allclose(distance.tile(self.samples, self.samples), expected, atol=1e-6)
+        np.testing.assert_allclose(distance.batch(self.samples[0], self.samples[5:]), expected[0, 5:], atol=1e-6)
+        pairs = np.array([[distance(a, b) for b in self.samples] for a in self.samples])
+        np.testing.assert_allclose(pairs, expected, atol=1e-6)
+
+        # frequencies of raw counts
+        counts = np.random.randint(1, 1000, 300).astype(np.uint64)
+        cols = np.sort(np.random.choice(4 ** 6, 300, replace=False)).astype(np.uint64)
+        compact = SampleMock('compact', CompactSparseArray.from_counts(cols, counts))
+        values = [reference(dense(compact.kmer_index), dense(b.kmer_index)) for b in self.samples]
+        np.testing.assert_allclose([distance(compact, b) for b in self.samples], values, atol=1e-6)
+        np.testing.assert_allclose(distance.batch(compact, self.samples), values, atol=1e-6)
+
+    def test_angular(self):
+        self._test_metric(Angular(None), lambda x, y: np.arccos(np.clip(1 - cosine(x, y), 0, 1)) / (np.pi / 2))
+
+    def test_bray_curtis(self):
+        self._test_metric(BrayCurtis(None), braycurtis)
+
+    def test_index_methods(self):
+        # a VP-tree index needs the triangle inequality
+        self.assertNotIn(BRAY_CURTIS, distances)
+        self.assertIn(BRAY_CURTIS, matrix_distances)
+
+        config = get_default_config()
+        config.set('distance', 'method', BRAY_CURTIS)
+        self.assertRaises(ValueError, DistanceFactory.create, config)
+
+
+if __name__ == '__main__':
+    unittest.main()
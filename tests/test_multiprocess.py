@@ -0,0 +1,24 @@
+import unittest
+
+from amquery.core.index._index import _resize_profile_cache
+from amquery.core.sample import KmerIndexCache
+from amquery.utils.multiprocess import Pool
+
+
+def profile_cache_size(_):
+    return KmerIndexCache.instance().max_size
+
+
+class TestPool(unittest.TestCase):
+    def test_initializer(self):
+        pool = Pool.instance()
+        pool.set_initializer(_resize_profile_cache, 2 ** 20)
+        self.assertEqual(pool.map_async(profile_cache_size, range(4)).get(), [2 ** 20] * 4)
+
+        # the workers started before are replaced
+        pool.set_initializer(_resize_profile_cache, 2 ** 21)
+        self.assertEqual(pool.map_async(profile_cache_size, range(4)).get(), [2 ** 21] * 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,142 @@
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+
+from amquery.core.distance.kmers_distr.sparse_array import CompactSparseArray
+from amquery.core.profile_store import ProfileStore
+from tests.helpers import random_profile
+
+
+class TestProfileStore(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.profiles = {str(i): random_profile(np.random.randint(1, 100), k=8) for i in range(10)}
+
+    def _assert_equal(self, x, y):
+        self.assertTrue(np.array_equal(x.cols, y.cols))
+        self.assertTrue(np.array_equal(x.data, y.data))
+        self.assertTrue(np.array_equal(x.entropy, y.entropy))
+        self.assertEqual(x.mass, y.mass)
+
+    def test_append_load(self):
+        store = ProfileStore(self.path)
+        for name, profile in self.profiles.items():
+            store.append(name, profile)
+            self._assert_equal(store[name], profile)
+
+        store = ProfileStore(self.path)
+        self.assertEqual(len(store), len(self.profiles))
+        for name, profile in self.profiles.items():
+            self._assert_equal(store[name], profile)
+            self.assertIsInstance(store[name].cols, np.memmap)
+            self.assertIsInstance(store[name].entropy, np.memmap)
+            # the mapped views do not count against the profile memory budget
+            self.assertEqual(store[name].resident_nbytes, 0)
+            self.assertEqual(profile.resident_nbytes, profile.nbytes)
+
+    def test_shadowing(self):
+        store = ProfileStore(self.path)
+        store.append('a', self.profiles['0'])
+        store.append('a', self.profiles['1'])
+        self._assert_equal(ProfileStore(self.path)['a'], self.profiles['1'])
+
+    def test_interrupted_append(self):
+        store = ProfileStore(self.path)
+        store.append('a', self.profiles['0'])
+
+        # simulate an append that crashed after writing the columns
+        with open(os.path.join(self.path, 'cols'), 'ab') as f:
+            self.profiles['1'].cols.tofile(f)
+        with open(os.path.join(self.path, 'rows'), 'a') as f:
+            f.write('b\t0')
+
+        store = ProfileStore(self.path)
+        self.assertNotIn('b', store)
+        store.append('c', self.profiles['2'])
+        store = ProfileStore(self.path)
+        self._assert_equal(store['a'], self.profiles['0'])
+        self._assert_equal(store['c'], self.profiles['2'])
+
+    def test_refresh(self):
+        store = ProfileStore(self.path)
+        store.append('a', self.profiles['0'])
+        reader = ProfileStore(self.path)
+        self.assertNotIn('b', reader)
+
+        # the rows read before are not parsed again
+        with open(os.path.join(self.path, 'rows'), 'r+') as f:
+            f.write('x')
+        store.append('b', self.profiles['1'])
+        self.assertIn('b', reader)
+        self.assertNotIn('x', reader)
+        self._assert_equal(reader['a'], self.profiles['0'])
+        self._assert_equal(reader['b'], self.profiles['1'])
+
+    def test_compaction(self):
+        store = ProfileStore(self.path)
+        counts = np.random.randint(1, 1000, 50).astype(np.uint64)
+        cols = np.sort(np.random.choice(4 ** 8, 50, replace=False)).astype(np.uint64)
+        for name, profile in self.profiles.items():
+            store.append(name, profile)
+        for name in '02468':
+            store.append(name, self.profiles['1'])
+        store.append('c', CompactSparseArray.from_counts(cols, counts))
+        store.append('c', CompactSparseArray.from_counts(cols, counts))
+        reader = ProfileStore(self.path)
+        old_view = reader['3']
+        self.assertGreater(store.garbage, 0.0)
+
+        store.compact()
+        self.assertEqual(store.garbage, 0.0)
+        self.assertFalse(os.path.exists(self.path + '.tmp'))
+        self.assertFalse(os.path.exists(self.path + '.old'))
+
+        for store in [store, reader, ProfileStore(self.path)]:
+            self.assertEqual(len(store), len(self.profiles) + 1)
+            for name, profile in self.profiles.items():
+                self._assert_equal(store[name], self.profiles['1'] if name in '02468' else profile)
+            self.assertTrue(np.array_equal(store['c'].cols, cols))
+            self.assertTrue(np.array_equal(store['c'].counts, counts))
+        self._assert_equal(old_view, self.profiles['3'])
+
+        store.append('d', self.profiles['2'])
+        self._assert_equal(ProfileStore(self.path)['d'], self.profiles['2'])
+
+    def test_interrupted_compaction(self):
+        store = ProfileStore(self.path)
+        store.append('a', self.profiles['0'])
+        store.append('a', self.profiles['1'])
+
+        # the compacted store was written, but has not replaced the old one
+        shutil.copytree(self.path, self.path + '.tmp')
+        os.rename(self.path, self.path + '.old')
+        self._assert_equal(ProfileStore(self.path)['a'], self.profiles['1'])
+        self.assertFalse(os.path.exists(self.path + '.old'))
+
+    def test_compact(self):
+        store = ProfileStore(self.path)
+        counts = np.random.randint(1, 1000, 50).astype(np.uint64)
+        cols = np.sort(np.random.choice(4 ** 8, 50, replace=False)).astype(np.uint64)
+        compact = CompactSparseArray.from_counts(cols, counts)
+        store.append('a', self.profiles['0'])
+        store.append('b', compact)
+        store.append('c', self.profiles['1'])
+
+        store = ProfileStore(self.path)
+        self._assert_equal(store['a'], self.profiles['0'])
+        self._assert_equal(store['c'], self.profiles['1'])
+        self.assertIsInstance(store['b'], CompactSparseArray)
+        self.assertTrue(np.array_equal(store['b'].cols, cols))
+        self.assertTrue(np.array_equal(store['b'].counts, counts))
+        self.assertEqual(store['b'].total, np.sum(counts))
+        self.assertEqual(store['b'].resident_nbytes, 0)
+        self.assertEqual(compact.resident_nbytes, compact.nbytes)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,114 @@
+import os
+import re
+import random
+import shutil
+import tempfile
+import unittest
+import numpy as np
+
+from amquery.core.sample import Sample
+from amquery.core.sample._sample import _read_fasta_blocks, _decode_fasta_block, _read_fastq_blocks, \
+    _decode_fastq_block, _split_ambiguous
+from tests.helpers import random_read, writers
+
+
+def fasta(reads):
+    return ''.join('>sample_%d\n%s\n%s\n' % (i, read[:40], read[40:]) for i, read in enumerate(reads))
+
+
+def fastq(reads):
+    return ''.join('@sample_%d\n%s\n+\n%s\n' % (i, read, 'I' * len(read)) for i, read in enumerate(reads))
+
+
+def decode(codes):
+    return ''.join('ACGT'[code] for code in codes)
+
+
+class TestSampleReading(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.reads = [random_read(random.randint(0, 120)) for _ in range(50)]
+        self.expected = [fragment for read in self.reads for fragment in re.split('[^ACGT]+', read) if fragment]
+
+    def _write(self, name, content, codec=''):
+        path = os.path.join(self.path, name + codec)
+        with writers[codec](path, 'wb') as f:
+            f.write(content.encode())
+        return path
+
+    def _seqs(self, path):
+        return [decode(codes) for codes in Sample(path).iter_seqs()]
+
+    def test_formats(self):
+        for codec in writers:
+            for ext, content in [('.fasta', fasta(self.reads)), ('.fastq', fastq(self.reads))]:
+                path = self._write('sample' + ext, content, codec)
+                self.assertEqual(Sample(path).name, 'sample')
+                self.assertEqual(self._seqs(path), self.expected, path)
+
+    def test_fasta_block(self):
+        # the headers are masked even if they look like sequences
+        block = b'>ACGT_0 GATTACA\nACGTNAC\nGTTG\r\n>CCCC_1\n\nAANTT\n>GGGG_2\n'
+        codes = _decode_fasta_block(block)
+        self.assertEqual([decode(x) for x in _split_ambiguous(codes)], ['ACGT', 'ACGTTG', 'AA', 'TT'])
+
+    def test_fasta_blocks(self):
+        path = self._write('sample.fasta', fasta(self.reads))
+        blocks = list(_read_fasta_blocks(path, block_size=37))
+        self.assertGreater(len(blocks), 1)
+        self.assertTrue(all(block.startswith(b'>') for block in blocks))
+        codes = np.concatenate([_decode_fasta_block(block) for block in blocks])
+        self.assertEqual([decode(x) for x in _split_ambiguous(codes)], self.expected)
+
+    def test_fastq_blocks(self):
+        path = self._write('sample.fastq', fastq(self.reads) + '\n\n')
+        blocks = list(_read_fastq_blocks(path, block_size=37))
+        self.assertGreater(len(blocks), 1)
+        codes = np.concatenate([_decode_fastq_block(block) for block in blocks])
+        self.assertEqual([decode(x) for x in _split_ambiguous(codes)], self.expected)
+
+    def test_trailing_blank_lines(self):
+        # the last read is empty, its sequence and qualities are blank lines too
+        content = fastq(self.reads + [''])
+        for blank_lines in ['\n' * 5, '\r\n' * 6]:
+            path = self._write('sample.fastq', content + blank_lines)
+            self.assertEqual(self._seqs(path), self.expected)
+            for block_size in [37, 1000]:
+                blocks = list(_read_fastq_blocks(path, block_size=block_size))
+                codes = np.concatenate([_decode_fastq_block(block) for block in blocks])
+                self.assertEqual([decode(x) for x in _split_ambiguous(codes)], self.expected)
+
+        # but not between the records
+        path = self._write('sample.fastq', fastq(self.reads[:2]) + '\n' * 4 + fastq(self.reads[2:]))
+        for block_size in [37, 1000]:
+            blocks = _read_fastq_blocks(path, block_size=block_size)
+            self.assertRaises(ValueError, lambda: [_decode_fastq_block(block) for block in blocks])
+
+    def test_no_sample_name(self):
+        for content in ['', '\n\n', 'ACGT\n', '>\nACGT\n', '\n@_0\nACGT\n+\nIIII\n']:
+            path = self._write('sample.fasta', content)
+            with self.assertRaisesRegex(ValueError, re.escape(path)):
+                Sample(path)
+
+    def test_crlf_fastq(self):
+        path = self._write('sample.fastq', fastq(self.reads).replace('\n', '\r\n'))
+        self.assertEqual(self._seqs(path), self.expected)
+
+    def test_malformed_fastq(self):
+        record = '@sample_0\nACGT\n+\nIIII\n'
+        for content in ['@sample_0\nACGT\n+\n',
+                        record + '>sample_1\nACGT\n+\nIIII\n',
+                        record + '@sample_1\nACGT\n-\nIIII\n',
+                        record + '@sample_1\nACGT\n+\nIII\n',
+                        record + '\n' + record,
+                        '@sample_0\nAC\nGT\n+\nIIII\n']:
+            for codec in writers:
+                path = self._write('sample.fastq', content, codec)
+                self.assertRaises(ValueError, self._seqs, path)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+
+if __name__ == '__main__':
+    unittest.main()
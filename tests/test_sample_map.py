@@ -0,0 +1,66 @@
+import os
+import json
+import shutil
+import tempfile
+import unittest
+from click.testing import CliRunner
+
+from amquery import cli
+from amquery.core import SampleMap
+from amquery.core.sample import Sample
+from amquery.utils.config import get_samplemap_path, get_sample_dir
+
+
+class TestSampleMap(unittest.TestCase):
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.path = tempfile.mkdtemp()
+        os.chdir(self.path)
+
+        # an index of the manifest only, the sample objects are not there
+        self.names = ['S2', 'S0', 'S1']
+        os.makedirs(os.path.dirname(get_samplemap_path()))
+        with open(get_samplemap_path(), 'w') as f:
+            json.dump(self.names, f)
+
+    def test_lazy_load(self):
+        sample_map = SampleMap.load()
+        self.assertEqual(len(sample_map), len(self.names))
+        self.assertEqual(list(sample_map.labels), self.names)
+        self.assertIn('S1', sample_map)
+        self.assertEqual(sample_map.loaded_samples, [])
+
+        # unchanged samples are not written back
+        sample_map.save()
+        self.assertFalse(os.path.exists(get_sample_dir()))
+        with open(get_samplemap_path()) as f:
+            self.assertEqual(json.load(f), self.names)
+
+    def test_materialize(self):
+        sample_file = os.path.join(self.path, 'S1.fasta')
+        with open(sample_file, 'w') as f:
+            f.write('>S1_0\nACGT\n')
+        Sample(sample_file).save()
+
+        sample_map = SampleMap.load()
+        self.assertEqual(sample_map['S1'].name, 'S1')
+        self.assertEqual([sample.name for sample in sample_map.loaded_samples], ['S1'])
+        self.assertRaises(FileNotFoundError, sample_map.__getitem__, 'S0')
+
+    def test_cli(self):
+        runner = CliRunner()
+        result = runner.invoke(cli, ['stats'])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn('%d samples' % len(self.names), result.output)
+
+        result = runner.invoke(cli, ['ls'])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertEqual(result.output.split()[1:], sorted(self.names))
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.path)
+
+
+if __name__ == '__main__':
+    unittest.main()
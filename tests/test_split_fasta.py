@@ -0,0 +1,113 @@
+import os
+import re
+import random
+import shutil
+import tempfile
+import unittest
+
+from amquery.utils.split_fasta import split_fasta, _OutputFiles
+from tests.helpers import random_read, writers
+
+
+class TestSplitFasta(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.output_dir = os.path.join(self.path, 'samples')
+        self.names = ['S%d' % i for i in range(5)]
+        self.reads = [(random.choice(self.names), random_read(random.randint(1, 100))) for _ in range(100)]
+
+    def _write(self, name, content, codec=''):
+        path = os.path.join(self.path, name + codec)
+        with writers[codec](path, 'wb') as f:
+            f.write(content.encode())
+        return path
+
+    def _test_split(self, ext, record):
+        records = {}
+        for i, (name, read) in enumerate(self.reads):
+            records.setdefault(name, []).append(record(name, i, read))
+        content = ''.join(record(name, i, read) for i, (name, read) in enumerate(self.reads))
+        for codec in writers:
+            shutil.rmtree(self.output_dir, ignore_errors=True)
+            paths = split_fasta(self._write('input' + ext, content, codec), self.output_dir)
+
+            self.assertEqual(sorted(os.path.basename(path) for path in paths),
+                             sorted(name + ext for name in records))
+            for name, expected in records.items():
+                with open(os.path.join(self.output_dir, name + ext)) as f:
+                    self.assertEqual(f.read(), ''.join(expected))
+
+    def test_fasta(self):
+        self._test_split('.fasta', lambda name, i, read: '>%s_%d\n%s\n' % (name, i, read))
+
+    def test_fastq(self):
+        self._test_split('.fastq', lambda name, i, read: '@%s_%d\n%s\n+\n%s\n' % (name, i, read, 'I' * len(read)))
+
+    def test_few_open_files(self):
+        # every sample file is closed and reopened many times
+        content = ''.join('>%s_%d\n%s\n' % (name, i, read) for i, (name, read) in enumerate(self.reads))
+        input_file = self._write('input.fasta', content)
+        split_fasta(input_file, os.path.join(self.path, 'expected'))
+        split_fasta(input_file, self.output_dir, max_open_files=2)
+
+        for name in set(name for name, _ in self.reads):
+            with open(os.path.join(self.path, 'expected', name + '.fasta')) as f:
+                expected = f.read()
+            with open(os.path.join(self.output_dir, name + '.fasta')) as f:
+                self.assertEqual(f.read(), expected)
+
+    def test_output_files(self):
+        os.makedirs(self.output_dir)
+        output_files = _OutputFiles(self.output_dir, '.fasta', 2)
+        a = output_files.get('a')
+        a.write(b'>a_0\n')
+        output_files.get('b').write(b'>b_0\n')
+        self.assertIs(output_files.get('a'), a)
+
+        # b is the least recently used one
+        output_files.get('c').write(b'>c_0\n')
+        self.assertFalse(a.closed)
+        self.assertIs(output_files.get('a'), a)
+        output_files.get('d')
+        self.assertFalse(a.closed)
+        output_files.get('c')
+        self.assertTrue(a.closed)
+
+        # an evicted file is reopened for appending
+        output_files.get('a').write(b'>a_1\n')
+        output_files.get('b').write(b'>b_1\n')
+        output_files.close()
+        self.assertEqual(list(output_files.paths), ['a', 'b', 'c', 'd'])
+        with open(output_files.paths['a'], 'rb') as f:
+            self.assertEqual(f.read(), b'>a_0\n>a_1\n')
+        with open(output_files.paths['b'], 'rb') as f:
+            self.assertEqual(f.read(), b'>b_0\n>b_1\n')
+
+    def test_malformed_fastq(self):
+        record = '@S0_0\nACGT\n+\nIIII\n'
+        for content in [record + '@S1_1\nACGT\n+\n',
+                        record + 'S1_1\nACGT\n+\nIIII\n',
+                        record + '@S1_1\nACGT\nIIII\n+\n',
+                        record + '@S1_1\nACGT\n+\nIIIII\n',
+                        record + '\n' + record]:
+            for codec in writers:
+                self.assertRaises(ValueError, split_fasta, self._write('input.fastq', content, codec),
+                                  self.output_dir)
+
+        # empty lines after the last record are fine
+        split_fasta(self._write('input.fastq', record + '\n\n'), self.output_dir)
+        with open(os.path.join(self.output_dir, 'S0.fastq')) as f:
+            self.assertEqual(f.read(), record)
+
+    def test_no_sample_name(self):
+        for header in ['>', '> ', '>_1']:
+            input_file = self._write('input.fasta', '>S0_0\nACGT\n%s\nACGT\n' % header)
+            with self.assertRaisesRegex(ValueError, re.escape(input_file) + ':3:'):
+                split_fasta(input_file, self.output_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,122 @@
+import os
+import pickle
+import random
+import shutil
+import tempfile
+import unittest
+import numpy as np
+from biom import Table
+from biom.util import biom_open
+from skbio import read
+from skbio.tree import TreeNode
+from skbio.diversity.beta import weighted_unifrac
+
+from amquery.core.distance.metrics import UnifracCache
+
+
+def random_tree(n_tips):
+    nodes = ['OTU%d:%.3f' % (i, random.uniform(0.1, 2)) for i in range(n_tips)]
+    while len(nodes) > 1:
+        a = nodes.pop(random.randrange(len(nodes)))
+        b = nodes.pop(random.randrange(len(nodes)))
+        nodes.append('(%s,%s):%.3f' % (a, b, random.uniform(0.1, 2)))
+    return nodes[0].rsplit(':', 1)[0] + ';\n'
+
+
+class TestUnifracCache(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.tree_path = os.path.join(self.path, 'tree.nwk')
+        self.biom_path = os.path.join(self.path, 'table.biom')
+        with open(self.tree_path, 'w') as f:
+            f.write(random_tree(20))
+
+        # a few OTUs of the table are missing in the tree
+        otus = ['OTU%d' % i for i in range(25)]
+        self.samples = ['S%d' % i for i in range(10)]
+        data = np.random.poisson(3, (len(otus), len(self.samples))) * (np.random.rand(len(otus), len(self.samples)) < 0.6)
+        data[0] += 1
+        self.table = Table(data.astype(float), otus, self.samples)
+        with biom_open(self.biom_path, 'w') as f:
+            self.table.to_hdf5(f, 'test')
+
+    def _expected(self, a, b):
+        tree = read(self.tree_path, format='newick', into=TreeNode).root_at_midpoint()
+        tips = {tip.name for tip in tree.tips()}
+        ids = self.table.ids(axis='observation')
+        mask = np.array([id_ in tips for id_ in ids])
+        return weighted_unifrac(self.table.data(a)[mask], self.table.data(b)[mask], ids[mask], tree.shear(ids[mask]))
+
+    def test_distance(self):
+        cache = UnifracCache.build(self.biom_path, self.tree_path)
+        for a in self.samples[:4]:
+            for b in self.samples:
+                self.assertAlmostEqual(cache.distance(cache.sample_ids[a], cache.sample_ids[b]),
+                                       self._expected(a, b), places=10)
+
+    def test_vectorized(self):
+        cache = UnifracCache.build(self.biom_path, self.tree_path)
+        n = len(cache)
+        expected = np.array([[cache.distance(i, j) for j in range(n)] for i in range(n)])
+        np.testing.assert_allclose(cache.many_to_many(np.arange(n), np.arange(n)), expected, atol=1e-12)
+        np.testing.assert_allclose(cache.one_to_many(3, [0, 5, 3]), expected[3, [0, 5, 3]], atol=1e-12)
+        self.assertAlmostEqual(cache.distance(4, 4), 0.0)
+
+    def test_open(self):
+        cache_path = os.path.join(self.path, 'unifrac')
+        built = UnifracCache.open(self.biom_path, self.tree_path, cache_path)
+        loaded = UnifracCache.open(self.biom_path, self.tree_path, cache_path)
+        self.assertIsInstance(loaded.embedding, np.memmap)
+        self.assertEqual(loaded.sample_names, built.sample_names)
+        self.assertEqual(loaded.distance(1, 2), built.distance(1, 2))
+
+    def test_pickle(self):
+        cache_path = os.path.join(self.path, 'unifrac')
+        cache = UnifracCache.open(self.biom_path, self.tree_path, cache_path)
+
+        # a saved cache is pickled by its directory and mapped again
+        data = pickle.dumps(cache)
+        self.assertLess(len(data), cache.embedding.nbytes)
+        restored = pickle.loads(data)
+        self.assertIsInstance(restored.embedding, np.memmap)
+        self.assertEqual(restored.sample_names, cache.sample_names)
+        ids = np.arange(len(cache))
+        np.testing.assert_array_equal(restored.many_to_many(ids, ids), cache.many_to_many(ids, ids))
+
+        built = UnifracCache.build(self.biom_path, self.tree_path)
+        np.testing.assert_array_equal(pickle.loads(pickle.dumps(built)).embedding, built.embedding)
+
+    def test_append(self):
+        cache_path = os.path.join(self.path, 'unifrac')
+        cache = UnifracCache.open(self.biom_path, self.tree_path, cache_path)
+
+        # the new samples have a part of the OTUs of the master table only
+        addition_path = os.path.join(self.path, 'addition.biom')
+        otus = ['OTU%d' % i for i in range(5, 25)]
+        data = np.random.poisson(3, (len(otus), 3)) + 1
+        addition = Table(data.astype(float), otus, ['N0', 'N1', 'N2'])
+        with biom_open(addition_path, 'w') as f:
+            addition.to_hdf5(f, 'test')
+
+        self.assertTrue(cache.can_append(addition))
+        self.assertFalse(cache.can_append(self.table))
+        cache.append(cache_path, addition_path)
+
+        reopened = UnifracCache.open(self.biom_path, self.tree_path, cache_path, [addition_path])
+        rebuilt = UnifracCache.build(self.biom_path, self.tree_path, [addition_path])
+        self.assertEqual(reopened.sample_names, cache.sample_names)
+        self.assertEqual(sorted(cache.sample_names), sorted(rebuilt.sample_names))
+
+        # a merged table orders the samples its own way
+        ids = np.arange(len(cache))
+        rebuilt_ids = np.array([rebuilt.sample_ids[name] for name in cache.sample_names])
+        expected = rebuilt.many_to_many(rebuilt_ids, rebuilt_ids)
+        np.testing.assert_allclose(cache.many_to_many(ids, ids), expected, atol=1e-12)
+        np.testing.assert_allclose(reopened.many_to_many(ids, ids), expected, atol=1e-12)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -6,7 +6,7 @@ import string
 import random
 from sklearn.neighbors import NearestNeighbors
 
-from amquery.core.storage.vptree import VpTree
+from amquery.core.storage.vptree import VpTree, BaseVpTree
 
 
 class ConfigMock:
@@ -41,6 +41,20 @@ class SampleDistanceMock:
         self.sample_map[sample.name] = sample
 
 
+class CachedDistanceMock(SampleDistanceMock):
+    def __init__(self, function, sample_map):
+        super(CachedDistanceMock, self).__init__(function, sample_map)
+        self.values = {}
+        self.evaluations = 0
+
+    def __call__(self, a, b):
+        key = tuple(sorted((a, b)))
+        if key not in self.values:
+            self.values[key] = super(CachedDistanceMock, self).__call__(a, b)
+            self.evaluations += 1
+        return self.values[key]
+
+
 class SampleMapMock(dict):
     pass
 
@@ -107,6 +121,72 @@ class TestVptree(unittest.TestCase):
         tree.add_samples(new_samples, self.distance)
         self._test_search(tree)
 
+    def test_bytes(self):
+        tree = BaseVpTree.from_bytes(self.tree.tree.to_bytes())
+        self.assertEqual(tree.to_dict(), self.tree.tree.to_dict())
+        self.assertEqual(BaseVpTree.from_dict(tree.to_dict()).to_dict(), tree.to_dict())
+
+    def test_binary_file(self):
+        path = self.config.vptree_path
+        self.tree.tree.save(path)
+        tree = BaseVpTree.load(path)
+        self.assertIsInstance(tree.vp.base, np.memmap)
+        self.assertEqual(tree.to_dict(), self.tree.tree.to_dict())
+
+        # the mapped tree is copied on insert and can replace its own file
+        sample = SampleMock(random_name(), np.random.uniform(0, 1, self.m))
+        self.sample_map[sample.name] = sample
+        tree.insert(sample.name, self.distance)
+        tree.save(path)
+        self.assertEqual(BaseVpTree.load(path).to_dict(), tree.to_dict())
+        self.assertEqual(len(BaseVpTree.load(path)), self.n + 1)
+
+        BaseVpTree().save(path)
+        self.assertEqual(len(BaseVpTree.load(path)), 0)
+
+        with open(path, 'wb') as f:
+            f.write(b'\x00' * 64)
+        self.assertRaises(ValueError, BaseVpTree.load, path)
+
+    def test_stats(self):
+        for name, sample in self.sample_map.items():
+            values, _ = self.tree.find(self.distance, name, self.k)
+            expected = sorted(euclidean(sample.values, other.values) for other in self.samples)[:self.k]
+            np.testing.assert_allclose(values, expected)
+
+            stats = self.tree.stats
+            self.assertEqual(stats['nodes_visited'], stats['distances_computed'])
+            self.assertGreaterEqual(stats['nodes_visited'], self.k)
+            self.assertLessEqual(stats['nodes_visited'] + stats['nodes_pruned'], self.n)
+
+        # only the distances missing in the cache of the distance are computed
+        distance = CachedDistanceMock(euclidean, self.sample_map)
+        for name in self.sample_map:
+            self.tree.find(distance, name, self.k)
+            self.assertGreaterEqual(self.tree.stats['distances_computed'], 0)
+            self.assertLessEqual(self.tree.stats['distances_computed'], self.tree.stats['nodes_visited'])
+
+        evaluations = distance.evaluations
+        name = next(iter(self.sample_map))
+        self.tree.find(distance, name, self.k)
+        self.assertEqual(self.tree.stats['distances_computed'], 0)
+        self.assertGreater(self.tree.stats['nodes_visited'], 0)
+        self.assertEqual(distance.evaluations, evaluations)
+
+    def test_degenerate(self):
+        # points on a line inserted in order make a chain deeper than the recursion limit
+        n = 1200
+        line = SampleMapMock({str(i): SampleMock(str(i), np.array([float(i)])) for i in range(n)})
+        distance = SampleDistanceMock(euclidean, line)
+        tree = VpTree()
+        tree.add_samples(list(line.values()), distance)
+
+        restored = VpTree(BaseVpTree.from_bytes(tree.tree.to_bytes()))
+        self.assertEqual(len(restored), n)
+        self.assertEqual(BaseVpTree.from_dict(restored.tree.to_dict()).n_nodes, n)
+        values, points = restored.find(distance, '600', 3)
+        self.assertEqual(sorted(points), ['599', '600', '601'])
+
     def tearDown(self):
         os.unlink(self.config.vptree_path)
 